@@ -1,17 +1,22 @@
 """共享内存管理工具 - GUI 主程序"""
 import tkinter as tk
 from tkinter import ttk, scrolledtext, messagebox
-import socket
-import time
-import threading
-from multiprocessing import shared_memory
 
 # 从工具模块导入共享内存相关功能
 from shared_memory_utils import (
-    BUF_SIZE, DATA_OFFSET, MAX_DATA_SIZE, SYNC_UPDATE_CMD,
-    LOCK_FREE, LOCK_HELD,
-    get_local_ip, SharedMemoryLock, shm_write, shm_read
+    BUF_SIZE, MAX_DATA_SIZE, LOCK_KIND_SPIN, LOCK_KIND_SEMAPHORE, LOCK_KIND_RWLOCK,
+    VersionConflictError, get_local_ip, segment_size, diff_patch
 )
+from shm_server import SharedMemoryHost
+from shm_snapshot import DEFAULT_SNAPSHOT_INTERVAL
+from shm_client import SharedMemoryClient, ClientWorker, encode_text
+
+# 锁类型选项（界面显示名称 -> 段头中的锁类型）
+LOCK_KIND_CHOICES = {
+    "轮询锁": LOCK_KIND_SPIN,
+    "阻塞锁（信号量）": LOCK_KIND_SEMAPHORE,
+    "读写锁": LOCK_KIND_RWLOCK,
+}
 
 
 class SharedMemoryGUI:
@@ -22,10 +27,15 @@ class SharedMemoryGUI:
         
         # 状态变量
         self.mode = tk.StringVar(value="host")
-        self.shm = None
-        self.lock = None
-        self.server_socket = None
-        self.client_socket = None
+        self.host = None  # SharedMemoryHost（Host 模式）
+        self.client = None  # SharedMemoryClient（Client 模式）
+        self.host_version = None  # 输入框当前显示内容的版本号
+        self.client_worker = None  # 独占 Client 连接的后台 I/O 线程
+        self.client_write_seq = 0  # 已发起的远程写入次数，用于丢弃过期的刷新结果
+        self.client_version = None  # 最近一次得知的 Host 内容版本号（用于增量写入），未知时为 None
+        self.client_notify_seq = 0  # 收到的推送次数
+        self.host_capacity = MAX_DATA_SIZE
+        self.client_capacity = MAX_DATA_SIZE
         self.is_locked = False
         self.auto_refresh_running = False
         self.last_content = ""  # 用于检测内容变化
@@ -88,38 +98,68 @@ class SharedMemoryGUI:
         ttk.Label(self.host_frame, textvariable=self.host_shm_id_var, 
                  font=("Arial", 10, "bold")).grid(row=3, column=1, sticky=tk.W, padx=5)
         
+        # 段大小输入（启动时指定，运行中可扩容）
+        ttk.Label(self.host_frame, text="段大小 (bytes):").grid(row=4, column=0, sticky=tk.W, pady=5)
+        size_frame = ttk.Frame(self.host_frame)
+        size_frame.grid(row=4, column=1, sticky=tk.W, padx=5)
+        self.host_size_entry = ttk.Entry(size_frame, width=15)
+        self.host_size_entry.insert(0, str(BUF_SIZE))
+        self.host_size_entry.pack(side=tk.LEFT)
+        self.host_grow_btn = ttk.Button(size_frame, text="扩容", 
+                                       command=self.host_grow, state=tk.DISABLED)
+        self.host_grow_btn.pack(side=tk.LEFT, padx=5)
+        ttk.Label(size_frame, text="锁类型:").pack(side=tk.LEFT, padx=(10, 0))
+        self.host_lock_kind_var = tk.StringVar(value="轮询锁")
+        ttk.Combobox(size_frame, textvariable=self.host_lock_kind_var, width=14, state="readonly",
+                    values=list(LOCK_KIND_CHOICES)).pack(side=tk.LEFT, padx=5)
+        
         # 启动/停止按钮
         self.host_start_btn = ttk.Button(self.host_frame, text="启动 Host", 
                                         command=self.start_host)
-        self.host_start_btn.grid(row=4, column=0, columnspan=2, pady=10)
+        self.host_start_btn.grid(row=5, column=0, columnspan=2, pady=10)
         
         self.host_stop_btn = ttk.Button(self.host_frame, text="停止 Host", 
                                        command=self.stop_host, state=tk.DISABLED)
-        self.host_stop_btn.grid(row=5, column=0, columnspan=2, pady=5)
+        self.host_stop_btn.grid(row=6, column=0, columnspan=2, pady=5)
         
         # 共享内存内容显示和编辑区域
-        ttk.Label(self.host_frame, text=f"共享内存中的内容 (最大 {MAX_DATA_SIZE} bytes):").grid(
-            row=6, column=0, columnspan=2, sticky=tk.W, pady=(10, 5))
+        self.host_content_label = ttk.Label(self.host_frame, 
+                                           text=f"共享内存中的内容 (最大 {MAX_DATA_SIZE} bytes):")
+        self.host_content_label.grid(
+            row=7, column=0, columnspan=2, sticky=tk.W, pady=(10, 5))
         
         self.host_text = scrolledtext.ScrolledText(self.host_frame, height=15, width=70)
-        self.host_text.grid(row=7, column=0, columnspan=2, pady=5)
+        self.host_text.grid(row=8, column=0, columnspan=2, pady=5)
         self.host_text.bind('<KeyRelease>', self.on_host_text_change)
         self.host_text_editing = False  # 标记是否正在编辑
         
         # 字符计数
-        self.host_count_var = tk.StringVar(value="0 / 4091 bytes")
+        self.host_count_var = tk.StringVar(value=f"0 / {MAX_DATA_SIZE} bytes")
         ttk.Label(self.host_frame, textvariable=self.host_count_var).grid(
-            row=8, column=0, columnspan=2, sticky=tk.W)
+            row=9, column=0, columnspan=2, sticky=tk.W)
         
         # 写入按钮
         self.host_write_btn = ttk.Button(self.host_frame, text="写入共享内存", 
                                         command=self.host_write, state=tk.DISABLED)
-        self.host_write_btn.grid(row=9, column=0, columnspan=2, pady=10)
+        self.host_write_btn.grid(row=10, column=0, columnspan=2, pady=10)
         
         # 锁状态显示
         self.host_lock_var = tk.StringVar(value="锁状态: 空闲")
         ttk.Label(self.host_frame, textvariable=self.host_lock_var, 
-                 foreground="green").grid(row=10, column=0, columnspan=2, pady=5)
+                 foreground="green").grid(row=11, column=0, columnspan=2, pady=5)
+        
+        # 快照文件（留空不保存；设置后定期保存、停止时保存，可选启动时恢复）
+        ttk.Label(self.host_frame, text="快照文件:").grid(row=12, column=0, sticky=tk.W, pady=5)
+        snapshot_frame = ttk.Frame(self.host_frame)
+        snapshot_frame.grid(row=12, column=1, sticky=tk.W, padx=5)
+        self.host_snapshot_entry = ttk.Entry(snapshot_frame, width=25)
+        self.host_snapshot_entry.pack(side=tk.LEFT)
+        self.host_warm_start_var = tk.BooleanVar(value=True)
+        ttk.Checkbutton(snapshot_frame, text="启动时恢复",
+                        variable=self.host_warm_start_var).pack(side=tk.LEFT, padx=5)
+        self.host_snapshot_btn = ttk.Button(snapshot_frame, text="立即快照",
+                                           command=self.host_snapshot, state=tk.DISABLED)
+        self.host_snapshot_btn.pack(side=tk.LEFT, padx=5)
         
     def create_client_widgets(self):
         # Host IP 输入
@@ -149,7 +189,9 @@ class SharedMemoryGUI:
         self.client_disconnect_btn.grid(row=4, column=0, columnspan=2, pady=5)
         
         # 共享内存内容显示和编辑区域
-        ttk.Label(self.client_frame, text=f"共享内存中的内容 (最大 {MAX_DATA_SIZE} bytes):").grid(
+        self.client_content_label = ttk.Label(self.client_frame, 
+                                             text=f"共享内存中的内容 (最大 {MAX_DATA_SIZE} bytes):")
+        self.client_content_label.grid(
             row=5, column=0, columnspan=2, sticky=tk.W, pady=(10, 5))
         
         self.client_text = scrolledtext.ScrolledText(self.client_frame, height=15, width=70)
@@ -158,7 +200,7 @@ class SharedMemoryGUI:
         self.client_text_editing = False  # 标记是否正在编辑
         
         # 字符计数
-        self.client_count_var = tk.StringVar(value="0 / 4091 bytes")
+        self.client_count_var = tk.StringVar(value=f"0 / {MAX_DATA_SIZE} bytes")
         ttk.Label(self.client_frame, textvariable=self.client_count_var).grid(
             row=7, column=0, columnspan=2, sticky=tk.W)
         
@@ -187,13 +229,13 @@ class SharedMemoryGUI:
         self.host_text_editing = True
         text = self.host_text.get("1.0", tk.END).rstrip('\n')
         byte_count = len(text.encode("utf-8"))
-        self.host_count_var.set(f"{byte_count} / {MAX_DATA_SIZE} bytes")
+        self.host_count_var.set(f"{byte_count} / {self.host_capacity} bytes")
         
         # 如果超过限制，禁用写入按钮
-        if byte_count > MAX_DATA_SIZE:
+        if byte_count > self.host_capacity:
             self.host_write_btn.config(state=tk.DISABLED)
-            self.host_count_var.set(f"{byte_count} / {MAX_DATA_SIZE} bytes (超出限制!)")
-        elif self.shm is not None:
+            self.host_count_var.set(f"{byte_count} / {self.host_capacity} bytes (超出限制!)")
+        elif self.host is not None:
             self.host_write_btn.config(state=tk.NORMAL)
         
         # 延迟重置编辑标志，避免频繁更新
@@ -204,13 +246,13 @@ class SharedMemoryGUI:
         self.client_text_editing = True
         text = self.client_text.get("1.0", tk.END).rstrip('\n')
         byte_count = len(text.encode("utf-8"))
-        self.client_count_var.set(f"{byte_count} / {MAX_DATA_SIZE} bytes")
+        self.client_count_var.set(f"{byte_count} / {self.client_capacity} bytes")
         
         # 如果超过限制，禁用写入按钮
-        if byte_count > MAX_DATA_SIZE:
+        if byte_count > self.client_capacity:
             self.client_write_btn.config(state=tk.DISABLED)
-            self.client_count_var.set(f"{byte_count} / {MAX_DATA_SIZE} bytes (超出限制!)")
-        elif self.shm is not None:
+            self.client_count_var.set(f"{byte_count} / {self.client_capacity} bytes (超出限制!)")
+        elif self.client is not None:
             self.client_write_btn.config(state=tk.NORMAL)
         
         # 延迟重置编辑标志，避免频繁更新
@@ -219,18 +261,28 @@ class SharedMemoryGUI:
     def start_host(self):
         """启动 Host"""
         try:
-            # 创建共享内存
-            self.shm = shared_memory.SharedMemory(create=True, size=BUF_SIZE)
-            self.shm.buf[0] = LOCK_FREE
-            
-            self.lock = SharedMemoryLock(self.shm)
-            
-            # 创建服务器 socket，绑定到 0.0.0.0（监听所有接口）
-            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.server_socket.bind(("0.0.0.0", 0))  # 绑定到所有接口
-            self.server_socket.listen(1)
-            host, port = self.server_socket.getsockname()
+            try:
+                size = int(self.host_size_entry.get().strip())
+            except ValueError:
+                raise ValueError(f"段大小格式错误: '{self.host_size_entry.get()}'，请输入数字")
+            
+            # 创建指定大小的共享内存，并启动服务（绑定到 0.0.0.0，监听所有接口）
+            lock_kind = LOCK_KIND_CHOICES[self.host_lock_kind_var.get()]
+            snapshot_path = self.host_snapshot_entry.get().strip() or None
+            self.host = SharedMemoryHost(
+                size, lock_kind=lock_kind, snapshot_path=snapshot_path,
+                snapshot_interval=DEFAULT_SNAPSHOT_INTERVAL if snapshot_path else 0,
+                warm_start=self.host_warm_start_var.get(),
+                on_update=self.on_remote_update,
+                on_status=lambda msg: self.root.after(0, lambda: self.status_var.set(msg)))
+            try:
+                host, port = self.host.start()
+            except Exception:
+                self.host = None
+                raise
+            self.update_host_capacity()
+            self.host_version = None
+            shm_id = self.host.shm_id
             
             # 获取本机实际 IP
             local_ip = get_local_ip()
@@ -238,166 +290,90 @@ class SharedMemoryGUI:
             # 更新界面
             self.host_ip_var.set(f"{local_ip} (可通过此 IP 访问)")
             self.host_port_var.set(str(port))
-            self.host_shm_id_var.set(self.shm.name)
+            self.host_shm_id_var.set(shm_id)
             self.host_start_btn.config(state=tk.DISABLED)
             self.host_stop_btn.config(state=tk.NORMAL)
             self.host_write_btn.config(state=tk.NORMAL)
-            
-            # 启动监听线程
-            threading.Thread(target=self.host_listen, daemon=True).start()
+            self.host_grow_btn.config(state=tk.NORMAL)
+            if snapshot_path:
+                self.host_snapshot_btn.config(state=tk.NORMAL)
             
             # 初始化输入框内容
             try:
-                initial_text = shm_read(self.shm, self.lock, DATA_OFFSET)
+                initial_text = self.host.read()
                 self.host_text.delete("1.0", tk.END)
                 self.host_text.insert("1.0", initial_text)
                 self.last_content = initial_text
                 byte_count = len(initial_text.encode("utf-8"))
-                self.host_count_var.set(f"{byte_count} / {MAX_DATA_SIZE} bytes")
+                self.host_count_var.set(f"{byte_count} / {self.host_capacity} bytes")
             except:
                 pass
             
             # 启动自动刷新
             self.start_auto_refresh()
             
-            self.status_var.set(f"Host 已启动 - IP: {local_ip}, 端口: {port}, SHM ID: {self.shm.name}")
+            self.status_var.set(f"Host 已启动 - IP: {local_ip}, 端口: {port}, SHM ID: {shm_id}")
             messagebox.showinfo("成功", 
                               f"Host 启动成功！\n\n"
                               f"本机 IP: {local_ip}\n"
                               f"本地访问: 127.0.0.1\n"
                               f"端口: {port}\n"
-                              f"共享内存 ID: {self.shm.name}\n\n"
+                              f"共享内存 ID: {shm_id}\n"
+                              f"段大小: {segment_size(self.host.shm)} bytes\n"
+                              f"{self.host_restored_text()}\n"
                               f"Client 可通过 {local_ip}:{port} 或 127.0.0.1:{port} 连接")
             
         except Exception as e:
             messagebox.showerror("错误", f"启动 Host 失败: {e}")
             self.status_var.set(f"错误: {e}")
             
-    def host_listen(self):
-        """Host 监听客户端连接（后台线程）"""
+    def host_restored_text(self):
+        restored = self.host.restored
+        if restored is None:
+            return ""
+        return f"已从快照恢复: {restored.length} bytes\n"
+        
+    def host_snapshot(self):
+        """立即保存快照（不阻塞写入者，见 shm_snapshot）"""
+        if not self.host:
+            messagebox.showwarning("警告", "共享内存未创建")
+            return
         try:
-            while self.server_socket:
-                conn, addr = self.server_socket.accept()
-                # 为每个连接创建新线程处理
-                threading.Thread(target=self.handle_client_connection, 
-                               args=(conn, addr), daemon=True).start()
+            info = self.host.snapshot()
+            self.status_var.set(f"快照已保存: {info.path} ({info.length} bytes)")
         except Exception as e:
-            if self.server_socket:
-                self.root.after(0, lambda: self.status_var.set(f"监听错误: {e}"))
-    
-    def handle_client_connection(self, conn, addr):
-        """处理客户端连接"""
+            messagebox.showerror("错误", f"保存快照失败: {e}")
+            
+    def update_host_capacity(self):
+        """根据当前段的真实大小更新容量显示"""
+        self.host_capacity = self.host.capacity
+        self.host_content_label.config(text=f"共享内存中的内容 (最大 {self.host_capacity} bytes):")
+        self.on_host_text_change()
+        
+    def host_grow(self):
+        """在线扩容：分配更大的段并通过 redirect 发布，读者无需重启即可迁移"""
+        if not self.host:
+            messagebox.showwarning("警告", "共享内存未创建")
+            return
         try:
-            with conn:
-                # 检查共享内存是否已创建
-                if not self.shm:
-                    error_msg = "错误：共享内存未创建，无法发送元数据"
-                    self.root.after(0, lambda: self.status_var.set(error_msg))
-                    return
-                
-                # 发送元数据
-                meta = f"{self.shm.name} {BUF_SIZE} 0 {BUF_SIZE-1} 0 {DATA_OFFSET}\n"
-                try:
-                    conn.sendall(meta.encode("utf-8"))
-                    self.root.after(0, lambda: self.status_var.set(f"客户端已连接: {addr}"))
-                except Exception as e:
-                    self.root.after(0, lambda: self.status_var.set(f"发送元数据失败: {e}"))
-                    return
-                
-                # 持续监听客户端消息（支持远程读写协议）
-                while True:
-                    try:
-                        data = conn.recv(1024)
-                        if not data:
-                            break
-                        msg = data.decode("utf-8", errors="replace")
-                        
-                        # 处理READ命令
-                        if msg.strip() == "READ":
-                            # 读取共享内存内容并返回
-                            try:
-                                content = shm_read(self.shm, self.lock, DATA_OFFSET)
-                                response = f"OK {content}\n".encode("utf-8")
-                                conn.sendall(response)
-                            except Exception as e:
-                                error_response = f"ERROR {str(e)}\n".encode("utf-8")
-                                conn.sendall(error_response)
-                        
-                        # 处理WRITE命令: "WRITE <length>\n<content>\n"
-                        elif msg.startswith("WRITE "):
-                            try:
-                                # 解析第一行获取长度
-                                first_line_end = msg.find("\n")
-                                if first_line_end == -1:
-                                    # 还没收到完整的第一行，继续接收
-                                    continue
-                                
-                                length_str = msg[6:first_line_end].strip()  # 跳过"WRITE "
-                                length = int(length_str)
-                                
-                                # 计算还需要接收的字节数（内容 + 最后的\n）
-                                content_start = first_line_end + 1
-                                received_content_len = len(msg) - content_start
-                                remaining = length + 1 - received_content_len  # +1 for final \n
-                                
-                                # 如果内容不完整，继续接收
-                                if remaining > 0:
-                                    content_data = b""
-                                    while len(content_data) < remaining:
-                                        chunk = conn.recv(remaining - len(content_data))
-                                        if not chunk:
-                                            raise RuntimeError("连接中断")
-                                        content_data += chunk
-                                    msg += content_data.decode("utf-8", errors="replace")
-                                
-                                # 提取内容（跳过第一行和最后的\n）
-                                content = msg[content_start:content_start+length]
-                                
-                                # 写入共享内存
-                                shm_write(self.shm, content, self.lock)
-                                
-                                # 发送确认
-                                conn.sendall(b"OK\n")
-                                
-                                # 触发自动刷新
-                                self.root.after(0, self.host_auto_refresh)
-                                self.root.after(0, lambda: self.status_var.set(f"客户端已更新: {addr}"))
-                            except Exception as e:
-                                error_response = f"ERROR {str(e)}\n".encode("utf-8")
-                                conn.sendall(error_response)
-                        
-                        # 兼容旧协议
-                        elif msg.strip() == "DONE":
-                            # 客户端写入完成，触发自动刷新
-                            self.root.after(0, self.host_auto_refresh)
-                            self.root.after(0, lambda: self.status_var.set(f"客户端已更新: {addr}"))
-                        elif msg.strip() == SYNC_UPDATE_CMD:
-                            # 客户端请求同步更新
-                            self.root.after(0, self.host_auto_refresh)
-                    except socket.timeout:
-                        # 接收超时，继续等待
-                        continue
-                    except Exception as e:
-                        # 接收错误，断开连接
-                        break
+            try:
+                new_size = int(self.host_size_entry.get().strip())
+            except ValueError:
+                raise ValueError(f"段大小格式错误: '{self.host_size_entry.get()}'，请输入数字")
+            
+            new_shm = self.host.grow(new_size)
+            self.update_host_capacity()
+            
+            self.status_var.set(f"扩容成功: {segment_size(new_shm)} bytes (段名: {new_shm.name})")
         except Exception as e:
-            if self.server_socket:
-                self.root.after(0, lambda: self.status_var.set(f"连接错误: {e}"))
-                
+            messagebox.showerror("错误", f"扩容失败: {e}")
+            
     def stop_host(self):
         """停止 Host"""
         try:
-            if self.server_socket:
-                self.server_socket.close()
-                self.server_socket = None
-                
-            if self.shm:
-                try:
-                    self.shm.close()
-                finally:
-                    self.shm.unlink()
-                self.shm = None
-                self.lock = None
+            if self.host:
+                self.host.stop()
+                self.host = None
                 
             # 更新界面
             self.host_ip_var.set("未启动")
@@ -406,6 +382,8 @@ class SharedMemoryGUI:
             self.host_start_btn.config(state=tk.NORMAL)
             self.host_stop_btn.config(state=tk.DISABLED)
             self.host_write_btn.config(state=tk.DISABLED)
+            self.host_grow_btn.config(state=tk.DISABLED)
+            self.host_snapshot_btn.config(state=tk.DISABLED)
             self.host_lock_var.set("锁状态: 空闲")
             
             # 停止自动刷新
@@ -419,15 +397,15 @@ class SharedMemoryGUI:
             
     def host_write(self):
         """Host 写入共享内存（写入时上锁，完成后立即释放）"""
-        if not self.shm:
+        if not self.host:
             messagebox.showwarning("警告", "共享内存未创建")
             return
             
         text = self.host_text.get("1.0", tk.END).rstrip('\n')
         byte_count = len(text.encode("utf-8"))
         
-        if byte_count > MAX_DATA_SIZE:
-            messagebox.showerror("错误", f"文本太长: {byte_count} > {MAX_DATA_SIZE} bytes")
+        if byte_count > self.host_capacity:
+            messagebox.showerror("错误", f"文本太长: {byte_count} > {self.host_capacity} bytes")
             return
             
         try:
@@ -435,8 +413,8 @@ class SharedMemoryGUI:
             self.host_lock_var.set("锁状态: 写入中...")
             self.host_write_btn.config(state=tk.DISABLED)
             
-            # 写入数据（内部会获取和释放锁）
-            shm_write(self.shm, text, self.lock)
+            # 写入数据（内部会获取和释放锁，并通知已订阅的客户端）
+            self.host.write(text)
             
             # 写入完成，立即更新状态
             self.host_lock_var.set("锁状态: 空闲")
@@ -446,9 +424,6 @@ class SharedMemoryGUI:
             # 更新last_content，避免立即被覆盖
             self.last_content = text
             
-            # 通知已连接的客户端更新
-            self.notify_clients_update()
-            
             self.status_var.set("写入成功，已同步")
             messagebox.showinfo("成功", "写入成功！内容已同步")
             
@@ -465,10 +440,14 @@ class SharedMemoryGUI:
     
     def host_auto_refresh(self):
         """Host 自动刷新共享内存内容到输入框（即使正在编辑也会被覆盖）"""
-        if not self.shm or not self.lock:
+        if not self.host or not self.host.running:
             return
         try:
-            text = shm_read(self.shm, self.lock, DATA_OFFSET)
+            # 先比较版本号，内容未变化时不复制、不解码、不重绘
+            version, text = self.host.read_if_newer(self.host_version)
+            if text is None:
+                return
+            self.host_version = version
             if text != self.last_content:
                 # 直接覆盖输入框内容，即使正在编辑
                 current_pos = self.host_text.index(tk.INSERT)
@@ -482,17 +461,15 @@ class SharedMemoryGUI:
                 self.last_content = text
                 # 更新字符计数
                 byte_count = len(text.encode("utf-8"))
-                self.host_count_var.set(f"{byte_count} / {MAX_DATA_SIZE} bytes")
+                self.host_count_var.set(f"{byte_count} / {self.host_capacity} bytes")
         except Exception as e:
             pass  # 静默失败，避免频繁弹窗
     
-    def notify_clients_update(self):
-        """通知已连接的客户端进行更新（通过共享内存变化，客户端会检测到）"""
-        # 由于共享内存是共享的，客户端可以通过轮询检测到变化
-        # 这里可以发送TCP通知（如果需要实时性）
-        pass
-            
-            
+    def on_remote_update(self, addr):
+        """客户端写入后的回调（在服务线程中调用），转到界面线程刷新"""
+        self.root.after(0, self.host_auto_refresh)
+        self.root.after(0, lambda: self.status_var.set(f"客户端已更新: {addr}"))
+        
     def client_connect(self):
         """Client 连接 Host"""
         try:
@@ -509,148 +486,38 @@ class SharedMemoryGUI:
             except ValueError:
                 raise ValueError(f"端口号格式错误: '{port_str}'，请输入数字")
             
-            # 连接服务器
-            self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.client_socket.settimeout(10.0)
-            
             # 更新状态显示连接尝试
             self.status_var.set(f"正在连接到 {host_ip}:{port}...")
-            
-            try:
-                self.client_socket.connect((host_ip, port))
-            except socket.timeout:
-                self.client_socket.close()
-                self.client_socket = None
-                raise RuntimeError(
-                    f"连接超时！\n"
-                    f"无法连接到 {host_ip}:{port}\n\n"
-                    f"请检查：\n"
-                    f"1. Host IP 是否正确：{host_ip}\n"
-                    f"2. 端口号是否正确：{port}\n"
-                    f"3. Host 程序是否已启动\n"
-                    f"4. 防火墙是否阻止了连接"
-                )
-            except ConnectionRefusedError:
-                self.client_socket.close()
-                self.client_socket = None
-                raise RuntimeError(
-                    f"连接被拒绝！\n"
-                    f"无法连接到 {host_ip}:{port}\n\n"
-                    f"请确认：\n"
-                    f"1. Host 程序是否已启动\n"
-                    f"2. 端口号是否正确：{port}"
-                )
-            except OSError as e:
-                self.client_socket.close()
-                self.client_socket = None
-                raise RuntimeError(
-                    f"连接失败：{e}\n\n"
-                    f"请检查网络连接和 Host 状态。"
-                )
-            
-            # 接收元数据（带超时保护）
-            self.status_var.set(f"正在接收元数据...")
-            meta = b""
-            start_time = time.time()
-            try:
-                while not meta.endswith(b"\n"):
-                    # 检查是否超时（给一个合理的超时时间）
-                    if time.time() - start_time > 15.0:
-                        raise socket.timeout("接收元数据超时")
-                    chunk = self.client_socket.recv(1024)
-                    if not chunk:
-                        raise RuntimeError("服务器关闭连接，未收到完整元数据")
-                    meta += chunk
-            except socket.timeout:
-                self.client_socket.close()
-                self.client_socket = None
-                raise RuntimeError(
-                    f"接收数据超时！\n"
-                    f"服务器未及时响应。\n\n"
-                    f"可能的原因：\n"
-                    f"1. Host 程序未正确启动\n"
-                    f"2. 网络延迟过大\n"
-                    f"3. Host 程序崩溃或卡住\n"
-                    f"4. 防火墙阻止了数据传输\n\n"
-                    f"请检查 Host 程序状态，并重试。"
-                )
-                
-            parts = meta.decode("utf-8").strip().split()
-            if len(parts) == 6:
-                name, size, start, end, lock_offset, data_offset = parts
-                lock_offset = int(lock_offset)
-                data_offset = int(data_offset)
-            else:
-                raise ValueError("无效的元数据格式")
-            
-            # 验证用户输入的 shm_id 是否与服务器返回的一致
-            if name != shm_id:
-                self.client_socket.close()
-                self.client_socket = None
-                raise ValueError(
-                    f"共享内存 ID 不匹配！\n"
-                    f"您输入的: {shm_id}\n"
-                    f"服务器实际的: {name}\n"
-                    f"请使用正确的共享内存 ID 重新连接。"
-                )
-            
-            # 跨网络模式：不直接访问共享内存，而是通过TCP协议通信
-            # 保存连接信息，不创建本地共享内存对象
-            self.remote_shm_id = name
-            self.shm = None  # 跨网络时不使用本地共享内存
-            self.lock = None
-            
-            # 更新界面
             self.client_connect_btn.config(state=tk.DISABLED)
-            self.client_disconnect_btn.config(state=tk.NORMAL)
-            self.client_write_btn.config(state=tk.NORMAL)
-            self.client_lock_var.set("锁状态: 空闲（远程模式）")
             
-            # 通过TCP读取初始内容
-            try:
-                initial_text = self.client_read_remote()
-                self.client_text.delete("1.0", tk.END)
-                self.client_text.insert("1.0", initial_text)
-                self.last_content = initial_text
-                byte_count = len(initial_text.encode("utf-8"))
-                self.client_count_var.set(f"{byte_count} / {MAX_DATA_SIZE} bytes")
-            except Exception as e:
-                # 如果读取失败，显示空内容
-                self.client_text.delete("1.0", tk.END)
-                self.last_content = ""
+            # 连接、校验 shm_id 和协商协议都在后台 I/O 线程中进行，界面不会被阻塞；
+            # 二进制协议下订阅变更推送
+            client = SharedMemoryClient(
+                host_ip, port, shm_id,
+                on_notify=lambda version, content: self.root.after(
+                    0, lambda: self.client_on_notify(client, version, content)),
+                on_disconnect=lambda: self.root.after(
+                    0, lambda: self.client_on_disconnect(client)))
+            self.client = client
+            self.client_version = None
+            self.client_worker = ClientWorker(client, lambda fn: self.root.after(0, fn)).start()
+            self.client_worker.connect(
+                lambda result, error: self.client_on_connected(client, host_ip, port, error))
             
-            # 启动自动刷新
-            self.start_auto_refresh()
-            
-            self.status_var.set(f"已连接到 {host_ip}:{port} (远程模式)")
-            messagebox.showinfo("成功", 
-                              f"连接成功！\n\n"
-                              f"共享内存 ID: {name}\n"
-                              f"模式: 远程访问（通过TCP）\n\n"
-                              f"注意：跨网络访问时，数据通过TCP传输。")
-            
-        except socket.timeout as e:
-            if self.client_socket:
-                self.client_socket.close()
-                self.client_socket = None
-            error_msg = (
-                f"连接超时！\n\n"
-                f"无法连接到 {host_ip}:{port}\n\n"
-                f"请检查：\n"
-                f"1. Host IP 是否正确：{host_ip}\n"
-                f"2. 端口号是否正确：{port}\n"
-                f"3. Host 程序是否已启动并显示端口号\n"
-                f"4. 防火墙是否阻止了连接\n"
-                f"5. 如果使用本机 IP，请确认 IP 地址正确\n"
-                f"6. 可以尝试使用 127.0.0.1 代替本机 IP"
-            )
-            messagebox.showerror("连接超时", error_msg)
-            self.status_var.set(f"连接超时 - {host_ip}:{port}")
         except Exception as e:
-            if self.client_socket:
-                self.client_socket.close()
-                self.client_socket = None
-            error_msg = str(e)
+            messagebox.showerror("错误", str(e))
+            self.status_var.set(f"连接失败: {e}")
+            
+    def client_on_connected(self, client, host_ip, port, error):
+        """连接完成的回调（界面线程）"""
+        if self.client is not client:
+            return  # 连接期间已断开
+        if error is not None:
+            self.client_worker.close()
+            self.client = None
+            self.client_worker = None
+            self.client_connect_btn.config(state=tk.NORMAL)
+            error_msg = str(error)
             # 如果错误信息已经包含详细说明，直接显示
             if "\n" in error_msg or len(error_msg) > 50:
                 messagebox.showerror("连接失败", error_msg)
@@ -658,23 +525,58 @@ class SharedMemoryGUI:
                 messagebox.showerror("连接失败", 
                     f"连接失败: {error_msg}\n\n"
                     f"请检查：\n"
-                    f"1. Host IP: {self.client_ip_entry.get()}\n"
-                    f"2. 端口: {self.client_port_entry.get()}\n"
+                    f"1. Host IP: {host_ip}\n"
+                    f"2. 端口: {port}\n"
                     f"3. 共享内存 ID: {self.client_shm_id_entry.get()}\n"
                     f"4. Host 程序是否已启动")
             self.status_var.set(f"连接失败: {error_msg}")
+            return
+        
+        self.client_capacity = client.capacity
+        self.client_content_label.config(
+            text=f"共享内存中的内容 (最大 {self.client_capacity} bytes):")
+        
+        # 更新界面
+        self.client_disconnect_btn.config(state=tk.NORMAL)
+        self.client_write_btn.config(state=tk.NORMAL)
+        self.client_lock_var.set(f"锁状态: 空闲（{self.client_mode_desc(client)}）")
+        
+        # 读取初始内容（读取失败时显示空内容）
+        self.client_text.delete("1.0", tk.END)
+        self.last_content = ""
+        self.client_auto_refresh(force=True)
+        
+        # 启动自动刷新
+        self.start_auto_refresh()
+        
+        proto_desc = f"二进制协议 v{client.proto}" if client.proto else "文本协议"
+        if client.subscribed:
+            proto_desc += ", 推送更新"
+        self.status_var.set(
+            f"已连接到 {host_ip}:{port} ({self.client_mode_desc(client)}, {proto_desc})")
+        if client.is_local:
+            mode_text = ("模式: 本地访问（直接读写共享内存）\n\n"
+                         "注意：Host 在本机，读写不经过TCP。")
+        else:
+            mode_text = ("模式: 远程访问（通过TCP）\n\n"
+                         "注意：跨网络访问时，数据通过TCP传输。")
+        messagebox.showinfo("成功", 
+                          f"连接成功！\n\n"
+                          f"共享内存 ID: {client.name}\n"
+                          f"{mode_text}")
+
+    @staticmethod
+    def client_mode_desc(client):
+        return "本地模式" if client.is_local else "远程模式"
             
     def client_disconnect(self):
         """Client 断开连接"""
         try:
-            if self.client_socket:
-                self.client_socket.close()
-                self.client_socket = None
-                
-            if self.shm:
-                self.shm.close()
-                self.shm = None
-                self.lock = None
+            if self.client_worker:
+                # 由 I/O 线程关闭连接，不阻塞界面
+                self.client_worker.close()
+                self.client_worker = None
+                self.client = None
                 
             # 更新界面
             self.client_connect_btn.config(state=tk.NORMAL)
@@ -692,144 +594,119 @@ class SharedMemoryGUI:
             messagebox.showerror("错误", f"断开连接失败: {e}")
             
     def client_write(self):
-        """Client 写入共享内存（通过TCP远程写入）"""
-        if not self.client_socket:
+        """Client 写入共享内存（本地模式直接写入，远程模式通过TCP写入）"""
+        if not self.client:
             messagebox.showwarning("警告", "未连接")
             return
             
         text = self.client_text.get("1.0", tk.END).rstrip('\n')
         byte_count = len(text.encode("utf-8"))
         
-        if byte_count > MAX_DATA_SIZE:
-            messagebox.showerror("错误", f"文本太长: {byte_count} > {MAX_DATA_SIZE} bytes")
+        if byte_count > self.client_capacity:
+            messagebox.showerror("错误", f"文本太长: {byte_count} > {self.client_capacity} bytes")
             return
             
-        try:
-            # 写入时自动上锁（对用户透明），写入完成后立即释放
-            self.client_lock_var.set("锁状态: 写入中...")
-            self.client_write_btn.config(state=tk.DISABLED)
-            
-            # 通过TCP远程写入
-            self.client_write_remote(text)
-            
-            # 写入完成，立即更新状态
-            self.client_lock_var.set("锁状态: 空闲（远程模式）")
-            self.client_write_btn.config(state=tk.NORMAL)
-            self.is_locked = False
-            
-            # 更新last_content，避免立即被覆盖
-            self.last_content = text
-            
-            self.status_var.set("写入成功，已同步")
-            messagebox.showinfo("成功", "写入成功！内容已同步到host")
-            
-        except Exception as e:
-            self.client_lock_var.set("锁状态: 空闲（远程模式）")
-            self.client_write_btn.config(state=tk.NORMAL)
-            self.is_locked = False
-            messagebox.showerror("错误", f"写入失败: {e}")
-    
-    def client_read_remote(self):
-        """通过TCP从远程Host读取共享内存内容"""
-        if not self.client_socket:
-            raise RuntimeError("未连接到服务器")
+        # 写入时自动上锁（对用户透明），写入完成后立即释放；请求由 I/O 线程发送，不阻塞界面
+        self.client_lock_var.set("锁状态: 写入中...")
+        self.client_write_btn.config(state=tk.DISABLED)
+        self.client_write_seq += 1
+        client, notify_seq = self.client, self.client_notify_seq
+        
+        # 已知 Host 当前内容的版本时只发送改动的部分（按版本号条件写入）
+        patch = None
+        if self.client_version is not None:
+            patch = diff_patch(encode_text(self.last_content), encode_text(text))
+        if patch is None:
+            self.client_worker.write(
+                text, lambda result, error: self.client_on_written(
+                    client, text, None, error, notify_seq))
+            return
+        offset, data, truncate = patch
+        self.client_worker.patch(
+            offset, data, self.client_version, truncate,
+            lambda result, error: self.client_on_written(client, text, result, error, notify_seq))
+            
+    def client_on_written(self, client, text, version, error, notify_seq):
+        """远程写入完成的回调（界面线程），version 为 PATCH 返回的新版本号"""
+        if self.client is not client:
+            return
+        if isinstance(error, VersionConflictError):
+            # 内容已被其他写者修改，补丁的基准已失效，改为发送完整内容
+            self.client_version = None
+            notify_seq = self.client_notify_seq
+            self.client_worker.write(
+                text, lambda result, error: self.client_on_written(
+                    client, text, None, error, notify_seq))
+            return
+        if version is not None:
+            self.client_version = version
+        elif self.client_notify_seq == notify_seq:
+            # 完整写入后版本未知，等待下一次推送（推送可能先于写入的响应到达，此时保留推送的版本）
+            self.client_version = None
+        self.client_lock_var.set(f"锁状态: 空闲（{self.client_mode_desc(client)}）")
+        self.client_write_btn.config(state=tk.NORMAL)
+        self.is_locked = False
+        if error is not None:
+            messagebox.showerror("错误", f"写入失败: {error}")
+            return
         
-        try:
-            # 发送READ命令
-            self.client_socket.sendall(b"READ\n")
-            
-            # 接收响应（设置超时）
-            self.client_socket.settimeout(10.0)
-            response = b""
-            while not response.endswith(b"\n"):
-                chunk = self.client_socket.recv(4096)
-                if not chunk:
-                    raise RuntimeError("服务器关闭连接")
-                response += chunk
-            
-            # 解析响应: "OK <content>\n" 或 "ERROR <message>\n"
-            response_str = response.decode("utf-8", errors="replace").strip()
-            if response_str.startswith("OK "):
-                # 提取内容（跳过"OK "前缀）
-                content = response_str[3:]  # 跳过"OK "
-                return content
-            elif response_str.startswith("ERROR "):
-                error_msg = response_str[6:]  # 跳过"ERROR "
-                raise RuntimeError(f"服务器错误: {error_msg}")
-            else:
-                raise RuntimeError(f"无效的服务器响应: {response_str}")
-        except socket.timeout:
-            raise RuntimeError("读取超时：服务器未响应")
-        except Exception as e:
-            raise RuntimeError(f"读取失败: {e}")
-    
-    def client_write_remote(self, text):
-        """通过TCP向远程Host写入共享内存内容"""
-        if not self.client_socket:
-            raise RuntimeError("未连接到服务器")
+        # 更新last_content，避免立即被覆盖
+        self.last_content = text
         
-        try:
-            # 发送WRITE命令和内容
-            # 格式: "WRITE <length>\n<content>\n"
-            content_bytes = text.encode("utf-8")
-            length = len(content_bytes)
-            
-            # 发送命令: "WRITE <length>\n"
-            cmd = f"WRITE {length}\n".encode("utf-8")
-            self.client_socket.sendall(cmd)
-            
-            # 发送内容
-            self.client_socket.sendall(content_bytes)
-            
-            # 发送结束标记\n
-            self.client_socket.sendall(b"\n")
-            
-            # 接收响应（设置超时）
-            self.client_socket.settimeout(10.0)
-            response = b""
-            while not response.endswith(b"\n"):
-                chunk = self.client_socket.recv(1024)
-                if not chunk:
-                    raise RuntimeError("服务器关闭连接")
-                response += chunk
-            
-            # 解析响应: "OK\n" 或 "ERROR <message>\n"
-            response_str = response.decode("utf-8", errors="replace").strip()
-            if response_str == "OK":
-                return  # 成功
-            elif response_str.startswith("ERROR "):
-                error_msg = response_str[6:]
-                raise RuntimeError(f"服务器错误: {error_msg}")
-            else:
-                raise RuntimeError(f"无效的服务器响应: {response_str}")
-        except socket.timeout:
-            raise RuntimeError("写入超时：服务器未响应")
-        except Exception as e:
-            raise RuntimeError(f"写入失败: {e}")
+        self.status_var.set("写入成功，已同步")
+        messagebox.showinfo("成功", "写入成功！内容已同步到host")
     
-    def client_auto_refresh(self):
-        """Client 自动刷新共享内存内容到输入框（通过TCP远程读取）"""
-        if not self.client_socket:
+    def client_on_notify(self, client, version, content):
+        """收到 Host 推送的更新：直接用推送的内容刷新输入框"""
+        if self.client is not client:
             return
-        try:
-            # 通过TCP远程读取
-            text = self.client_read_remote()
-            if text != self.last_content:
+        if self.client_version is not None and version <= self.client_version:
+            return  # 并发的推送可能乱序到达，不用旧版本覆盖已显示的内容
+        self.client_version = version
+        self.client_notify_seq += 1
+        self.client_show_content(content.rstrip(b"\x00").decode("utf-8", errors="replace"))
+    
+    def client_on_disconnect(self, client):
+        """与 Host 的连接意外断开"""
+        if self.client is client:
+            self.status_var.set("与 Host 的连接已断开")
+    
+    def client_show_content(self, text):
+        """用共享内存内容覆盖输入框（即使正在编辑）"""
+        if text != self.last_content:
+            current_pos = self.client_text.index(tk.INSERT)
+            self.client_text.delete("1.0", tk.END)
+            self.client_text.insert("1.0", text)
+            # 尝试恢复光标位置（如果可能）
+            try:
+                self.client_text.mark_set(tk.INSERT, current_pos)
+            except:
+                pass
+            self.last_content = text
+            # 更新字符计数
+            byte_count = len(text.encode("utf-8"))
+            self.client_count_var.set(f"{byte_count} / {self.client_capacity} bytes")
+            
+    def client_auto_refresh(self, force=False):
+        """Client 自动刷新共享内存内容到输入框（在 I/O 线程中读取，不阻塞界面）"""
+        if not self.client_worker:
+            return
+        # 已订阅推送时由 Host 主动通知，不再轮询
+        if self.client.subscribed and not force:
+            return
+        client, write_seq = self.client, self.client_write_seq
+        
+        def on_read(result, error):
+            # 读取期间发起了新的写入时丢弃结果，避免旧内容覆盖刚写入的内容
+            if error is None and self.client is client and self.client_write_seq == write_seq:
+                version, text = result
+                if text is None:
+                    return  # Host 回复 NOT_MODIFIED，内容未变化
+                self.client_version = version
                 # 直接覆盖输入框内容，即使正在编辑
-                current_pos = self.client_text.index(tk.INSERT)
-                self.client_text.delete("1.0", tk.END)
-                self.client_text.insert("1.0", text)
-                # 尝试恢复光标位置（如果可能）
-                try:
-                    self.client_text.mark_set(tk.INSERT, current_pos)
-                except:
-                    pass
-                self.last_content = text
-                # 更新字符计数
-                byte_count = len(text.encode("utf-8"))
-                self.client_count_var.set(f"{byte_count} / {MAX_DATA_SIZE} bytes")
-        except Exception as e:
-            pass  # 静默失败，避免频繁弹窗
+                self.client_show_content(text)
+        # 只有版本号变化时 Host 才返回内容；上一次读取仍在途时不重复发送
+        self.client_worker.read_if_newer(None if force else self.client_version, on_read)
             
     
     def start_auto_refresh(self):
@@ -842,12 +719,10 @@ class SharedMemoryGUI:
             if not self.auto_refresh_running:
                 return
             try:
-                if self.mode.get() == "host" and self.shm:
+                if self.mode.get() == "host" and self.host:
                     self.host_auto_refresh()
-                elif self.mode.get() == "client":
-                    # 远程模式：检查socket连接；本地模式：检查共享内存
-                    if self.client_socket or self.shm:
-                        self.client_auto_refresh()
+                elif self.mode.get() == "client" and self.client:
+                    self.client_auto_refresh()
             except:
                 pass
             # 每500ms检查一次
@@ -0,0 +1,363 @@
+"""性能基准测试（只依赖标准库，无需图形界面）
+- lock: SharedMemoryLock（轮询）、SemaphoreLock（阻塞唤醒）与 ReadWriteLock（排他模式）
+        在无竞争和 1..N 个进程竞争下的获取延迟
+- rw:   shm_write_bytes / shm_read_bytes 在不同负载大小下（从几十字节到超过默认段容量）的延迟和吞吐
+- tcp:  Host 在独立进程中运行，多个 Client 进程并发通过 TCP 读写的往返延迟和吞吐
+
+用法:
+    python benchmark.py [--suite all|lock|rw|tcp] [--iterations N] [--processes P]
+                        [--sizes 64,1024,...] [--clients 1,4,16] [--json FILE|-]
+
+--json 输出机器可读的结果（"-" 表示标准输出），便于在版本之间比较是否有性能回退。
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import time
+import multiprocessing
+from multiprocessing import shared_memory
+
+from shared_memory_utils import (
+    LOCK_KIND_SPIN, LOCK_KIND_SEMAPHORE, LOCK_KIND_RWLOCK, DATA_OFFSET, MAX_DATA_SIZE,
+    MIN_SEGMENT_SIZE, atomic_backend, create_segment, open_lock, shm_read_bytes, shm_write_bytes
+)
+
+LOCK_KINDS = {
+    "spin": LOCK_KIND_SPIN,
+    "semaphore": LOCK_KIND_SEMAPHORE,
+    "rwlock": LOCK_KIND_RWLOCK,
+}
+
+
+def percentile(samples, p):
+    """计算百分位数（samples 需已排序）"""
+    if not samples:
+        return 0.0
+    k = min(len(samples) - 1, max(0, int(round(p / 100.0 * (len(samples) - 1)))))
+    return samples[k]
+
+
+def summarize(samples):
+    """汇总延迟样本（秒），返回以微秒为单位的统计结果"""
+    samples = sorted(samples)
+    return {
+        "count": len(samples),
+        "p50_us": percentile(samples, 50) * 1e6,
+        "p99_us": percentile(samples, 99) * 1e6,
+        "max_us": (samples[-1] if samples else 0.0) * 1e6,
+    }
+
+
+RW_SIZES = (64, 1024, MAX_DATA_SIZE, 64 * 1024, 1024 * 1024, 8 * 1024 * 1024)
+RW_MAX_BYTES = 256 * 1024 * 1024  # 每种负载大小最多复制的总字节数（限制大负载的迭代次数）
+RW_MIN_ITERATIONS = 20
+TCP_CLIENTS = (1, 4, 16)
+TCP_PAYLOAD = 256
+TCP_WRITE_RATIO = 0.1
+TCP_SEGMENT_SIZE = 64 * 1024
+
+
+def _contend_worker(shm_name, iterations, hold, start_event, result_queue):
+    """竞争测试的工作进程：反复获取/持有/释放锁，记录每次获取的等待时间"""
+    shm = shared_memory.SharedMemory(name=shm_name)
+    lock = open_lock(shm)
+    samples = []
+    try:
+        start_event.wait()
+        for _ in range(iterations):
+            t0 = time.perf_counter()
+            lock.acquire(timeout=30.0)
+            samples.append(time.perf_counter() - t0)
+            if hold:
+                end = time.perf_counter() + hold
+                while time.perf_counter() < end:
+                    pass
+            lock.release()
+    finally:
+        if hasattr(lock, "close"):
+            lock.close()
+        shm.close()
+    result_queue.put(samples)
+
+
+def bench_uncontended(lock_kind, iterations):
+    """无竞争：单进程反复获取/释放锁"""
+    shm = create_segment(lock_kind=lock_kind)
+    lock = open_lock(shm)
+    samples = []
+    try:
+        for _ in range(iterations):
+            t0 = time.perf_counter()
+            lock.acquire()
+            lock.release()
+            samples.append(time.perf_counter() - t0)
+    finally:
+        if hasattr(lock, "unlink"):
+            lock.unlink()
+            lock.close()
+        shm.close()
+        shm.unlink()
+    return summarize(samples)
+
+
+def bench_contended(lock_kind, processes, iterations, hold=0.0001):
+    """多进程竞争：processes 个进程同时争抢同一把锁"""
+    shm = create_segment(lock_kind=lock_kind)
+    lock = open_lock(shm)  # 保持信号量存活直到测试结束
+    start_event = multiprocessing.Event()
+    result_queue = multiprocessing.Queue()
+    workers = [
+        multiprocessing.Process(target=_contend_worker,
+                                args=(shm.name, iterations, hold, start_event, result_queue))
+        for _ in range(processes)
+    ]
+    try:
+        for w in workers:
+            w.start()
+        t0 = time.perf_counter()
+        start_event.set()
+        samples = []
+        for _ in workers:
+            samples.extend(result_queue.get())
+        elapsed = time.perf_counter() - t0
+        for w in workers:
+            w.join()
+    finally:
+        if hasattr(lock, "unlink"):
+            lock.unlink()
+            lock.close()
+        shm.close()
+        shm.unlink()
+    result = summarize(samples)
+    result["ops_per_sec"] = len(samples) / elapsed if elapsed > 0 else 0.0
+    return result
+
+
+def bench_locks(kinds, max_processes, iterations):
+    """锁测试：每种锁先测无竞争，再依次测 1..max_processes 个进程竞争（总获取次数相同）"""
+    results = []
+    for name, kind in kinds.items():
+        r = bench_uncontended(kind, iterations)
+        results.append(dict(lock=name, processes=0, **r))
+        for processes in range(1, max_processes + 1):
+            r = bench_contended(kind, processes, iterations // processes or 1)
+            results.append(dict(lock=name, processes=processes, **r))
+    return results
+
+
+def bench_read_write(sizes, iterations, lock_kind=LOCK_KIND_SPIN):
+    """读写测试：每种负载大小使用刚好容纳它的段，分别测量写入和 seqlock 读取"""
+    results = []
+    for size in sizes:
+        shm = create_segment(max(MIN_SEGMENT_SIZE, size + DATA_OFFSET), lock_kind=lock_kind)
+        lock = open_lock(shm)
+        payload = os.urandom(size)
+        n = max(RW_MIN_ITERATIONS, min(iterations, RW_MAX_BYTES // max(size, 1)))
+        try:
+            for op in ("write", "read"):
+                samples = []
+                t0 = time.perf_counter()
+                for _ in range(n):
+                    t = time.perf_counter()
+                    if op == "write":
+                        shm_write_bytes(shm, payload, lock)
+                    else:
+                        shm_read_bytes(shm, lock)
+                    samples.append(time.perf_counter() - t)
+                elapsed = time.perf_counter() - t0
+                r = summarize(samples)
+                r["ops_per_sec"] = n / elapsed if elapsed > 0 else 0.0
+                r["mb_per_sec"] = r["ops_per_sec"] * size / (1024 * 1024)
+                results.append(dict(op=op, size=size, **r))
+        finally:
+            if hasattr(lock, "unlink"):
+                lock.unlink()
+                lock.close()
+            shm.close()
+            shm.unlink()
+    return results
+
+
+def _host_process(size, lock_kind, address_queue, stop_event):
+    """TCP 测试的 Host 进程：启动服务并回传端口，直到 stop_event 置位"""
+    from shm_server import SharedMemoryHost
+    with SharedMemoryHost(size, lock_kind=lock_kind, host="127.0.0.1", port=0) as host:
+        address_queue.put(host.address[1])
+        stop_event.wait()
+
+
+def _tcp_worker(port, local, ops, payload, write_ratio, seed, ready_queue, start_event,
+                result_queue):
+    """TCP 测试的 Client 进程：独占一个连接，按比例混合读写，分别记录读写的往返延迟"""
+    from shm_client import SharedMemoryClient
+    rng = random.Random(seed)
+    reads, writes, error = [], [], None
+    try:
+        with SharedMemoryClient("127.0.0.1", port, local=local) as client:
+            ready_queue.put(True)
+            start_event.wait()
+            for _ in range(ops):
+                t0 = time.perf_counter()
+                if rng.random() < write_ratio:
+                    client.write_bytes(payload)
+                    writes.append(time.perf_counter() - t0)
+                else:
+                    client.read_bytes()
+                    reads.append(time.perf_counter() - t0)
+    except Exception as e:
+        ready_queue.put(False)
+        error = str(e)
+    result_queue.put((reads, writes, error))
+
+
+def bench_tcp(client_counts, ops, payload_size=TCP_PAYLOAD, write_ratio=TCP_WRITE_RATIO,
+              lock_kind=LOCK_KIND_SPIN, local=False):
+    """TCP 端到端测试：Host 和每个 Client 各在独立进程中运行（不共享 GIL），所有 Client 连接就绪后
+    同时开始，每个 Client 执行 ops 次请求
+
+    local=True 时 Client 走本机直接访问（对比 TCP 与共享内存的差距）。
+    """
+    stop_event = multiprocessing.Event()
+    address_queue = multiprocessing.Queue()
+    host = multiprocessing.Process(target=_host_process,
+                                   args=(TCP_SEGMENT_SIZE, lock_kind, address_queue, stop_event))
+    host.start()
+    results = []
+    try:
+        port = address_queue.get(timeout=30.0)
+        payload = b"x" * payload_size
+        for clients in client_counts:
+            ready_queue = multiprocessing.Queue()
+            result_queue = multiprocessing.Queue()
+            start_event = multiprocessing.Event()
+            workers = [
+                multiprocessing.Process(target=_tcp_worker,
+                                        args=(port, local, ops, payload, write_ratio, i,
+                                              ready_queue, start_event, result_queue))
+                for i in range(clients)
+            ]
+            for w in workers:
+                w.start()
+            for _ in workers:
+                ready_queue.get(timeout=60.0)
+            t0 = time.perf_counter()
+            start_event.set()
+            reads, writes, errors = [], [], []
+            for _ in workers:
+                r, w, error = result_queue.get()
+                reads.extend(r)
+                writes.extend(w)
+                if error:
+                    errors.append(error)
+            elapsed = time.perf_counter() - t0
+            for w in workers:
+                w.join()
+            total = len(reads) + len(writes)
+            transport = "local" if local else "tcp"
+            for op, samples in (("read", reads), ("write", writes), ("all", reads + writes)):
+                r = summarize(samples)
+                if op == "all":
+                    r["ops_per_sec"] = total / elapsed if elapsed > 0 else 0.0
+                    r["errors"] = errors
+                results.append(dict(transport=transport, op=op, clients=clients,
+                                    size=payload_size, **r))
+    finally:
+        stop_event.set()
+        host.join(timeout=10.0)
+    return results
+
+
+def environment():
+    """记录测试环境，便于比较不同机器/版本的结果"""
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "atomic_backend": type(atomic_backend()).__name__,
+    }
+
+
+def _print_table(report):
+    """以表格输出结果（人工查看）"""
+    header = f"{'p50(us)':>12}{'p99(us)':>12}{'max(us)':>12}{'ops/s':>12}"
+    if "lock" in report:
+        print(f"{'锁类型':<12}{'场景':<16}{header}")
+        for r in report["lock"]:
+            scene = "无竞争" if r["processes"] == 0 else f"{r['processes']} 进程竞争"
+            ops = f"{r['ops_per_sec']:>12.0f}" if "ops_per_sec" in r else f"{'':>12}"
+            print(f"{r['lock']:<12}{scene:<16}{r['p50_us']:>12.1f}{r['p99_us']:>12.1f}"
+                  f"{r['max_us']:>12.1f}{ops}")
+    if "rw" in report:
+        print(f"\n{'操作':<8}{'大小(B)':>12}{header}{'MB/s':>12}")
+        for r in report["rw"]:
+            print(f"{r['op']:<8}{r['size']:>12}{r['p50_us']:>12.1f}{r['p99_us']:>12.1f}"
+                  f"{r['max_us']:>12.1f}{r['ops_per_sec']:>12.0f}{r['mb_per_sec']:>12.1f}")
+    if "tcp" in report:
+        print(f"\n{'方式':<8}{'客户端':<8}{'操作':<8}{header}")
+        for r in report["tcp"]:
+            ops = f"{r['ops_per_sec']:>12.0f}" if "ops_per_sec" in r else f"{'':>12}"
+            print(f"{r['transport']:<8}{r['clients']:<8}{r['op']:<8}{r['p50_us']:>12.1f}"
+                  f"{r['p99_us']:>12.1f}{r['max_us']:>12.1f}{ops}")
+            for error in r.get("errors", ()):
+                print(f"错误: {error}", file=sys.stderr)
+
+
+def _int_list(text):
+    try:
+        return [int(x) for x in text.split(",") if x.strip()]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"应为逗号分隔的整数: '{text}'")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="共享内存性能基准测试")
+    parser.add_argument("--suite", choices=["all", "lock", "rw", "tcp"], default="all")
+    parser.add_argument("--iterations", type=int, default=2000,
+                        help="锁测试的总获取次数 / 读写测试每种大小的次数")
+    parser.add_argument("--processes", type=int, default=4, help="锁测试的最大竞争进程数")
+    parser.add_argument("--lock", choices=["all"] + list(LOCK_KINDS), default="all")
+    parser.add_argument("--sizes", type=_int_list, default=list(RW_SIZES),
+                        help="读写测试的负载大小（bytes，逗号分隔）")
+    parser.add_argument("--clients", type=_int_list, default=list(TCP_CLIENTS),
+                        help="TCP 测试的并发 Client 数（逗号分隔，每个值测一轮）")
+    parser.add_argument("--ops", type=int, default=2000, help="TCP 测试每个 Client 的请求数")
+    parser.add_argument("--size", type=int, default=TCP_PAYLOAD, help="TCP 测试写入的负载大小")
+    parser.add_argument("--write-ratio", type=float, default=TCP_WRITE_RATIO,
+                        help="TCP 测试的写请求比例")
+    parser.add_argument("--local", action="store_true",
+                        help="TCP 测试另外测一轮本机直接访问作为对比")
+    parser.add_argument("--json", default=None, metavar="FILE",
+                        help="输出 JSON 结果到文件（- 表示标准输出，此时不输出表格）")
+    args = parser.parse_args(argv)
+
+    kinds = LOCK_KINDS if args.lock == "all" else {args.lock: LOCK_KINDS[args.lock]}
+    lock_kind = LOCK_KINDS["spin" if args.lock == "all" else args.lock]
+    suites = ("lock", "rw", "tcp") if args.suite == "all" else (args.suite,)
+    report = {"environment": environment()}
+    if "lock" in suites:
+        report["lock"] = bench_locks(kinds, args.processes, args.iterations)
+    if "rw" in suites:
+        report["rw"] = bench_read_write(args.sizes, args.iterations, lock_kind)
+    if "tcp" in suites:
+        report["tcp"] = bench_tcp(args.clients, args.ops, args.size, args.write_ratio, lock_kind)
+        if args.local:
+            report["tcp"] += bench_tcp(args.clients, args.ops, args.size, args.write_ratio,
+                                       lock_kind, local=True)
+
+    if args.json == "-":
+        json.dump(report, sys.stdout, indent=2, ensure_ascii=False)
+        print()
+        return
+    _print_table(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,95 @@
 """共享内存工具模块
 包含共享内存相关的常量、类和工具函数
 """
+import os
+import sys
 import socket
 import struct
 import time
 import threading
+import ctypes
+import ctypes.util
+import uuid
 from multiprocessing import shared_memory
 
+from shm_metrics import METRICS
+
 # 常量定义
-BUF_SIZE = 4096
-LOCK_SIZE = 1
+BUF_SIZE = 4096  # 默认段大小（可在创建时指定其他大小）
+MIN_SEGMENT_SIZE = 4096
+
+# 段头（header）布局
+HEADER_MAGIC = b"SHMM"
+MAGIC_OFFSET = 0          # 4 字节魔数
+FLAGS_OFFSET = 4          # uint32 标志位
+SIZE_OFFSET = 8           # uint64 段的真实大小
+GEN_OFFSET = 16           # uint32 代号（generation），每次迁移 +1
+REDIRECT_OFFSET = 20      # 迁移后新段的名称（UTF-8，空字节填充）
+REDIRECT_SIZE = 32
+LOCK_KIND_OFFSET = 52     # 1 字节，段使用的锁类型
+LAYOUT_OFFSET = 53        # 1 字节，段的数据布局
+SEQ_OFFSET = 56           # uint64 序列计数器（seqlock），8 字节对齐
+HEADER_SIZE = 64          # 其余为保留字段
+FLAGS_FMT = "<I"
+SIZE_FMT = "<Q"
+GEN_FMT = "<I"
+FLAG_MOVED = 0x1          # 段已迁移到 redirect 指向的新段
+FLAG_READ_ONLY = 0x2      # 段由副本 Host 维护（内容从上游复制），其他进程不应直接写入
+LOCK_KIND_SPIN = 0        # 轮询锁标志字节（SharedMemoryLock）
+LOCK_KIND_SEMAPHORE = 1   # 命名信号量阻塞锁（SemaphoreLock）
+LOCK_KIND_RWLOCK = 2      # 读写锁（ReadWriteLock）
+LAYOUT_SINGLE = 0         # 单值布局：一把锁 + 一个长度字段 + 一段数据
+LAYOUT_SLOTS = 1          # 槽位布局：槽位目录 + 每个槽位独立的锁/长度/数据（见 shm_slots）
+LAYOUT_HASHMAP = 2        # 哈希表布局：开放寻址的分段哈希表（见 shm_hashmap）
+LAYOUT_RING = 3           # 环形缓冲区布局：单生产者/多消费者消息队列（见 shm_ring）
+
+# 数据区布局（紧跟在段头之后）
+LOCK_OFFSET = HEADER_SIZE
+LOCK_SIZE = 4             # 4 字节对齐的锁字，支持原子 CAS（首字节兼容旧的锁标志）
 LEN_SIZE = 4
-DATA_OFFSET = LOCK_SIZE + LEN_SIZE
+LEN_OFFSET = LOCK_OFFSET + LOCK_SIZE
+DATA_OFFSET = LEN_OFFSET + LEN_SIZE
 LEN_FMT = "<I"
 LOCK_FREE = 0
 LOCK_HELD = 1
-MAX_DATA_SIZE = BUF_SIZE - DATA_OFFSET  # 4091 bytes
+# 读写锁状态字：bit0-15 读者数，bit16-30 等待中的写者数，bit31 写者持有
+RW_READER_MASK = 0xFFFF
+RW_WAITER_ONE = 1 << 16
+RW_WAITER_MASK = 0x7FFF << 16
+RW_WRITER_BIT = 1 << 31
+MAX_DATA_SIZE = BUF_SIZE - DATA_OFFSET  # 默认段大小下的最大数据长度
 SYNC_UPDATE_CMD = "SYNC_UPDATE"  # 同步更新命令
+SEQ_FMT = "<Q"
+READ_MODE_SEQLOCK = "seqlock"  # 乐观读取，不获取写锁
+READ_MODE_LOCKED = "locked"    # 获取写锁后读取（兼容模式）
+SEQLOCK_READ_RETRIES = 100     # 乐观读取的最大重试次数，超过后退化为加锁读取
+WRITE_FILL_DELTA = "delta"     # 只清空旧数据比新数据多出的部分（默认）
+WRITE_FILL_FULL = "full"       # 清空长度之后的整个数据区（旧行为）
+WRITE_FILL_NONE = "none"       # 只写长度和数据，不清理尾部
+_ZERO_BLOCK = bytes(64 * 1024)  # 清零用的共享零块，避免每次写入分配临时对象
+_DIFF_BLOCK = 4096  # diff_patch 按块比较的块大小
+HOST_TOKEN_FILES = ("/proc/sys/kernel/random/boot_id", "/etc/machine-id")
+
+
+class VersionConflictError(RuntimeError):
+    """条件写入时段内容的版本号与期望的不一致（内容已被其他写者修改）"""
+    def __init__(self, expected: int, actual: int):
+        super().__init__(f"版本冲突: 期望 {expected}，实际 {actual}")
+        self.expected = expected
+        self.actual = actual
+
+
+class SegmentMovedError(RuntimeError):
+    """段已迁移（扩容），需要重新挂载到 new_name 指向的新段"""
+    def __init__(self, new_name: str):
+        super().__init__(f"共享内存已迁移到新段: {new_name}")
+        self.new_name = new_name
+
+
+class ReadOnlyError(RuntimeError):
+    """段由只读副本维护，不接受写入"""
+    def __init__(self):
+        super().__init__("副本 Host 只读，请写入上游 Host")
 
 
 def get_local_ip():
@@ -45,27 +118,296 @@ def get_local_ip():
             return "127.0.0.1"
 
 
+_host_token = None
+_created_segments = set()  # 本进程创建的段名（untrack_segment 不处理这些段）
+
+
+def host_token():
+    """本机标识：同一台机器（同一次启动）上的进程得到相同的值，用于判断 Host 是否在本机
+
+    优先使用内核的 boot_id，其次 machine-id，都不可用时退回主机名 + MAC 地址。
+    """
+    global _host_token
+    if _host_token is None:
+        token = None
+        for path in HOST_TOKEN_FILES:
+            try:
+                with open(path, "r", encoding="ascii") as f:
+                    token = f.read().strip() or None
+            except (OSError, ValueError):
+                continue
+            if token:
+                break
+        _host_token = token or f"{socket.gethostname()}-{uuid.getnode():x}"
+    return _host_token
+
+
+# 原子操作内存序（与 GCC __ATOMIC_* 常量一致）
+_ATOMIC_SEQ_CST = 5
+_ATOMIC_FMT = {4: "<I", 8: "<Q"}
+_ATOMIC_CTYPE = {4: ctypes.c_uint32, 8: ctypes.c_uint64}
+
+
+class _LibAtomicBackend:
+    """通过 ctypes 调用 libatomic 的 __atomic_* 函数，在段内地址上执行真正的原子指令"""
+    def __init__(self):
+        path = ctypes.util.find_library("atomic") or "libatomic.so.1"
+        self.lib = ctypes.CDLL(path)
+        self.funcs = {}
+        for width, ctype in _ATOMIC_CTYPE.items():
+            cas = getattr(self.lib, f"__atomic_compare_exchange_{width}")
+            cas.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctype, ctypes.c_int, ctypes.c_int]
+            cas.restype = ctypes.c_bool
+            add = getattr(self.lib, f"__atomic_fetch_add_{width}")
+            add.argtypes = [ctypes.c_void_p, ctype, ctypes.c_int]
+            add.restype = ctype
+            load = getattr(self.lib, f"__atomic_load_{width}")
+            load.argtypes = [ctypes.c_void_p, ctypes.c_int]
+            load.restype = ctype
+            store = getattr(self.lib, f"__atomic_store_{width}")
+            store.argtypes = [ctypes.c_void_p, ctype, ctypes.c_int]
+            store.restype = None
+            self.funcs[width] = (cas, add, load, store)
+
+    def compare_exchange(self, atomic, expected, desired):
+        cas = self.funcs[atomic.width][0]
+        exp = _ATOMIC_CTYPE[atomic.width](expected)
+        return cas(atomic.address, ctypes.byref(exp), desired, _ATOMIC_SEQ_CST, _ATOMIC_SEQ_CST)
+
+    def fetch_add(self, atomic, delta):
+        mask = (1 << (8 * atomic.width)) - 1
+        return self.funcs[atomic.width][1](atomic.address, delta & mask, _ATOMIC_SEQ_CST)
+
+    def load(self, atomic):
+        return self.funcs[atomic.width][2](atomic.address, _ATOMIC_SEQ_CST)
+
+    def store(self, atomic, value):
+        self.funcs[atomic.width][3](atomic.address, value, _ATOMIC_SEQ_CST)
+
+
+class _FcntlBackend:
+    """在共享内存文件上用 fcntl 字节范围锁模拟原子操作（POSIX，无 libatomic 时使用）
+
+    fcntl 锁归属于进程，因此同一进程内的线程还需要额外的线程锁串行化。
+    """
+    def __init__(self):
+        import fcntl
+        self.fcntl = fcntl
+        self.local_lock = threading.Lock()
+
+    def _locked(self, atomic, fn):
+        fd = getattr(atomic.shm, "_fd", -1)
+        if fd < 0:
+            raise OSError("共享内存没有可用的文件描述符，无法使用 fcntl 锁")
+        with self.local_lock:
+            self.fcntl.lockf(fd, self.fcntl.LOCK_EX, atomic.width, atomic.offset)
+            try:
+                return fn()
+            finally:
+                self.fcntl.lockf(fd, self.fcntl.LOCK_UN, atomic.width, atomic.offset)
+
+    def compare_exchange(self, atomic, expected, desired):
+        def op():
+            if atomic.raw_load() != expected:
+                return False
+            atomic.raw_store(desired)
+            return True
+        return self._locked(atomic, op)
+
+    def fetch_add(self, atomic, delta):
+        def op():
+            old = atomic.raw_load()
+            atomic.raw_store((old + delta) & ((1 << (8 * atomic.width)) - 1))
+            return old
+        return self._locked(atomic, op)
+
+    def load(self, atomic):
+        return self._locked(atomic, atomic.raw_load)
+
+    def store(self, atomic, value):
+        return self._locked(atomic, lambda: atomic.raw_store(value))
+
+
+_atomic_backend = None
+_atomic_backend_checked = False
+
+
+def atomic_backend():
+    """返回当前平台可用的原子操作后端（libatomic > fcntl），都不可用时返回 None"""
+    global _atomic_backend, _atomic_backend_checked
+    if not _atomic_backend_checked:
+        _atomic_backend_checked = True
+        for backend_cls in (_LibAtomicBackend, _FcntlBackend):
+            try:
+                _atomic_backend = backend_cls()
+                break
+            except (OSError, AttributeError, ImportError):
+                continue
+    return _atomic_backend
+
+
+def _buffer_address(shm: shared_memory.SharedMemory):
+    """获取段映射在本进程中的起始地址（不保留对缓冲区的导出引用，避免阻塞 close）"""
+    anchor = ctypes.c_char.from_buffer(shm.buf)
+    address = ctypes.addressof(anchor)
+    del anchor
+    return address
+
+
+class SharedMemoryAtomic:
+    """段内一个对齐的 4/8 字节无符号整数，提供跨进程原子的 load/store/CAS/fetch_add
+
+    地址在构造时解析；段 close 之后不能再使用该对象。
+    """
+    def __init__(self, shm: shared_memory.SharedMemory, offset: int, width: int = 4):
+        if width not in _ATOMIC_CTYPE:
+            raise ValueError(f"不支持的原子整数宽度: {width}")
+        if offset % width:
+            raise ValueError(f"原子整数偏移必须按 {width} 字节对齐: {offset}")
+        self.backend = atomic_backend()
+        if self.backend is None:
+            raise OSError("当前平台没有可用的原子操作后端（需要 libatomic 或 fcntl）")
+        self.shm = shm
+        self.offset = offset
+        self.width = width
+        self.fmt = _ATOMIC_FMT[width]
+        self.address = _buffer_address(shm) + offset
+
+    def raw_load(self):
+        """非原子读取（仅供后端在自身互斥保护下使用）"""
+        return struct.unpack(self.fmt, bytes(self.shm.buf[self.offset:self.offset+self.width]))[0]
+
+    def raw_store(self, value):
+        """非原子写入（仅供后端在自身互斥保护下使用）"""
+        self.shm.buf[self.offset:self.offset+self.width] = struct.pack(self.fmt, value)
+
+    def load(self):
+        return self.backend.load(self)
+
+    def store(self, value):
+        self.backend.store(self, value)
+
+    def compare_exchange(self, expected, desired):
+        """当前值等于 expected 时原子地替换为 desired，返回是否成功"""
+        return self.backend.compare_exchange(self, expected, desired)
+
+    def fetch_add(self, delta):
+        """原子地加上 delta（可为负数），返回旧值"""
+        return self.backend.fetch_add(self, delta)
+
+
+class SeqLock:
+    """段头中的序列计数器（seqlock）
+
+    写者在持有写锁时，写入前后各把计数器 +1（写入期间为奇数）；
+    读者记录起始值，复制数据后再次检查计数器，未变化则说明读到的是一致的快照。
+    计数器的一半即为段内容的版本号。
+    """
+    def __init__(self, shm: shared_memory.SharedMemory, offset: int = SEQ_OFFSET):
+        self.shm = shm
+        self.offset = offset
+        self.counter = None
+        if atomic_backend() is not None:
+            self.counter = SharedMemoryAtomic(shm, offset, 8)
+
+    def load(self):
+        """读取计数器当前值"""
+        if self.counter is not None:
+            return self.counter.load()
+        return struct.unpack(SEQ_FMT, bytes(self.shm.buf[self.offset:self.offset+8]))[0]
+
+    def _add(self, delta):
+        if self.counter is not None:
+            self.counter.fetch_add(delta)
+        else:
+            value = self.load() + delta
+            self.shm.buf[self.offset:self.offset+8] = struct.pack(SEQ_FMT, value)
+
+    def write_begin(self):
+        """写入开始（调用方必须持有写锁），计数器变为奇数"""
+        self._add(1)
+
+    def write_end(self):
+        """写入结束，计数器变回偶数"""
+        self._add(1)
+
+    def read_begin(self):
+        """开始一次乐观读取，返回起始计数器；有写者正在写入时返回 None"""
+        seq = self.load()
+        if seq & 1:
+            return None
+        return seq
+
+    def read_validate(self, start):
+        """检查读取期间是否有写入发生"""
+        if self.counter is not None:
+            # fetch_add(0) 是完整内存屏障，保证数据复制先于这次检查完成
+            return self.counter.fetch_add(0) == start
+        return self.load() == start
+
+    def version(self):
+        """段内容的版本号（完成的写入次数）"""
+        return self.load() >> 1
+
+
 class SharedMemoryLock:
-    """基于共享内存的简单锁机制（整块锁）"""
-    def __init__(self, shm: shared_memory.SharedMemory, lock_offset: int = 0):
+    """基于共享内存的简单锁机制（整块锁）
+
+    平台支持原子操作时，锁字通过跨进程原子 CAS 获取，不再需要进程内的线程锁；
+    否则退化为“检查后写入”加进程内线程锁（只能保证同一进程内的互斥）。
+    """
+    metrics_kind = "spin"
+
+    def __init__(self, shm: shared_memory.SharedMemory, lock_offset: int = LOCK_OFFSET,
+                 seq_offset: int = SEQ_OFFSET):
         self.shm = shm
         self.lock_offset = lock_offset
         self.local_lock = threading.Lock()
+        self.seqlock = SeqLock(shm, seq_offset) if has_header(shm) else None
+        self.acquired_at = None  # 启用指标时记录获取时间，用于统计持有时间
+        self.word = None
+        if lock_offset % 4 == 0 and atomic_backend() is not None:
+            self.word = SharedMemoryAtomic(shm, lock_offset)
+        
+    def try_acquire(self):
+        """尝试获取一次锁，不等待"""
+        if self.word is not None:
+            return self.word.compare_exchange(LOCK_FREE, LOCK_HELD)
+        with self.local_lock:
+            if self.shm.buf[self.lock_offset] == LOCK_FREE:
+                self.shm.buf[self.lock_offset] = LOCK_HELD
+                if self.shm.buf[self.lock_offset] == LOCK_HELD:
+                    return True
+        return False
         
     def acquire(self, timeout=5.0):
-        """获取锁，带超时机制"""
-        start_time = time.time()
-        while time.time() - start_time < timeout:
-            with self.local_lock:
-                if self.shm.buf[self.lock_offset] == LOCK_FREE:
-                    self.shm.buf[self.lock_offset] = LOCK_HELD
-                    if self.shm.buf[self.lock_offset] == LOCK_HELD:
-                        return True
-            time.sleep(0.01)
+        """获取锁，带超时机制（timeout=0 时只尝试一次，不等待）"""
+        start_time = time.perf_counter()
+        delay = 0.00005
+        while True:
+            if self.try_acquire():
+                if METRICS.enabled:
+                    self.acquired_at = METRICS.record_acquire(self.metrics_kind, "exclusive",
+                                                              start_time)
+                return True
+            if time.perf_counter() - start_time >= timeout:
+                break
+            # 指数退避：短暂竞争时很快重试，长时间竞争时不空转 CPU
+            time.sleep(delay)
+            delay = min(delay * 2, 0.01)
+        if METRICS.enabled:
+            METRICS.record_timeout(self.metrics_kind, "exclusive", timeout)
         raise TimeoutError(f"获取锁超时（{timeout}秒）")
     
     def release(self):
         """释放锁"""
+        if METRICS.enabled:
+            METRICS.record_release(self.metrics_kind, self.acquired_at)
+        self.acquired_at = None
+        if self.word is not None:
+            if not self.word.compare_exchange(LOCK_HELD, LOCK_FREE):
+                raise RuntimeError("尝试释放未持有的锁")
+            return
         with self.local_lock:
             if self.shm.buf[self.lock_offset] == LOCK_HELD:
                 self.shm.buf[self.lock_offset] = LOCK_FREE
@@ -77,61 +419,899 @@ class SharedMemoryLock:
         return self.shm.buf[self.lock_offset] == LOCK_HELD
 
 
+class ReadWriteLock:
+    """存放在锁字中的共享/排他读写锁（需要原子操作支持）
+
+    任意数量的读者可以同时持有共享锁；写者排他。写者开始等待时会登记到等待计数，
+    此后新的读者不能进入，从而保证写者优先、不会被持续的读者饿死。
+    acquire/release/is_locked 与 SharedMemoryLock 相同（排他锁），
+    acquire_shared/release_shared 为共享锁，超时语义与 acquire(timeout=5.0) 一致。
+    """
+    metrics_kind = "rwlock"
+
+    def __init__(self, shm: shared_memory.SharedMemory, lock_offset: int = LOCK_OFFSET,
+                 seq_offset: int = SEQ_OFFSET):
+        if atomic_backend() is None:
+            raise OSError("读写锁需要原子操作支持（libatomic 或 fcntl）")
+        self.shm = shm
+        self.lock_offset = lock_offset
+        self.seqlock = SeqLock(shm, seq_offset) if has_header(shm) else None
+        self.acquired_at = None
+        self.word = SharedMemoryAtomic(shm, lock_offset)
+
+    def _wait(self, try_once, timeout, mode):
+        start_time = time.perf_counter()
+        delay = 0.00005
+        while True:
+            if try_once():
+                if METRICS.enabled:
+                    acquired_at = METRICS.record_acquire(self.metrics_kind, mode, start_time)
+                    if mode == "exclusive":
+                        self.acquired_at = acquired_at
+                return True
+            if time.perf_counter() - start_time >= timeout:
+                if METRICS.enabled:
+                    METRICS.record_timeout(self.metrics_kind, mode, timeout)
+                return False
+            time.sleep(delay)
+            delay = min(delay * 2, 0.01)
+
+    def acquire(self, timeout=5.0):
+        """获取排他（写）锁，带超时机制"""
+        # 登记为等待中的写者，阻止新的读者进入
+        self.word.fetch_add(RW_WAITER_ONE)
+
+        def try_once():
+            state = self.word.load()
+            if state & (RW_WRITER_BIT | RW_READER_MASK):
+                return False
+            # 取得写锁的同时撤销等待登记
+            return self.word.compare_exchange(state, (state - RW_WAITER_ONE) | RW_WRITER_BIT)
+
+        if not self._wait(try_once, timeout, "exclusive"):
+            self.word.fetch_add(-RW_WAITER_ONE)
+            raise TimeoutError(f"获取锁超时（{timeout}秒）")
+        return True
+
+    def release(self):
+        """释放排他（写）锁"""
+        if METRICS.enabled:
+            METRICS.record_release(self.metrics_kind, self.acquired_at)
+        self.acquired_at = None
+        while True:
+            state = self.word.load()
+            if not state & RW_WRITER_BIT:
+                raise RuntimeError("尝试释放未持有的锁")
+            if self.word.compare_exchange(state, state & ~RW_WRITER_BIT):
+                return
+
+    def acquire_shared(self, timeout=5.0):
+        """获取共享（读）锁，带超时机制；有写者持有或等待时不能进入"""
+        def try_once():
+            state = self.word.load()
+            if state & (RW_WRITER_BIT | RW_WAITER_MASK):
+                return False
+            if state & RW_READER_MASK == RW_READER_MASK:
+                return False
+            return self.word.compare_exchange(state, state + 1)
+
+        if not self._wait(try_once, timeout, "shared"):
+            raise TimeoutError(f"获取读锁超时（{timeout}秒）")
+        return True
+
+    def release_shared(self):
+        """释放共享（读）锁"""
+        while True:
+            state = self.word.load()
+            if not state & RW_READER_MASK:
+                raise RuntimeError("尝试释放未持有的读锁")
+            if self.word.compare_exchange(state, state - 1):
+                return
+
+    def is_locked(self):
+        """检查写锁是否被占用"""
+        return bool(self.word.load() & RW_WRITER_BIT)
+
+    def reader_count(self):
+        """当前持有读锁的读者数"""
+        return self.word.load() & RW_READER_MASK
+
+
+class _PosixSemaphore:
+    """POSIX 命名信号量（sem_open/sem_timedwait/sem_post）的 ctypes 封装"""
+    _lib = None
+
+    class _Timespec(ctypes.Structure):
+        _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+    @classmethod
+    def _load(cls):
+        if cls._lib is not None:
+            return cls._lib
+        candidates = [None, ctypes.util.find_library("pthread"), ctypes.util.find_library("rt")]
+        for name in candidates:
+            try:
+                lib = ctypes.CDLL(name, use_errno=True)
+            except OSError:
+                continue
+            if hasattr(lib, "sem_open"):
+                break
+        else:
+            raise OSError("当前平台不支持 POSIX 命名信号量")
+        lib.sem_open.restype = ctypes.c_void_p
+        lib.sem_open.argtypes = [ctypes.c_char_p, ctypes.c_int, ctypes.c_uint, ctypes.c_uint]
+        for fn in ("sem_trywait", "sem_post", "sem_close"):
+            getattr(lib, fn).argtypes = [ctypes.c_void_p]
+            getattr(lib, fn).restype = ctypes.c_int
+        lib.sem_unlink.argtypes = [ctypes.c_char_p]
+        lib.sem_unlink.restype = ctypes.c_int
+        if hasattr(lib, "sem_timedwait"):  # macOS 没有 sem_timedwait
+            lib.sem_timedwait.argtypes = [ctypes.c_void_p, ctypes.POINTER(cls._Timespec)]
+            lib.sem_timedwait.restype = ctypes.c_int
+        cls._lib = lib
+        return lib
+
+    def __init__(self, name: str):
+        lib = self._load()
+        self.name = ("/" + name).encode("utf-8")
+        handle = lib.sem_open(self.name, os.O_CREAT, 0o600, 1)
+        if handle is None or handle == ctypes.c_void_p(-1).value:
+            err = ctypes.get_errno()
+            raise OSError(err, f"创建信号量失败: {os.strerror(err)}")
+        self.handle = handle
+
+    def wait(self, timeout: float):
+        """等待信号量，超时返回 False"""
+        lib = self._lib
+        if hasattr(lib, "sem_timedwait"):
+            deadline = time.time() + timeout
+            ts = self._Timespec(int(deadline), int((deadline % 1) * 1e9))
+            while True:
+                if lib.sem_timedwait(self.handle, ctypes.byref(ts)) == 0:
+                    return True
+                err = ctypes.get_errno()
+                if err == 4:  # EINTR
+                    continue
+                if err == 110 or err == 60:  # ETIMEDOUT (Linux / BSD)
+                    return False
+                raise OSError(err, f"等待信号量失败: {os.strerror(err)}")
+        # 无 sem_timedwait 时退化为指数退避的 trywait
+        deadline = time.time() + timeout
+        delay = 0.0001
+        while True:
+            if lib.sem_trywait(self.handle) == 0:
+                return True
+            if time.time() >= deadline:
+                return False
+            time.sleep(delay)
+            delay = min(delay * 2, 0.005)
+
+    def post(self):
+        if self._lib.sem_post(self.handle) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, f"释放信号量失败: {os.strerror(err)}")
+
+    def close(self):
+        if self.handle is not None:
+            self._lib.sem_close(self.handle)
+            self.handle = None
+
+    def unlink(self):
+        self._lib.sem_unlink(self.name)
+
+
+class _WindowsSemaphore:
+    """Windows 命名信号量（CreateSemaphoreW/WaitForSingleObject）的 ctypes 封装"""
+    WAIT_OBJECT_0 = 0
+    WAIT_TIMEOUT = 0x102
+
+    def __init__(self, name: str):
+        from ctypes import wintypes
+        self._kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+        self._kernel32.CreateSemaphoreW.restype = wintypes.HANDLE
+        self._kernel32.CreateSemaphoreW.argtypes = [
+            ctypes.c_void_p, wintypes.LONG, wintypes.LONG, wintypes.LPCWSTR]
+        self._kernel32.WaitForSingleObject.argtypes = [wintypes.HANDLE, wintypes.DWORD]
+        self._kernel32.WaitForSingleObject.restype = wintypes.DWORD
+        self._kernel32.ReleaseSemaphore.argtypes = [
+            wintypes.HANDLE, wintypes.LONG, ctypes.c_void_p]
+        self._kernel32.CloseHandle.argtypes = [wintypes.HANDLE]
+        self.name = name
+        self.handle = self._kernel32.CreateSemaphoreW(None, 1, 1, name)
+        if not self.handle:
+            raise ctypes.WinError(ctypes.get_last_error())
+
+    def wait(self, timeout: float):
+        """等待信号量，超时返回 False"""
+        ret = self._kernel32.WaitForSingleObject(self.handle, int(timeout * 1000))
+        if ret == self.WAIT_OBJECT_0:
+            return True
+        if ret == self.WAIT_TIMEOUT:
+            return False
+        raise ctypes.WinError(ctypes.get_last_error())
+
+    def post(self):
+        if not self._kernel32.ReleaseSemaphore(self.handle, 1, None):
+            raise ctypes.WinError(ctypes.get_last_error())
+
+    def close(self):
+        if self.handle:
+            self._kernel32.CloseHandle(self.handle)
+            self.handle = None
+
+    def unlink(self):
+        # Windows 命名对象在最后一个句柄关闭后自动销毁
+        pass
+
+
+class SemaphoreLock:
+    """基于命名信号量的阻塞锁：等待时挂起，释放时由内核唤醒，不再轮询
+
+    与 SharedMemoryLock 接口相同。锁标志字节仍会同步更新，用于 is_locked() 显示。
+    同一个段上的所有进程必须使用同一种锁（见段头中的锁类型，open_lock 会自动选择）。
+    """
+    metrics_kind = "semaphore"
+
+    def __init__(self, shm: shared_memory.SharedMemory, lock_offset: int = LOCK_OFFSET,
+                 seq_offset: int = SEQ_OFFSET):
+        self.shm = shm
+        self.lock_offset = lock_offset
+        self.seqlock = SeqLock(shm, seq_offset) if has_header(shm) else None
+        self.acquired_at = None
+        sem_name = f"{shm.name.lstrip('/')}_lock"
+        if lock_offset != LOCK_OFFSET:
+            # 段内的每把锁（如各个槽位）使用各自的信号量，互不争用
+            sem_name += str(lock_offset)
+        if sys.platform == "win32":
+            self.sem = _WindowsSemaphore(sem_name)
+        else:
+            self.sem = _PosixSemaphore(sem_name)
+
+    def acquire(self, timeout=5.0):
+        """获取锁，带超时机制（阻塞等待，不占用 CPU）"""
+        start_time = time.perf_counter()
+        if not self.sem.wait(timeout):
+            if METRICS.enabled:
+                METRICS.record_timeout(self.metrics_kind, "exclusive", timeout)
+            raise TimeoutError(f"获取锁超时（{timeout}秒）")
+        self.shm.buf[self.lock_offset] = LOCK_HELD
+        if METRICS.enabled:
+            self.acquired_at = METRICS.record_acquire(self.metrics_kind, "exclusive", start_time)
+        return True
+
+    def release(self):
+        """释放锁"""
+        if self.shm.buf[self.lock_offset] != LOCK_HELD:
+            raise RuntimeError("尝试释放未持有的锁")
+        if METRICS.enabled:
+            METRICS.record_release(self.metrics_kind, self.acquired_at)
+        self.acquired_at = None
+        self.shm.buf[self.lock_offset] = LOCK_FREE
+        self.sem.post()
+
+    def is_locked(self):
+        """检查锁是否被占用"""
+        return self.shm.buf[self.lock_offset] == LOCK_HELD
+
+    def close(self):
+        """关闭本进程的信号量句柄"""
+        self.sem.close()
+
+    def unlink(self):
+        """销毁命名信号量（由创建段的 Host 在停止时调用）"""
+        self.sem.unlink()
+
+
+def open_lock(shm: shared_memory.SharedMemory, lock_offset: int = LOCK_OFFSET,
+              seq_offset: int = SEQ_OFFSET):
+    """根据段头中记录的锁类型创建对应的锁对象
+
+    seq_offset 为该锁保护的数据所用的 seqlock 计数器位置（默认是段头中的计数器）。
+    """
+    kind = segment_lock_kind(shm)
+    if kind == LOCK_KIND_SEMAPHORE:
+        return SemaphoreLock(shm, lock_offset, seq_offset)
+    if kind == LOCK_KIND_RWLOCK:
+        return ReadWriteLock(shm, lock_offset, seq_offset)
+    return SharedMemoryLock(shm, lock_offset, seq_offset)
+
+
+def init_segment(shm: shared_memory.SharedMemory, size: int = None, generation: int = 0,
+                 lock_kind: int = LOCK_KIND_SPIN):
+    """初始化段头：写入魔数、真实大小、代号和锁类型（单值布局），锁置为空闲，数据长度置 0"""
+    if size is None:
+        size = shm.size
+    shm.buf[MAGIC_OFFSET:MAGIC_OFFSET+4] = HEADER_MAGIC
+    shm.buf[FLAGS_OFFSET:FLAGS_OFFSET+4] = struct.pack(FLAGS_FMT, 0)
+    shm.buf[SIZE_OFFSET:SIZE_OFFSET+8] = struct.pack(SIZE_FMT, size)
+    shm.buf[GEN_OFFSET:GEN_OFFSET+4] = struct.pack(GEN_FMT, generation)
+    shm.buf[REDIRECT_OFFSET:REDIRECT_OFFSET+REDIRECT_SIZE] = b"\x00" * REDIRECT_SIZE
+    shm.buf[LOCK_KIND_OFFSET] = lock_kind
+    shm.buf[LAYOUT_OFFSET] = LAYOUT_SINGLE
+    shm.buf[LOCK_OFFSET:LOCK_OFFSET+LOCK_SIZE] = b"\x00" * LOCK_SIZE
+    shm.buf[LEN_OFFSET:LEN_OFFSET+LEN_SIZE] = struct.pack(LEN_FMT, 0)
+
+
+def create_segment(size: int = BUF_SIZE, generation: int = 0, lock_kind: int = LOCK_KIND_SPIN):
+    """创建指定大小的共享内存段并初始化段头"""
+    size = int(size)
+    if size < MIN_SEGMENT_SIZE:
+        raise ValueError(f"段大小过小: {size} < {MIN_SEGMENT_SIZE} bytes")
+    shm = shared_memory.SharedMemory(create=True, size=size)
+    _created_segments.add(shm._name)
+    init_segment(shm, size, generation, lock_kind)
+    return shm
+
+
+def has_header(shm: shared_memory.SharedMemory):
+    """检查段是否带有段头（由 create_segment 创建）"""
+    return shm.buf[MAGIC_OFFSET:MAGIC_OFFSET+4] == HEADER_MAGIC
+
+
+def segment_size(shm: shared_memory.SharedMemory):
+    """获取段的真实大小（Windows/macOS 上 shm.size 会按页向上取整）"""
+    if has_header(shm):
+        (size,) = struct.unpack_from(SIZE_FMT, shm.buf, SIZE_OFFSET)
+        return min(size, shm.size)
+    return shm.size
+
+
+def segment_capacity(shm: shared_memory.SharedMemory, data_offset: int = DATA_OFFSET):
+    """获取段中可存放的最大数据长度"""
+    return segment_size(shm) - data_offset
+
+
+def segment_generation(shm: shared_memory.SharedMemory):
+    """获取段的代号"""
+    (gen,) = struct.unpack(GEN_FMT, bytes(shm.buf[GEN_OFFSET:GEN_OFFSET+4]))
+    return gen
+
+
+def segment_version(shm: shared_memory.SharedMemory):
+    """段内容的版本号（seqlock 计数器的一半，每次完成写入 +1）"""
+    if not has_header(shm):
+        return 0
+    (seq,) = struct.unpack_from(SEQ_FMT, shm.buf, SEQ_OFFSET)
+    return seq >> 1
+
+
+def segment_redirect(shm: shared_memory.SharedMemory):
+    """如果段已迁移，返回新段名称；否则返回 None"""
+    if not has_header(shm):
+        return None
+    (flags,) = struct.unpack(FLAGS_FMT, bytes(shm.buf[FLAGS_OFFSET:FLAGS_OFFSET+4]))
+    if not flags & FLAG_MOVED:
+        return None
+    raw = bytes(shm.buf[REDIRECT_OFFSET:REDIRECT_OFFSET+REDIRECT_SIZE])
+    return raw.rstrip(b"\x00").decode("utf-8")
+
+
+def untrack_segment(shm: shared_memory.SharedMemory):
+    """让本进程的 resource_tracker 不再跟踪挂载的段
+
+    POSIX 上按名称挂载段也会登记到 resource_tracker，进程退出时段会被 unlink；
+    只挂载、不拥有段的进程（例如同机的 Client）需要取消登记，否则会在退出时删掉 Host 的段。
+    本进程创建的段不受影响。
+    """
+    if os.name != "posix" or shm._name in _created_segments:
+        return
+    from multiprocessing import resource_tracker
+    try:
+        resource_tracker.unregister(shm._name, "shared_memory")
+    except Exception:
+        pass
+
+
+def _open_segment(name: str, track: bool):
+    shm = shared_memory.SharedMemory(name=name)
+    if not track:
+        untrack_segment(shm)
+    return shm
+
+
+def attach_segment(name: str, max_hops: int = 16, track: bool = True):
+    """按名称挂载共享内存段，并沿 redirect 链迁移到最新的段
+
+    track=False 时沿途挂载的段都不登记到 resource_tracker（见 untrack_segment）。
+    """
+    shm = _open_segment(name, track)
+    for _ in range(max_hops):
+        new_name = segment_redirect(shm)
+        if new_name is None:
+            return shm
+        new_shm = _open_segment(new_name, track)
+        shm.close()
+        shm = new_shm
+    shm.close()
+    raise RuntimeError(f"redirect 链过长（超过 {max_hops} 次）: {name}")
+
+
+def follow_redirect(shm: shared_memory.SharedMemory, track: bool = True):
+    """检查段是否已迁移：未迁移返回原段，已迁移则关闭原段并返回挂载好的新段"""
+    new_name = segment_redirect(shm)
+    if new_name is None:
+        return shm
+    new_shm = attach_segment(new_name, track=track)
+    shm.close()
+    return new_shm
+
+
+def segment_lock_kind(shm: shared_memory.SharedMemory):
+    """获取段使用的锁类型"""
+    if not has_header(shm):
+        return LOCK_KIND_SPIN
+    return shm.buf[LOCK_KIND_OFFSET]
+
+
+def segment_layout(shm: shared_memory.SharedMemory):
+    """获取段的数据布局（LAYOUT_SINGLE / LAYOUT_SLOTS）"""
+    if not has_header(shm):
+        return LAYOUT_SINGLE
+    return shm.buf[LAYOUT_OFFSET]
+
+
+def segment_read_only(shm: shared_memory.SharedMemory):
+    """段是否由只读副本维护"""
+    if not has_header(shm):
+        return False
+    (flags,) = struct.unpack_from(FLAGS_FMT, shm.buf, FLAGS_OFFSET)
+    return bool(flags & FLAG_READ_ONLY)
+
+
+def mark_read_only(shm: shared_memory.SharedMemory):
+    """在段头中置只读标志（副本 Host 创建段后调用）"""
+    (flags,) = struct.unpack_from(FLAGS_FMT, shm.buf, FLAGS_OFFSET)
+    struct.pack_into(FLAGS_FMT, shm.buf, FLAGS_OFFSET, flags | FLAG_READ_ONLY)
+
+
+def publish_redirect(shm: shared_memory.SharedMemory, new_shm: shared_memory.SharedMemory):
+    """在旧段头中发布 redirect（调用方持有旧段上所有写者使用的锁）
+
+    先写名称，再置迁移标志，最后把代号更新为新段的代号。
+    """
+    name = new_shm.name.encode("utf-8")
+    if len(name) > REDIRECT_SIZE:
+        raise ValueError(f"新段名称过长: {new_shm.name}")
+    shm.buf[REDIRECT_OFFSET:REDIRECT_OFFSET+REDIRECT_SIZE] = name.ljust(REDIRECT_SIZE, b"\x00")
+    (flags,) = struct.unpack(FLAGS_FMT, bytes(shm.buf[FLAGS_OFFSET:FLAGS_OFFSET+4]))
+    shm.buf[FLAGS_OFFSET:FLAGS_OFFSET+4] = struct.pack(FLAGS_FMT, flags | FLAG_MOVED)
+    shm.buf[GEN_OFFSET:GEN_OFFSET+4] = struct.pack(GEN_FMT, segment_generation(new_shm))
+
+
+def grow_segment(shm: shared_memory.SharedMemory, lock: SharedMemoryLock, new_size: int):
+    """在线扩容：分配更大的新段，复制数据，并在旧段头中发布 redirect
+
+    旧段不会被 unlink，调用方需要保留它直到所有读者迁移完成（例如 Host 停止时），
+    这样仍持有旧段的进程可以通过 follow_redirect 找到新段。
+    """
+    new_size = int(new_size)
+    old_size = segment_size(shm)
+    if new_size <= old_size:
+        raise ValueError(f"新段大小必须大于当前大小: {new_size} <= {old_size} bytes")
+    if segment_layout(shm) != LAYOUT_SINGLE:
+        raise ValueError("只有单值布局的段支持在线扩容")
+
+    lock.acquire()
+    try:
+        if segment_redirect(shm) is not None:
+            raise SegmentMovedError(segment_redirect(shm))
+        new_gen = segment_generation(shm) + 1
+        new_shm = create_segment(new_size, new_gen, segment_lock_kind(shm))
+        name = new_shm.name.encode("utf-8")
+        if len(name) > REDIRECT_SIZE:
+            new_shm.close()
+            new_shm.unlink()
+            raise ValueError(f"新段名称过长: {new_shm.name}")
+        try:
+            # 复制长度字段和有效数据（只复制实际长度，不复制空白区域）
+            (n,) = struct.unpack(LEN_FMT, bytes(shm.buf[LEN_OFFSET:LEN_OFFSET+LEN_SIZE]))
+            n = min(n, old_size - DATA_OFFSET)
+            new_shm.buf[LEN_OFFSET:LEN_OFFSET+LEN_SIZE] = struct.pack(LEN_FMT, n)
+            new_shm.buf[DATA_OFFSET:DATA_OFFSET+n] = shm.buf[DATA_OFFSET:DATA_OFFSET+n]
+            # 沿用旧段的序列计数器，保证版本号单调递增
+            new_shm.buf[SEQ_OFFSET:SEQ_OFFSET+8] = shm.buf[SEQ_OFFSET:SEQ_OFFSET+8]
+            if segment_read_only(shm):
+                mark_read_only(new_shm)
+        except Exception:
+            new_shm.close()
+            new_shm.unlink()
+            raise
+        publish_redirect(shm, new_shm)
+        return new_shm
+    finally:
+        lock.release()
+
+
+def _zero_fill(buf: memoryview, start: int, end: int):
+    """用共享零块分段清零 [start, end)，不分配临时对象"""
+    block = len(_ZERO_BLOCK)
+    zeros = memoryview(_ZERO_BLOCK)
+    while start < end:
+        n = min(block, end - start)
+        buf[start:start+n] = zeros[:n]
+        start += n
+
+
+def shm_write_bytes(shm: shared_memory.SharedMemory, data, lock: SharedMemoryLock, 
+                    data_offset: int = DATA_OFFSET, buf_size: int = None,
+                    fill: str = WRITE_FILL_DELTA, timeout: float = 5.0):
+    """原子性写入二进制数据（bytes/bytearray/memoryview），写入完成后立即释放锁
+
+    fill 决定如何处理新数据之后的尾部：
+    - WRITE_FILL_DELTA: 只清空旧长度比新长度多出的部分，写入开销为 O(数据长度)
+    - WRITE_FILL_FULL: 清空长度之后的整个数据区，开销为 O(段大小)
+    - WRITE_FILL_NONE: 只写长度和数据，尾部保留旧内容（读者依赖长度字段）
+    timeout 为获取锁的超时时间，timeout=0 时锁被占用立即抛出 TimeoutError。
+    """
+    if fill not in (WRITE_FILL_DELTA, WRITE_FILL_FULL, WRITE_FILL_NONE):
+        raise ValueError(f"未知的尾部处理模式: {fill}")
+    n = len(data)
+    if buf_size is None:
+        buf_size = segment_size(shm)
+    max_data_size = buf_size - data_offset
+    if n > max_data_size:
+        raise ValueError(f"数据太长: {n} > {max_data_size} bytes")
+    started = time.perf_counter() if METRICS.enabled else None
+    
+    # 获取锁
+    lock.acquire(timeout)
+    try:
+        # 段已迁移时拒绝写入旧段，避免数据丢失
+        new_name = segment_redirect(shm)
+        if new_name is not None:
+            raise SegmentMovedError(new_name)
+        _write_locked(shm, data, lock, data_offset, buf_size, fill)
+    finally:
+        # 写入完成后立即释放锁
+        lock.release()
+    if started is not None:
+        METRICS.record_shm("write", n, started)
+
+
+def _write_locked(shm: shared_memory.SharedMemory, data, lock: SharedMemoryLock,
+                  data_offset: int, buf_size: int, fill: str):
+    """在调用方已持有锁时写入长度和数据（不检查长度，由调用方保证不超过数据区）"""
+    n = len(data)
+    seqlock = getattr(lock, "seqlock", None)
+    if seqlock is not None:
+        seqlock.write_begin()
+    try:
+        buf = shm.buf
+        len_offset = lock.lock_offset + LOCK_SIZE
+        (old_n,) = struct.unpack_from(LEN_FMT, buf, len_offset)
+        # 确保长度字段正确写入实际数据长度（直接写入段内，不创建临时 bytes）
+        struct.pack_into(LEN_FMT, buf, len_offset, n)
+        # 写入实际数据（memoryview 切片赋值，只复制 n 字节）
+        buf[data_offset:data_offset+n] = data
+        # 清理尾部（使用空字节填充，不是空格）
+        if fill == WRITE_FILL_FULL:
+            _zero_fill(buf, data_offset + n, buf_size)
+        elif fill == WRITE_FILL_DELTA and old_n > n:
+            # 旧长度异常时按整个数据区处理
+            _zero_fill(buf, data_offset + n, data_offset + min(old_n, buf_size - data_offset))
+    finally:
+        if seqlock is not None:
+            seqlock.write_end()
+
+
 def shm_write(shm: shared_memory.SharedMemory, text: str, lock: SharedMemoryLock, 
-              data_offset: int = DATA_OFFSET, buf_size: int = BUF_SIZE):
+              data_offset: int = DATA_OFFSET, buf_size: int = None,
+              fill: str = WRITE_FILL_DELTA, timeout: float = 5.0):
     """原子性写入共享内存，写入完成后立即释放锁"""
     # 移除文本末尾的空白字符，避免写入多余的空格
     text = text.rstrip()
     data = text.encode("utf-8")
+    if buf_size is None:
+        buf_size = segment_size(shm)
     max_data_size = buf_size - data_offset
     if len(data) > max_data_size:
         raise ValueError(f"文本太长: {len(data)} > {max_data_size} bytes")
+    shm_write_bytes(shm, data, lock, data_offset, buf_size, fill, timeout)
+
+
+def shm_patch(shm: shared_memory.SharedMemory, offset: int, data, lock: SharedMemoryLock,
+              data_offset: int = DATA_OFFSET, expected_version: int = None,
+              truncate: bool = False, timeout: float = 5.0):
+    """在数据区的 offset 处写入 data，只复制 len(data) 字节，返回写入后的版本号
+
+    - offset 不能超过当前数据长度（不允许留下空洞）
+    - truncate=True 时数据长度变为 offset + len(data)，并清空多出的旧数据；
+      否则数据长度为 max(原长度, offset + len(data))
+    - expected_version 不为 None 时，只有段内容的版本号与之相同才写入，
+      否则抛出 VersionConflictError
+    """
+    n = len(data)
+    buf_size = segment_size(shm)
+    max_data_size = buf_size - data_offset
+    if offset < 0 or offset + n > max_data_size:
+        raise ValueError(f"数据太长: {offset} + {n} > {max_data_size} bytes")
+    started = time.perf_counter() if METRICS.enabled else None
     
-    # 获取锁
-    lock.acquire()
+    lock.acquire(timeout)
     try:
-        # 写入数据
-        len_offset = lock.lock_offset + 4
-        # 确保长度字段正确写入实际数据长度
-        shm.buf[len_offset:len_offset+4] = struct.pack(LEN_FMT, len(data))
-        # 写入实际数据
-        shm.buf[data_offset:data_offset+len(data)] = data
-        # 清空剩余区域（使用空字节填充，不是空格）
-        remaining = buf_size - data_offset - len(data)
-        if remaining > 0:
-            shm.buf[data_offset+len(data):buf_size] = b"\x00" * remaining
+        # 段已迁移时拒绝写入旧段，避免数据丢失
+        new_name = segment_redirect(shm)
+        if new_name is not None:
+            raise SegmentMovedError(new_name)
+        if expected_version is not None:
+            actual = segment_version(shm)
+            if actual != expected_version:
+                raise VersionConflictError(expected_version, actual)
+        buf = shm.buf
+        len_offset = lock.lock_offset + LOCK_SIZE
+        old_n = _payload_length(shm, len_offset, data_offset)
+        if offset > old_n:
+            raise ValueError(f"写入位置超出数据长度: {offset} > {old_n}")
+        new_n = offset + n if truncate else max(old_n, offset + n)
+        seqlock = getattr(lock, "seqlock", None)
+        if seqlock is not None:
+            seqlock.write_begin()
+        try:
+            buf[data_offset+offset:data_offset+offset+n] = data
+            if new_n != old_n:
+                struct.pack_into(LEN_FMT, buf, len_offset, new_n)
+            if old_n > new_n:
+                _zero_fill(buf, data_offset + new_n, data_offset + old_n)
+        finally:
+            if seqlock is not None:
+                seqlock.write_end()
+        version = segment_version(shm)
     finally:
-        # 写入完成后立即释放锁
         lock.release()
+    if started is not None:
+        METRICS.record_shm("patch", n, started)
+    return version
+
+
+def diff_patch(old: bytes, new: bytes):
+    """计算把 old 变为 new 所需的最小补丁，返回 (offset, data, truncate)；内容相同时返回 None
+
+    长度不变时只发送首尾公共部分之间的字节；长度改变时从第一个不同的字节发送到末尾。
+    """
+    if old == new:
+        return None
+    limit = min(len(old), len(new))
+    prefix = _common_length(old, new, 0, 0, limit, 1)
+    if len(old) != len(new):
+        return prefix, new[prefix:], True
+    suffix = _common_length(old, new, len(old) - 1, len(new) - 1, limit - prefix, -1)
+    return prefix, new[prefix:len(new)-suffix], False
+
+
+def _common_length(a, b, a_start: int, b_start: int, limit: int, step: int):
+    """从 a_start / b_start 起按 step 方向（1 向后，-1 向前）相同的字节数，最多 limit
+
+    先按块比较（切片比较在 C 中完成），只在第一个不同的块内逐字节查找。
+    """
+    n = 0
+    block = _DIFF_BLOCK
+    while limit - n >= block:
+        if step > 0:
+            same = a[a_start+n:a_start+n+block] == b[b_start+n:b_start+n+block]
+        else:
+            same = a[a_start-n-block+1:a_start-n+1] == b[b_start-n-block+1:b_start-n+1]
+        if not same:
+            break
+        n += block
+    while n < limit and a[a_start+step*n] == b[b_start+step*n]:
+        n += 1
+    return n
+
+
+def _payload_length(shm: shared_memory.SharedMemory, len_offset: int, data_offset: int,
+                    buf_size: int = None):
+    """按长度字段计算有效数据长度（不加锁，由调用方保证一致性）
+
+    buf_size 为数据区的结束位置，默认为段的真实大小。
+    """
+    if buf_size is None:
+        buf_size = segment_size(shm)
+    (n,) = struct.unpack_from(LEN_FMT, shm.buf, len_offset)
+    
+    # 验证长度字段的合理性，防止读取到无效数据
+    max_valid_len = buf_size - data_offset
+    if n < 0 or n > max_valid_len:
+        # 长度字段异常，尝试找到实际数据结束位置
+        # 查找第一个空字节或缓冲区结束
+        actual_data = bytes(shm.buf[data_offset:buf_size])
+        # 找到第一个空字节的位置
+        null_pos = actual_data.find(b'\x00')
+        if null_pos > 0:
+            n = null_pos
+        else:
+            # 如果没有空字节，使用整个缓冲区（但限制在合理范围内）
+            n = min(len(actual_data.rstrip(b'\x00')), max_valid_len)
+    return n
+
+
+def _read_locked(lock: SharedMemoryLock):
+    """返回加锁读取使用的 (acquire, release)：读写锁用共享模式，其他锁用排他模式"""
+    if hasattr(lock, "acquire_shared"):
+        return lock.acquire_shared, lock.release_shared
+    return lock.acquire, lock.release
+
+
+def _consistent_read(shm: shared_memory.SharedMemory, lock: SharedMemoryLock,
+                     data_offset: int, mode: str, copy, timeout: float = 5.0,
+                     buf_size: int = None):
+    """在一致性保护下调用 copy(start, end) 复制数据区，返回 copy 的结果
+
+    seqlock 模式下乐观复制，读取期间发生写入则重试，多次失败后退化为加锁读取；
+    locked 模式下始终加锁复制。
+    """
+    started = time.perf_counter() if METRICS.enabled else None
+    len_offset = lock.lock_offset + LOCK_SIZE
+    seqlock = getattr(lock, "seqlock", None)
+    if mode == READ_MODE_SEQLOCK and seqlock is not None:
+        for _ in range(SEQLOCK_READ_RETRIES):
+            start = seqlock.read_begin()
+            if start is None:
+                # 写者正在写入，让出 CPU 后重试
+                time.sleep(0)
+                continue
+            n = _payload_length(shm, len_offset, data_offset, buf_size)
+            result = copy(data_offset, data_offset + n)
+            if seqlock.read_validate(start):
+                if started is not None:
+                    METRICS.record_shm("read", n, started)
+                return result
+        if started is not None:
+            METRICS.shm_read_fallbacks.inc()
+    elif mode not in (READ_MODE_SEQLOCK, READ_MODE_LOCKED):
+        raise ValueError(f"未知的读取模式: {mode}")
+    
+    # 读写锁下以共享模式加锁，读者之间互不阻塞
+    acquire, release = _read_locked(lock)
+    acquire(timeout)
+    try:
+        n = _payload_length(shm, len_offset, data_offset, buf_size)
+        result = copy(data_offset, data_offset + n)
+    finally:
+        release()
+    if started is not None:
+        METRICS.record_shm("read", n, started)
+    return result
 
 
 def shm_read(shm: shared_memory.SharedMemory, lock: SharedMemoryLock, 
-             data_offset: int = DATA_OFFSET):
-    """读取共享内存"""
-    lock.acquire()
+             data_offset: int = DATA_OFFSET, mode: str = READ_MODE_SEQLOCK,
+             timeout: float = 5.0):
+    """读取共享内存
+
+    默认使用 seqlock 乐观读取，不与写者争抢锁；读取期间发生写入则重试，
+    多次重试失败（写入非常频繁）后退化为加锁读取。mode=READ_MODE_LOCKED 时始终加锁读取。
+    """
+    data = shm_read_bytes(shm, lock, data_offset, mode, timeout)
+    # 移除末尾的空字节
+    return data.rstrip(b'\x00').decode("utf-8", errors="replace")
+
+
+def shm_read_bytes(shm: shared_memory.SharedMemory, lock: SharedMemoryLock, 
+                   data_offset: int = DATA_OFFSET, mode: str = READ_MODE_SEQLOCK,
+                   timeout: float = 5.0, buf_size: int = None):
+    """读取共享内存中的原始字节（只复制一次，不解码）"""
+    buf = shm.buf
+    return _consistent_read(shm, lock, data_offset, mode, lambda a, b: bytes(buf[a:b]), timeout,
+                            buf_size)
+
+
+def shm_read_if_newer(shm: shared_memory.SharedMemory, lock: SharedMemoryLock, since_version,
+                      data_offset: int = DATA_OFFSET, mode: str = READ_MODE_SEQLOCK,
+                      timeout: float = 5.0):
+    """条件读取，返回 (版本号, 数据)
+
+    段内容的版本号等于 since_version 时只读取一次计数器，不复制数据，返回 (since_version, None)；
+    否则返回来自同一个一致快照的版本号和数据。since_version 为 None 时总是读取。
+    """
+    if since_version is not None and segment_version(shm) == since_version:
+        return since_version, None
+    buf = shm.buf
+    # 复制在 seqlock 校验窗口（或锁）内进行，版本号与数据一致
+    return _consistent_read(shm, lock, data_offset, mode,
+                            lambda a, b: (segment_version(shm), bytes(buf[a:b])), timeout)
+
+
+def shm_readinto(shm: shared_memory.SharedMemory, lock: SharedMemoryLock, out, 
+                 data_offset: int = DATA_OFFSET, mode: str = READ_MODE_SEQLOCK,
+                 timeout: float = 5.0):
+    """把数据复制到调用方提供的可写缓冲区（bytearray/memoryview），返回数据长度
+
+    缓冲区不足时抛出 ValueError，不做任何分配。
+    """
+    buf = shm.buf
+    target = memoryview(out)
+
+    def copy(a, b):
+        n = b - a
+        if n > len(target):
+            raise ValueError(f"缓冲区太小: {len(target)} < {n} bytes")
+        target[:n] = buf[a:b]
+        return n
+
     try:
-        len_offset = lock.lock_offset + 4
-        (n,) = struct.unpack(LEN_FMT, bytes(shm.buf[len_offset:len_offset+4]))
-        
-        # 验证长度字段的合理性，防止读取到无效数据
-        max_valid_len = BUF_SIZE - data_offset
-        if n < 0 or n > max_valid_len:
-            # 长度字段异常，尝试找到实际数据结束位置
-            # 查找第一个空字节或缓冲区结束
-            actual_data = bytes(shm.buf[data_offset:BUF_SIZE])
-            # 找到第一个空字节的位置
-            null_pos = actual_data.find(b'\x00')
-            if null_pos > 0:
-                n = null_pos
-            else:
-                # 如果没有空字节，使用整个缓冲区（但限制在合理范围内）
-                n = min(len(actual_data.rstrip(b'\x00')), max_valid_len)
-        
-        # 只读取指定长度的数据
-        data = bytes(shm.buf[data_offset:data_offset+n])
-        # 移除末尾的空字节
-        data = data.rstrip(b'\x00')
-        return data.decode("utf-8", errors="replace")
+        return _consistent_read(shm, lock, data_offset, mode, copy, timeout)
     finally:
-        lock.release()
+        target.release()
+
+
+class ShmView:
+    """段内数据区的只读 memoryview，只在 with 块内有效
+
+    locked 模式（默认）在 with 块内持有锁（读写锁为共享锁），view.data 始终一致；
+    seqlock 模式不加锁，退出 with 块时检查序列计数器，view.valid 为 False
+    表示期间发生了写入，调用方应丢弃解析结果并重试。seqlock 模式下写者持续写入、
+    重试 SEQLOCK_READ_RETRIES 次仍无法开始读取时退化为加锁（与 shm_read 相同）。
+    timeout: 等待锁的最长时间，超时抛出 TimeoutError
+    """
+    def __init__(self, shm: shared_memory.SharedMemory, lock: SharedMemoryLock,
+                 data_offset: int = DATA_OFFSET, mode: str = READ_MODE_LOCKED,
+                 timeout: float = 5.0):
+        if mode not in (READ_MODE_SEQLOCK, READ_MODE_LOCKED):
+            raise ValueError(f"未知的读取模式: {mode}")
+        self.shm = shm
+        self.lock = lock
+        self.data_offset = data_offset
+        self.mode = mode
+        self.timeout = timeout
+        self.data = None
+        self.valid = False
+        self._seq_start = None
+        self._release = None
+
+    def __enter__(self):
+        seqlock = getattr(self.lock, "seqlock", None)
+        start = None
+        if self.mode == READ_MODE_SEQLOCK and seqlock is not None:
+            for _ in range(SEQLOCK_READ_RETRIES):
+                start = seqlock.read_begin()
+                if start is not None:
+                    break
+                # 写者正在写入，让出 CPU 后重试
+                time.sleep(0)
+            else:
+                if METRICS.enabled:
+                    METRICS.shm_read_fallbacks.inc()
+        self._seq_start = start
+        if start is None:
+            acquire, release = _read_locked(self.lock)
+            acquire(self.timeout)
+            self._release = release
+        try:
+            len_offset = self.lock.lock_offset + LOCK_SIZE
+            n = _payload_length(self.shm, len_offset, self.data_offset)
+            self.data = self.shm.buf[self.data_offset:self.data_offset+n].toreadonly()
+        except Exception:
+            if self._release is not None:
+                self._release()
+                self._release = None
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # 释放 memoryview，避免阻止段的 close
+        self.data.release()
+        if self._release is not None:
+            self._release()
+            self._release = None
+            self.valid = True
+        else:
+            self.valid = self.lock.seqlock.read_validate(self._seq_start)
+        return False
+
+
+def shm_view(shm: shared_memory.SharedMemory, lock: SharedMemoryLock, 
+             data_offset: int = DATA_OFFSET, mode: str = READ_MODE_LOCKED,
+             timeout: float = 5.0):
+    """零拷贝读取：返回 ShmView 上下文管理器
+
+    用法:
+        with shm_view(shm, lock) as view:
+            record = struct.unpack_from(fmt, view.data, 0)
+    """
+    return ShmView(shm, lock, data_offset, mode, timeout)
+
 
+if __name__ == "__main__":
+    # 命令行入口: python -m shared_memory_utils serve|get|put|bench
+    from shm_cli import main
+    sys.exit(main())
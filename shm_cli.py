@@ -0,0 +1,298 @@
+"""命令行入口（无需图形界面）
+
+用法:
+    python -m shared_memory_utils serve [--port P] [--size N] [--lock spin|semaphore|rwlock]
+                                        [--slots N [--slot-size B]] [--ring B [--ring-overwrite]]
+                                        [--upstream HOST:PORT [--upstream-shm-id ID]]  (只读副本)
+                                        [--metrics] [--metrics-port P]
+                                        [--snapshot FILE [--snapshot-interval S] [--warm-start]]
+    python -m shared_memory_utils get HOST:PORT [--shm-id ID] [--key K] [--compress zlib|lzma]
+                                                                    [--no-local]
+    python -m shared_memory_utils put HOST:PORT TEXT [--shm-id ID] [--key K]
+                                                                    (TEXT 为 - 时从标准输入读取)
+    python -m shared_memory_utils stream HOST:PORT [--shm-id ID]     (逐行输出 Host 环形缓冲区的消息)
+    python -m shared_memory_utils bench HOST:PORT [--ops N] [--clients C] [--size B] [--write-ratio R]
+    python -m shared_memory_utils stats HOST:PORT [--shm-id ID]      (输出 Host 的运行指标，JSON)
+"""
+import argparse
+import json
+import random
+import signal
+import sys
+import threading
+import time
+
+from shared_memory_utils import BUF_SIZE, get_local_ip
+from shm_protocol import CODEC_NAMES, COMPRESS_THRESHOLD
+from shm_ring import RING_BLOCK, RING_OVERWRITE
+from shm_server import DEFAULT_BACKLOG, DEFAULT_MAX_CONNECTIONS, SharedMemoryHost
+from shm_replica import ReplicaHost
+from shm_client import SharedMemoryClient
+from shm_metrics import enable as enable_metrics
+from benchmark import LOCK_KINDS, summarize
+
+
+def parse_address(address: str):
+    """解析 "HOST:PORT"，返回 (host, port)"""
+    host, sep, port = address.rpartition(":")
+    if not sep or not host:
+        raise argparse.ArgumentTypeError(f"地址格式错误: '{address}'，应为 HOST:PORT")
+    try:
+        return host, int(port)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"端口号格式错误: '{port}'，请输入数字")
+
+
+def cmd_serve(args):
+    """以守护方式运行 Host，直到收到 SIGINT/SIGTERM"""
+    stop_event = threading.Event()
+    signal.signal(signal.SIGINT, lambda *_: stop_event.set())
+    if hasattr(signal, "SIGTERM"):
+        signal.signal(signal.SIGTERM, lambda *_: stop_event.set())
+    snapshot_event = threading.Event()
+    if args.snapshot and hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, lambda *_: snapshot_event.set())
+
+    status = (lambda msg: print(msg, flush=True)) if args.verbose else None
+    if args.metrics:
+        enable_metrics()
+    ring_policy = RING_OVERWRITE if args.ring_overwrite else RING_BLOCK
+    if args.upstream is not None:
+        if args.slots:
+            raise ValueError("副本只支持单值布局，不能与 --slots 同时使用")
+        state = None
+        if args.verbose:
+            def state(connected, error):
+                print("已连接上游 Host" if connected else f"上游连接断开: {error}", flush=True)
+        host = ReplicaHost(*args.upstream, upstream_shm_id=args.upstream_shm_id, size=args.size,
+                           lock_kind=LOCK_KINDS[args.lock], host=args.host, port=args.port,
+                           backlog=args.backlog, max_connections=args.max_connections,
+                           ring_size=args.ring, ring_policy=ring_policy,
+                           compress_threshold=args.compress_threshold,
+                           compression=args.upstream_compress,
+                           metrics_port=args.metrics_port, snapshot_path=args.snapshot,
+                           snapshot_interval=args.snapshot_interval, warm_start=args.warm_start,
+                           on_state=state, on_status=status)
+    else:
+        host = SharedMemoryHost(args.size, lock_kind=LOCK_KINDS[args.lock], host=args.host,
+                                port=args.port, backlog=args.backlog,
+                                max_connections=args.max_connections, slots=args.slots,
+                                slot_size=args.slot_size, ring_size=args.ring,
+                                ring_policy=ring_policy,
+                                compress_threshold=args.compress_threshold,
+                                metrics_port=args.metrics_port, snapshot_path=args.snapshot,
+                                snapshot_interval=args.snapshot_interval,
+                                warm_start=args.warm_start, on_status=status)
+    _, port = host.start()
+    try:
+        print(f"Host 已启动 - IP: {get_local_ip()}, 端口: {port}, SHM ID: {host.shm_id}, "
+              f"容量: {host.capacity} bytes", flush=True)
+        if args.upstream is not None:
+            upstream = "已同步" if host.connected else f"未连接（后台重试）: {host.last_error}"
+            print(f"只读副本 - 上游: {args.upstream[0]}:{args.upstream[1]}, {upstream}", flush=True)
+        if host.metrics_address is not None:
+            metrics_host, metrics_port = host.metrics_address
+            print(f"指标端点: http://{metrics_host}:{metrics_port}/metrics", flush=True)
+        if host.ring_shm is not None:
+            print(f"环形缓冲区: {host.ring_shm.name}, 容量: {args.ring} bytes", flush=True)
+        if args.snapshot:
+            if host.restored is not None:
+                print(f"已从快照恢复: {args.snapshot}（{host.restored.length} bytes）", flush=True)
+            print(f"快照文件: {args.snapshot}（SIGUSR1 立即保存，停止时保存）", flush=True)
+        while not stop_event.wait(0.5):
+            if snapshot_event.is_set():
+                snapshot_event.clear()
+                try:
+                    info = host.snapshot()
+                    print(f"快照已保存: {info.path}（{info.length} bytes）", flush=True)
+                except Exception as e:
+                    print(f"保存快照失败: {e}", file=sys.stderr, flush=True)
+    finally:
+        host.stop()
+        print("Host 已停止", flush=True)
+    return 0
+
+
+def cmd_get(args):
+    """读取远程共享内存内容并输出到标准输出"""
+    with SharedMemoryClient(*args.address, shm_id=args.shm_id, timeout=args.timeout,
+                            compression=args.compress, local=args.local) as client:
+        if args.key is None:
+            data = client.read_bytes().rstrip(b"\x00")
+        else:
+            data = client.get_bytes(args.key)
+            if data is None:
+                print(f"错误: 键不存在: {args.key}", file=sys.stderr)
+                return 1
+    sys.stdout.buffer.write(data)
+    if data and not data.endswith(b"\n"):
+        sys.stdout.buffer.write(b"\n")
+    return 0
+
+
+def cmd_put(args):
+    """写入内容到远程共享内存"""
+    text = sys.stdin.read() if args.text == "-" else args.text
+    with SharedMemoryClient(*args.address, shm_id=args.shm_id, timeout=args.timeout,
+                            compression=args.compress, local=args.local) as client:
+        if args.key is None:
+            client.write(text)
+        else:
+            client.put(args.key, text)
+    return 0
+
+
+def cmd_stream(args):
+    """订阅 Host 的环形缓冲区，逐行输出收到的消息，直到 Ctrl+C 或连接断开"""
+    stop_event = threading.Event()
+    signal.signal(signal.SIGINT, lambda *_: stop_event.set())
+    out = sys.stdout.buffer
+
+    def on_messages(messages):
+        for data in messages:
+            out.write(data)
+            if not data.endswith(b"\n"):
+                out.write(b"\n")
+        out.flush()
+
+    with SharedMemoryClient(*args.address, shm_id=args.shm_id, timeout=args.timeout,
+                            compression=args.compress, on_messages=on_messages,
+                            on_disconnect=stop_event.set):
+        while not stop_event.wait(0.5):
+            pass
+    return 0
+
+
+def _bench_worker(address, shm_id, timeout, compression, local, ops, payload, write_ratio,
+                  seed, results, errors):
+    """压测线程：独占一个连接，按比例混合执行读写，记录每次请求的延迟"""
+    rng = random.Random(seed)
+    samples = []
+    try:
+        with SharedMemoryClient(*address, shm_id=shm_id, timeout=timeout,
+                                compression=compression, local=local) as client:
+            for _ in range(ops):
+                t0 = time.perf_counter()
+                if rng.random() < write_ratio:
+                    client.write_bytes(payload)
+                else:
+                    client.read_bytes()
+                samples.append(time.perf_counter() - t0)
+    except Exception as e:
+        errors.append(e)
+    results.append(samples)
+
+
+def cmd_bench(args):
+    """对远程 Host 做读写压测，输出延迟分位数和吞吐"""
+    payload = b"x" * args.size
+    results, errors = [], []
+    per_client = max(1, args.ops // args.clients)
+    workers = [
+        threading.Thread(target=_bench_worker,
+                         args=(args.address, args.shm_id, args.timeout, args.compress, args.local,
+                               per_client, payload, args.write_ratio, i, results, errors))
+        for i in range(args.clients)
+    ]
+    t0 = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.perf_counter() - t0
+
+    samples = [s for r in results for s in r]
+    r = summarize(samples)
+    ops_per_sec = len(samples) / elapsed if elapsed > 0 else 0.0
+    print(f"{'客户端':<8}{'请求数':>10}{'p50(us)':>12}{'p99(us)':>12}{'max(us)':>12}{'ops/s':>12}")
+    print(f"{args.clients:<8}{r['count']:>10}{r['p50_us']:>12.1f}{r['p99_us']:>12.1f}"
+          f"{r['max_us']:>12.1f}{ops_per_sec:>12.0f}")
+    for e in errors:
+        print(f"错误: {e}", file=sys.stderr)
+    return 1 if errors else 0
+
+
+def cmd_stats(args):
+    """查询 Host 的运行指标和连接明细，以 JSON 输出"""
+    with SharedMemoryClient(*args.address, shm_id=args.shm_id, timeout=args.timeout,
+                            compression=args.compress, local=False) as client:
+        stats = client.stats()
+    json.dump(stats, sys.stdout, indent=2, ensure_ascii=False)
+    print()
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python -m shared_memory_utils",
+                                     description="共享内存 Host/Client 命令行工具")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("serve", help="启动 Host（无界面）")
+    p.add_argument("--host", default="0.0.0.0", help="监听地址")
+    p.add_argument("--port", type=int, default=0, help="监听端口（0 = 随机）")
+    p.add_argument("--size", type=int, default=BUF_SIZE, help="段大小（bytes）")
+    p.add_argument("--lock", choices=list(LOCK_KINDS), default="spin", help="锁类型")
+    p.add_argument("--backlog", type=int, default=DEFAULT_BACKLOG)
+    p.add_argument("--max-connections", type=int, default=DEFAULT_MAX_CONNECTIONS)
+    p.add_argument("--slots", type=int, default=0, help="槽位数（>0 时使用键值槽位布局）")
+    p.add_argument("--slot-size", type=int, default=0, help="定长槽位的容量（0 = 变长）")
+    p.add_argument("--ring", type=int, default=0, help="环形缓冲区容量（bytes，0 = 不启用）")
+    p.add_argument("--ring-overwrite", action="store_true",
+                   help="环形缓冲区满时覆盖最旧的消息（默认等待最慢的消费者）")
+    p.add_argument("--compress-threshold", type=int, default=COMPRESS_THRESHOLD,
+                   help="小于该长度的负载不压缩（bytes）")
+    p.add_argument("--upstream", type=parse_address, default=None,
+                   help="作为只读副本运行，从上游 Host HOST:PORT 复制内容")
+    p.add_argument("--upstream-shm-id", default=None, help="校验上游的共享内存 ID")
+    p.add_argument("--upstream-compress", choices=list(CODEC_NAMES), default=None,
+                   help="与上游连接的压缩算法")
+    p.add_argument("--metrics", action="store_true",
+                   help="记录锁、读写和连接的指标（STATS 命令返回）")
+    p.add_argument("--metrics-port", type=int, default=None,
+                   help="在 127.0.0.1 的该端口提供 HTTP 指标端点（/metrics、/stats，隐含 --metrics）")
+    p.add_argument("--snapshot", default=None, metavar="FILE",
+                   help="快照文件：停止时保存，收到 SIGUSR1 时立即保存")
+    p.add_argument("--snapshot-interval", type=float, default=0,
+                   help="定期快照的间隔（秒，内容未变化时跳过；0 = 不定期保存）")
+    p.add_argument("--warm-start", action="store_true",
+                   help="启动时从快照文件恢复内容（文件存在时）")
+    p.add_argument("-v", "--verbose", action="store_true", help="输出连接状态")
+    p.set_defaults(func=cmd_serve)
+
+    for name, func, help_text in (("get", cmd_get, "读取远程共享内存"),
+                                  ("put", cmd_put, "写入远程共享内存"),
+                                  ("stream", cmd_stream, "订阅远程环形缓冲区的消息流"),
+                                  ("bench", cmd_bench, "远程读写压测"),
+                                  ("stats", cmd_stats, "查询 Host 的运行指标")):
+        p = sub.add_parser(name, help=help_text)
+        p.add_argument("address", type=parse_address, help="Host 地址 HOST:PORT")
+        p.add_argument("--shm-id", default=None, help="校验共享内存 ID")
+        p.add_argument("--timeout", type=float, default=10.0, help="请求超时（秒）")
+        p.add_argument("--compress", choices=list(CODEC_NAMES), default=None,
+                       help="协商压缩算法（需要二进制协议）")
+        p.add_argument("--no-local", dest="local", action="store_false",
+                       help="Host 在本机时也通过 TCP 访问（默认直接挂载共享内存）")
+        p.set_defaults(func=func)
+        if name in ("get", "put"):
+            p.add_argument("--key", default=None, help="槽位键（Host 使用槽位布局时）")
+        if name == "put":
+            p.add_argument("text", help="要写入的内容，- 表示从标准输入读取")
+        elif name == "bench":
+            p.add_argument("--ops", type=int, default=10000, help="总请求数")
+            p.add_argument("--clients", type=int, default=4, help="并发连接数")
+            p.add_argument("--size", type=int, default=256, help="写入的负载大小（bytes）")
+            p.add_argument("--write-ratio", type=float, default=0.1, help="写请求比例")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    try:
+        return args.func(args)
+    except (RuntimeError, ValueError, OSError) as e:
+        print(f"错误: {e}", file=sys.stderr)
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
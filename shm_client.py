@@ -0,0 +1,1057 @@
+"""无界面的 Client 模块
+通过 TCP 连接 Host，远程读写共享内存；优先协商二进制协议，旧版 Host 自动退回文本协议
+
+Host 在本机时（HOST_INFO 返回的本机标识与本进程相同）直接挂载共享内存段：
+读写不经过 TCP，只在写入后发送 SYNC_UPDATE 让 Host 通知其他客户端；挂载失败时照常使用 TCP。
+"""
+import collections
+import json
+import queue
+import socket
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError, TimeoutError as FutureTimeoutError
+
+from shared_memory_utils import (
+    LAYOUT_SINGLE, LAYOUT_SLOTS, ReadOnlyError, SegmentMovedError, VersionConflictError,
+    attach_segment, has_header, host_token, open_lock, segment_layout, segment_read_only,
+    segment_redirect, segment_size, shm_patch, shm_read_bytes, shm_read_if_newer, shm_write_bytes
+)
+from shm_protocol import (
+    OP_READ, OP_WRITE, OP_SYNC_UPDATE, OP_SUBSCRIBE, OP_PATCH, OP_READ_IF_NEWER, OP_GET, OP_PUT,
+    OP_BATCH, OP_PING, OP_STATS,
+    OP_OK, OP_ERROR, OP_NOTIFY, OP_CONFLICT, OP_NOT_MODIFIED, OP_NOT_FOUND, OP_MESSAGES, OP_DELTA,
+    SUBSCRIBE_CONTENT, SUBSCRIBE_STREAM, SUBSCRIBE_DELTA,
+    FrameReader, FrameWriter, negotiate_client, unpack_notify, unpack_delta, pack_version,
+    unpack_version,
+    pack_patch, pack_put, unpack_messages, pack_batch, unpack_batch_results,
+    CODEC_NAMES, CODEC_NONE, COMPRESS_THRESHOLD, Compression, negotiate_compression,
+    query_host_token
+)
+from shm_slots import SlotTable
+
+DEFAULT_TIMEOUT = 10.0
+EXPIRE_INTERVAL = 0.2  # I/O 线程检查在途请求超时的间隔（秒）
+MAX_TEXT_RESPONSE = 1 << 30
+_STOP = object()
+_NO_VERSION = (1 << 64) - 1  # 条件读取时表示“未知版本”，Host 总是返回完整内容
+
+
+class SharedMemoryClient:
+    """远程共享内存 Client
+
+    shm_id: 期望的共享内存 ID，为 None 时不校验
+    on_notify: 收到 Host 推送时的回调 on_notify(version, content)，在接收线程中调用；
+               为 None 时不订阅推送
+    on_messages: 收到 Host 环形缓冲区消息时的回调 on_messages(messages)，messages 为按顺序排列的
+                 bytes 列表，在接收线程中调用；为 None 时不订阅（需要二进制协议）
+    on_delta: 增量订阅的回调 on_delta(base_version, version, offset, data, truncate)，在接收线程中
+              按顺序调用；base_version 为 DELTA_BASE_ANY 时为完整快照，否则是相对 base_version 内容的补丁。
+              不为 None 时以 SUBSCRIBE_DELTA 订阅（代替 on_notify），Host 不支持时连接失败（需要二进制协议）
+    on_disconnect: 连接意外断开时的回调 on_disconnect()，在接收线程中调用
+    compression: 希望使用的压缩算法（"zlib" / "lzma"，也可以是按偏好排列的列表）；
+                 None 或 "none" 时不压缩。需要二进制协议，Host 不支持时自动不压缩
+    compress_threshold: 小于该长度的请求负载不压缩
+    local: Host 在本机时是否直接挂载共享内存段读写（需要二进制协议）；False 时始终使用 TCP
+    """
+    def __init__(self, host: str, port: int, shm_id: str = None, timeout: float = DEFAULT_TIMEOUT,
+                 subscribe_mode: int = SUBSCRIBE_CONTENT, on_notify=None, on_messages=None,
+                 on_delta=None, on_disconnect=None, compression=None,
+                 compress_threshold: int = COMPRESS_THRESHOLD, local: bool = True):
+        self.host = host
+        self.port = port
+        self.shm_id = shm_id
+        self.timeout = timeout
+        self.subscribe_mode = subscribe_mode
+        self.on_notify = on_notify
+        self.on_messages = on_messages
+        self.on_delta = on_delta
+        self.on_disconnect = on_disconnect
+        self.codecs = _parse_codecs(compression)
+        self.compress_threshold = compress_threshold
+        self.codec = CODEC_NONE  # 连接上协商到的压缩算法
+        self.local = local
+        # 本机模式下挂载的 (shm, lock)：Host 扩容后整体替换，读到的段和锁总是配套的
+        self.segment = (None, None)
+        self.table = None  # 本机模式下槽位布局的 SlotTable
+        self._retired = []  # 本机模式下 Host 扩容前的旧段（关闭连接时释放）
+        self._local_lock = threading.Lock()
+        self.sock = None
+        self.reader = None
+        self.writer = None
+        self.proto = 0  # 0 = 文本协议，>0 = 协商到的二进制协议版本
+        self.subscribed = False
+        self.streaming = False
+        self.broken = False  # 接收线程发现连接意外断开
+        self.name = None
+        self.size = 0
+        self.lock_offset = 0
+        self.data_offset = 0
+        self._request_id = 0
+        self._pending = {}  # 二进制协议: request_id -> (Future, 期限)
+        self._text_pending = collections.deque()  # 文本协议: 按发送顺序排列的 (Future, 期限)
+        self._pending_lock = threading.Lock()
+        self._send_lock = threading.Lock()  # 文本协议: 保证入队顺序与发送顺序一致
+
+    @property
+    def connected(self):
+        return self.sock is not None
+
+    @property
+    def healthy(self):
+        """已连接且接收线程未发现连接断开"""
+        return self.sock is not None and not self.broken
+
+    @property
+    def shm(self):
+        """本机模式下挂载的段"""
+        return self.segment[0]
+
+    @property
+    def lock(self):
+        return self.segment[1]
+
+    @property
+    def is_local(self):
+        """是否直接读写本机的共享内存段"""
+        return self.shm is not None
+
+    @property
+    def capacity(self):
+        """远程段可存放的最大数据长度"""
+        return self.size - self.data_offset
+
+    # ---- 连接 ----
+
+    def connect(self):
+        """连接 Host、校验元数据并协商协议，返回 self"""
+        host, port = self.host, self.port
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect((host, port))
+        except socket.timeout:
+            sock.close()
+            raise RuntimeError(
+                f"连接超时！\n"
+                f"无法连接到 {host}:{port}\n\n"
+                f"请检查：\n"
+                f"1. Host IP 是否正确：{host}\n"
+                f"2. 端口号是否正确：{port}\n"
+                f"3. Host 程序是否已启动\n"
+                f"4. 防火墙是否阻止了连接"
+            )
+        except ConnectionRefusedError:
+            sock.close()
+            raise RuntimeError(
+                f"连接被拒绝！\n"
+                f"无法连接到 {host}:{port}\n\n"
+                f"请确认：\n"
+                f"1. Host 程序是否已启动\n"
+                f"2. 端口号是否正确：{port}"
+            )
+        except OSError as e:
+            sock.close()
+            raise RuntimeError(
+                f"连接失败：{e}\n\n"
+                f"请检查网络连接和 Host 状态。"
+            )
+
+        try:
+            self._handshake(sock)
+        except socket.timeout:
+            sock.close()
+            raise RuntimeError(
+                f"接收数据超时！\n"
+                f"服务器未及时响应。\n\n"
+                f"可能的原因：\n"
+                f"1. Host 程序未正确启动\n"
+                f"2. 网络延迟过大\n"
+                f"3. Host 程序崩溃或卡住\n"
+                f"4. 防火墙阻止了数据传输\n\n"
+                f"请检查 Host 程序状态，并重试。"
+            )
+        except Exception:
+            sock.close()
+            raise
+        return self
+
+    def _handshake(self, sock):
+        """接收元数据、校验 shm_id 并协商二进制协议"""
+        reader = FrameReader(sock)
+        try:
+            meta = reader.read_line()
+        except ConnectionError:
+            raise RuntimeError("服务器关闭连接，未收到完整元数据")
+        parts = meta.decode("utf-8").strip().split()
+        if len(parts) >= 2 and parts[0] == "ERROR":
+            raise RuntimeError(f"服务器错误: {' '.join(parts[1:])}")
+        if len(parts) < 6:
+            raise ValueError("无效的元数据格式")
+        name, size, start, end, lock_offset, data_offset = parts[:6]
+
+        # 验证用户输入的 shm_id 是否与服务器返回的一致
+        if self.shm_id is not None and name != self.shm_id:
+            raise ValueError(
+                f"共享内存 ID 不匹配！\n"
+                f"您输入的: {self.shm_id}\n"
+                f"服务器实际的: {name}\n"
+                f"请使用正确的共享内存 ID 重新连接。"
+            )
+        self.name = name
+        self.size = int(size)
+        self.lock_offset = int(lock_offset)
+        self.data_offset = int(data_offset)
+
+        # 协商二进制协议（旧版 Host 不回应，超时后继续使用文本协议）
+        self.proto = negotiate_client(sock, reader)
+        self.sock = sock
+        self.reader = reader
+        self.broken = False
+        self._request_id = 0
+        self._pending = {}
+        self._text_pending = collections.deque()
+        self.subscribed = False
+        self.streaming = False
+        self.codec = CODEC_NONE
+        if self.proto:
+            # 小帧（请求）立即发出
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.writer = FrameWriter(sock)
+            if self.codecs:
+                # 接收线程启动前同步协商，之后两个方向的帧都按选定的算法压缩
+                self.codec = negotiate_compression(sock, reader, self.codecs)
+                compression = Compression(self.codec, self.compress_threshold)
+                reader.compression = compression
+                self.writer.compression = compression
+            if self.local:
+                self._attach_local(sock, reader)
+        # 由接收线程读取所有响应（和推送），请求方不再直接 recv，多个请求可以同时在途
+        sock.settimeout(None)
+        threading.Thread(target=self._receive_loop, args=(sock, reader),
+                         name="shm-client-recv", daemon=True).start()
+        if self.on_delta is not None:
+            if not self.proto:
+                self.close()
+                raise RuntimeError("服务器不支持二进制协议，无法增量订阅")
+            try:
+                reply = self.request(OP_SUBSCRIBE, bytes([SUBSCRIBE_DELTA]))
+            except Exception:
+                self.close()
+                raise
+            if reply != bytes([SUBSCRIBE_DELTA]):
+                self.close()
+                raise RuntimeError("服务器不支持增量订阅")
+            self.subscribed = True
+        elif self.proto and self.on_notify is not None:
+            try:
+                self.request(OP_SUBSCRIBE, bytes([self.subscribe_mode]))
+                self.subscribed = True
+            except Exception:
+                self.subscribed = False
+        if self.on_messages is not None:
+            if not self.proto:
+                self.close()
+                raise RuntimeError("服务器不支持二进制协议，无法订阅消息流")
+            try:
+                self.request(OP_SUBSCRIBE, bytes([SUBSCRIBE_STREAM]))
+            except Exception:
+                self.close()
+                raise
+            self.streaming = True
+
+    def _attach_local(self, sock, reader):
+        """Host 在本机时挂载它的共享内存段；任何一步失败都继续使用 TCP"""
+        if query_host_token(sock, reader) != host_token():
+            return
+        try:
+            # 只挂载不拥有：不登记到 resource_tracker，本进程退出时不会删掉 Host 的段
+            shm = attach_segment(self.name, track=False)
+        except Exception:
+            return
+        lock = None
+        try:
+            layout = segment_layout(shm) if has_header(shm) else None
+            if layout == LAYOUT_SLOTS:
+                self.table = SlotTable(shm)
+            elif layout == LAYOUT_SINGLE:
+                lock = open_lock(shm, self.lock_offset)
+            else:
+                raise ValueError(f"不支持本机直接访问的段布局: {layout}")
+        except Exception:
+            self.table = None
+            shm.close()
+            return
+        self.segment = (shm, lock)
+
+    def _release_local(self):
+        segment, self.segment = self.segment, (None, None)
+        if segment[0] is None:
+            return
+        segments = self._retired + [segment]
+        if self.table is not None:
+            segments.append((None, self.table))
+        self._retired = []
+        self.table = None
+        for old_shm, lock in segments:
+            try:
+                # 只关闭本进程的句柄，段和信号量归 Host 所有，不 unlink
+                if hasattr(lock, "close"):
+                    lock.close()
+                if old_shm is not None:
+                    old_shm.close()
+            except Exception:
+                pass
+
+    def close(self):
+        """断开连接，所有在途请求以错误结束"""
+        sock, self.sock = self.sock, None
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+        self._fail_pending(RuntimeError("连接已关闭"))
+        self._release_local()
+        self.reader = None
+        self.writer = None
+        self.proto = 0
+        self.subscribed = False
+        self.streaming = False
+
+    def __enter__(self):
+        return self.connect()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    # ---- 响应分发 ----
+
+    def _receive_loop(self, sock, reader):
+        """接收线程：二进制协议按 request_id 匹配响应，文本协议按发送顺序匹配；推送交给 on_notify/on_messages"""
+        binary = self.proto > 0
+        try:
+            while True:
+                if binary:
+                    opcode, _, request_id, payload = reader.read_frame()
+                    if opcode == OP_NOTIFY:
+                        version, content = unpack_notify(payload)
+                        if self.on_notify is not None:
+                            self.on_notify(version, content)
+                        continue
+                    if opcode == OP_MESSAGES:
+                        if self.on_messages is not None:
+                            self.on_messages(unpack_messages(payload))
+                        continue
+                    if opcode == OP_DELTA:
+                        if self.on_delta is not None:
+                            self.on_delta(*unpack_delta(payload))
+                        continue
+                    with self._pending_lock:
+                        entry = self._pending.pop(request_id, None)
+                    if entry is None:
+                        continue  # 已超时请求的迟到响应
+                    future = entry[0]
+                    if opcode == OP_OK:
+                        _set_result(future, payload)
+                    elif opcode in (OP_NOT_MODIFIED, OP_NOT_FOUND):
+                        _set_result(future, None)
+                    elif opcode == OP_CONFLICT:
+                        _set_exception(future, VersionConflictError(entry[2], unpack_version(payload)))
+                    elif opcode == OP_ERROR:
+                        _set_exception(future, RuntimeError(
+                            f"服务器错误: {payload.decode('utf-8', errors='replace')}"))
+                    else:
+                        _set_exception(future, RuntimeError(f"无效的服务器响应: 操作码 {opcode}"))
+                else:
+                    line = reader.read_line(max_length=MAX_TEXT_RESPONSE)
+                    with self._pending_lock:
+                        entry = self._text_pending.popleft() if self._text_pending else None
+                    if entry is not None:
+                        _resolve_text(entry[0], line, entry[2])
+        except Exception:
+            if self.sock is sock:
+                self.broken = True
+            self._fail_pending(RuntimeError("服务器关闭连接"))
+            if self.sock is sock and self.on_disconnect is not None:
+                self.on_disconnect()
+
+    def _fail_pending(self, error):
+        with self._pending_lock:
+            entries = list(self._pending.values()) + list(self._text_pending)
+            self._pending.clear()
+            self._text_pending.clear()
+        for entry in entries:
+            _set_exception(entry[0], error)
+
+    def expire_requests(self, now: float = None):
+        """让超过期限的在途请求以 socket.timeout 结束（由调用方定期调用）"""
+        if now is None:
+            now = time.monotonic()
+        expired = []
+        with self._pending_lock:
+            for request_id, entry in list(self._pending.items()):
+                if entry[1] <= now:
+                    expired.append(self._pending.pop(request_id))
+            # 文本协议没有 request_id，超时的请求仍留在队列中占位，迟到的响应到达时再丢弃
+            expired.extend(e for e in self._text_pending if e[1] <= now)
+        for entry in expired:
+            _set_exception(entry[0], socket.timeout("等待响应超时"))
+
+    # ---- 请求 ----
+
+    def _check_connected(self):
+        if self.sock is None:
+            raise RuntimeError("未连接到服务器")
+
+    def request_async(self, opcode: int, payload=b"", timeout: float = None, flags: int = 0,
+                      expected_version: int = None):
+        """以二进制帧协议发送一个请求，不等待响应，返回 Future（结果为响应负载）"""
+        self._check_connected()
+        future = Future()
+        deadline = time.monotonic() + (self.timeout if timeout is None else timeout)
+        with self._pending_lock:
+            self._request_id = (self._request_id + 1) & 0xFFFFFFFF
+            request_id = self._request_id
+            self._pending[request_id] = (future, deadline, expected_version)
+        try:
+            self.writer.send(opcode, request_id, payload, flags)
+        except OSError as e:
+            with self._pending_lock:
+                self._pending.pop(request_id, None)
+            _set_exception(future, e)
+        return future
+
+    def _text_request_async(self, message: bytes, timeout: float = None,
+                            expected_version: int = None):
+        """以文本协议发送一个请求，不等待响应，返回 Future（结果为 OK 之后的内容）"""
+        self._check_connected()
+        future = Future()
+        deadline = time.monotonic() + (self.timeout if timeout is None else timeout)
+        # 入队和发送在同一把发送锁内完成；接收线程只需要 _pending_lock，发送大请求时不会被阻塞
+        with self._send_lock:
+            with self._pending_lock:
+                self._text_pending.append((future, deadline, expected_version))
+            try:
+                self.sock.sendall(message)
+            except OSError as e:
+                _set_exception(future, e)
+        return future
+
+    def _timeout(self, timeout):
+        return self.timeout if timeout is None else timeout
+
+    def _wait(self, future, timeout: float = None):
+        """等待 Future 完成，超时抛出 socket.timeout"""
+        if timeout is None:
+            timeout = self.timeout
+        try:
+            return future.result(timeout)
+        except FutureTimeoutError:
+            self.expire_requests()
+            raise socket.timeout("等待响应超时")
+
+    def request(self, opcode: int, payload=b"", timeout: float = None):
+        """以二进制帧协议发送一个请求并等待响应，返回响应负载"""
+        return self._wait(self.request_async(opcode, payload, timeout), timeout)
+
+    def ping(self, timeout: float = None):
+        """检查连接是否可用，连接已断开或超时时抛出 RuntimeError
+
+        二进制协议下发送 PING 并等待任意响应；文本协议没有心跳命令，只检查连接状态。
+        """
+        self._check_connected()
+        if self.proto:
+            try:
+                self._wait(self.request_async(OP_PING, timeout=timeout), timeout)
+            except socket.timeout:
+                raise RuntimeError("心跳超时：服务器未响应")
+            except OSError as e:
+                raise RuntimeError(f"连接已断开: {e}")
+            except RuntimeError:
+                # 不认识 PING 的旧版 Host 回复 ERROR，同样说明连接可用
+                if not self.healthy:
+                    raise RuntimeError("连接已断开")
+        elif not self.healthy:
+            raise RuntimeError("连接已断开")
+
+    def stats(self, timeout: float = None):
+        """查询 Host 的运行指标和连接明细（见 shm_metrics），返回 dict
+
+        本机直接访问时同样经由连接查询：返回的是 Host 进程的指标，不含本进程的读写。
+        """
+        self._check_connected()
+        try:
+            if self.proto:
+                data = self._wait(self.request_async(OP_STATS, timeout=timeout), timeout)
+            else:
+                # 文本协议: "STATS\n" -> "OK <JSON>\n"
+                data = self._wait(self._text_request_async(b"STATS\n", timeout), timeout)
+        except socket.timeout:
+            raise RuntimeError("查询超时：服务器未响应")
+        return json.loads(bytes(data).decode("utf-8"))
+
+    # ---- 本机直接访问 ----
+
+    def _local_segment(self, write: bool = False):
+        """返回本机挂载的单值布局 (shm, lock)；Host 扩容后先沿 redirect 挂载新段
+
+        write 为 True 时检查段是否可写（每次取得段都检查，扩容后的新段同样适用）。
+        """
+        self._check_connected()
+        if self.table is not None:
+            raise ValueError("段使用槽位布局，请使用 GET/PUT")
+        segment = self.segment
+        if segment_redirect(segment[0]) is not None:
+            with self._local_lock:
+                if self.segment is segment:
+                    new_shm = attach_segment(segment_redirect(segment[0]), track=False)
+                    # 旧段可能仍在其他线程的读取中使用，保留到关闭连接时再释放
+                    self._retired.append(segment)
+                    # 先打开新段的锁再一次性发布，其他线程不会拿到新段配旧锁
+                    self.segment = (new_shm, open_lock(new_shm, self.lock_offset))
+                    self.size = segment_size(new_shm)
+                segment = self.segment
+        if write:
+            self._check_writable(segment[0])
+        return segment
+
+    def _local_table(self):
+        self._check_connected()
+        if self.table is None:
+            raise ValueError("Host 未启用槽位布局")
+        return self.table
+
+    def _local_call(self, fn, *args):
+        """在调用方线程中直接执行本机操作，返回已完成的 Future"""
+        future = Future()
+        try:
+            _set_result(future, fn(*args))
+        except Exception as e:
+            _set_exception(future, e)
+        return future
+
+    def _sync_update(self):
+        """本机写入后通知 Host（由 Host 推送给订阅者并回调 on_update），不等待响应"""
+        try:
+            self.request_async(OP_SYNC_UPDATE)
+        except RuntimeError:
+            pass
+
+    def _local_read(self, timeout):
+        shm, lock = self._local_segment()
+        return shm_read_bytes(shm, lock, self.data_offset, timeout=timeout)
+
+    def _local_read_if_newer(self, since_version, timeout):
+        shm, lock = self._local_segment()
+        return shm_read_if_newer(shm, lock, since_version, self.data_offset, timeout=timeout)
+
+    def _check_writable(self, shm):
+        # 副本 Host 的段只由副本自己写入，直接写入会与上游内容不一致
+        if segment_read_only(shm):
+            raise ReadOnlyError()
+
+    def _local_write(self, data, timeout):
+        try:
+            shm, lock = self._local_segment(write=True)
+            shm_write_bytes(shm, data, lock, self.data_offset, timeout=timeout)
+        except SegmentMovedError:
+            # 写入期间 Host 扩容，改写到新段
+            shm, lock = self._local_segment(write=True)
+            shm_write_bytes(shm, data, lock, self.data_offset, timeout=timeout)
+        self._sync_update()
+        return b""
+
+    def _local_patch(self, offset, data, expected_version, truncate, timeout):
+        try:
+            shm, lock = self._local_segment(write=True)
+            version = shm_patch(shm, offset, data, lock, self.data_offset, expected_version,
+                                truncate, timeout)
+        except SegmentMovedError:
+            shm, lock = self._local_segment(write=True)
+            version = shm_patch(shm, offset, data, lock, self.data_offset, expected_version,
+                                truncate, timeout)
+        self._sync_update()
+        return version
+
+    def _local_get(self, key, timeout):
+        return self._local_table().get_bytes(key, timeout=timeout)
+
+    def _local_put(self, key, data, timeout):
+        self._check_writable(self.shm)
+        self._local_table().put_bytes(key, data, timeout=timeout)
+        self._sync_update()
+        return b""
+
+    # ---- 读写 ----
+
+    def read_bytes_async(self, timeout: float = None):
+        """发送读取请求，返回 Future（结果为远程共享内存的原始字节）"""
+        if self.shm is not None:
+            return self._local_call(self._local_read, self._timeout(timeout))
+        if self.proto:
+            return self.request_async(OP_READ, timeout=timeout)
+        # 文本协议: "READ\n" -> "OK <content>\n"
+        return self._text_request_async(b"READ\n", timeout)
+
+    def read_if_newer_async(self, since_version, timeout: float = None):
+        """条件读取，返回 Future，结果为 (版本号, 原始字节)；内容未变化时为 (since_version, None)
+
+        只有二进制协议支持；文本协议（旧版 Host）下退化为完整读取，版本号为 None。
+        """
+        if self.shm is not None:
+            return self._local_call(self._local_read_if_newer, since_version,
+                                    self._timeout(timeout))
+        future = Future()
+        if self.proto:
+            since = _NO_VERSION if since_version is None else since_version
+            inner = self.request_async(OP_READ_IF_NEWER, pack_version(since), timeout)
+        else:
+            inner = self.read_bytes_async(timeout)
+
+        def done(f):
+            try:
+                result = f.result()
+            except Exception as e:
+                _set_exception(future, e)
+                return
+            if not self.proto:
+                _set_result(future, (None, result))
+            elif result is None:
+                _set_result(future, (since_version, None))
+            else:
+                _set_result(future, unpack_notify(result))
+        inner.add_done_callback(done)
+        return future
+
+    def write_bytes_async(self, data, timeout: float = None):
+        """发送写入请求，返回 Future"""
+        if self.shm is not None:
+            return self._local_call(self._local_write, data, self._timeout(timeout))
+        if self.proto:
+            return self.request_async(OP_WRITE, data, timeout=timeout)
+        # 文本协议: "WRITE <length>\n<content>\n" -> "OK\n"
+        message = f"WRITE {len(data)}\n".encode("utf-8") + bytes(data) + b"\n"
+        return self._text_request_async(message, timeout)
+
+    def patch_async(self, offset: int, data, expected_version: int = None,
+                    truncate: bool = False, timeout: float = None):
+        """发送 PATCH 请求（在 offset 处写入 data），返回 Future（结果为写入后的版本号）
+
+        expected_version 不为 None 时为条件写入，版本不匹配时 Future 以 VersionConflictError 结束
+        """
+        if self.shm is not None:
+            return self._local_call(self._local_patch, offset, data, expected_version, truncate,
+                                    self._timeout(timeout))
+        future = Future()
+        if self.proto:
+            flags, payload = pack_patch(offset, data, expected_version, truncate)
+            inner = self.request_async(OP_PATCH, payload, timeout, flags, expected_version)
+            convert = unpack_version
+        else:
+            # 文本协议: "PATCH <offset> <length> <期望版本|-> <truncate 0|1>\n<data>\n" -> "OK <version>\n"
+            version_field = "-" if expected_version is None else str(expected_version)
+            message = (f"PATCH {offset} {len(data)} {version_field} {int(truncate)}\n".encode("utf-8")
+                       + bytes(data) + b"\n")
+            inner = self._text_request_async(message, timeout, expected_version)
+            convert = int
+
+        def done(f):
+            try:
+                _set_result(future, convert(f.result()))
+            except Exception as e:
+                _set_exception(future, e)
+        inner.add_done_callback(done)
+        return future
+
+    def patch(self, offset: int, data, expected_version: int = None, truncate: bool = False):
+        """在远程共享内存的 offset 处写入 data，返回写入后的版本号"""
+        try:
+            return self._wait(self.patch_async(offset, data, expected_version, truncate))
+        except VersionConflictError:
+            raise
+        except socket.timeout:
+            raise RuntimeError("写入超时：服务器未响应")
+        except Exception as e:
+            raise RuntimeError(f"写入失败: {e}")
+
+    def read_bytes(self):
+        """读取远程共享内存的原始字节"""
+        try:
+            return self._wait(self.read_bytes_async())
+        except socket.timeout:
+            raise RuntimeError("读取超时：服务器未响应")
+        except Exception as e:
+            raise RuntimeError(f"读取失败: {e}")
+
+    def read(self):
+        """读取远程共享内存的文本内容"""
+        return decode_text(self.read_bytes())
+
+    def write_bytes(self, data):
+        """写入原始字节到远程共享内存"""
+        try:
+            self._wait(self.write_bytes_async(data))
+        except socket.timeout:
+            raise RuntimeError("写入超时：服务器未响应")
+        except Exception as e:
+            raise RuntimeError(f"写入失败: {e}")
+
+    def write(self, text: str):
+        """写入文本到远程共享内存（去除末尾空白）"""
+        self.write_bytes(encode_text(text))
+
+    # ---- 槽位（键值） ----
+
+    def get_bytes_async(self, key, timeout: float = None):
+        """发送槽位读取请求，返回 Future（结果为原始字节，键不存在时为 None）"""
+        key = _encode_key(key)
+        if self.shm is not None:
+            return self._local_call(self._local_get, key, self._timeout(timeout))
+        if self.proto:
+            return self.request_async(OP_GET, key, timeout=timeout)
+        # 文本协议: "GET <key>\n" -> "OK <value>\n" 或 "NOT_FOUND\n"
+        return self._text_request_async(b"GET " + key + b"\n", timeout)
+
+    def put_bytes_async(self, key, data, timeout: float = None):
+        """发送槽位写入请求，返回 Future"""
+        key = _encode_key(key)
+        if self.shm is not None:
+            return self._local_call(self._local_put, key, data, self._timeout(timeout))
+        if self.proto:
+            return self.request_async(OP_PUT, pack_put(key, data), timeout=timeout)
+        # 文本协议: "PUT <key> <length>\n<value>\n" -> "OK\n"
+        message = b"PUT " + key + f" {len(data)}\n".encode("utf-8") + bytes(data) + b"\n"
+        return self._text_request_async(message, timeout)
+
+    def get_bytes(self, key):
+        """读取远程槽位的原始字节，键不存在时返回 None"""
+        try:
+            return self._wait(self.get_bytes_async(key))
+        except socket.timeout:
+            raise RuntimeError("读取超时：服务器未响应")
+        except Exception as e:
+            raise RuntimeError(f"读取失败: {e}")
+
+    def get(self, key):
+        """读取远程槽位的文本，键不存在时返回 None"""
+        data = self.get_bytes(key)
+        return None if data is None else bytes(data).decode("utf-8", errors="replace")
+
+    def put_bytes(self, key, data):
+        """写入原始字节到远程槽位（键不存在时由 Host 新建）"""
+        try:
+            self._wait(self.put_bytes_async(key, data))
+        except socket.timeout:
+            raise RuntimeError("写入超时：服务器未响应")
+        except Exception as e:
+            raise RuntimeError(f"写入失败: {e}")
+
+    def put(self, key, value: str):
+        """写入文本到远程槽位"""
+        self.put_bytes(key, value.encode("utf-8"))
+
+    # ---- 批量 ----
+
+    def batch(self):
+        """创建批量请求，收集多个操作后一次发送（见 RequestBatch）"""
+        return RequestBatch(self)
+
+
+def _ignore_result(_):
+    return None
+
+
+def _identity(result):
+    return result
+
+
+class RequestBatch:
+    """批量请求：收集多个读写操作，二进制协议下打包为一个 BATCH 帧，一次往返取回所有结果
+
+    Host 按顺序执行各项操作，每项各自原子，整个批量不是一个事务。
+    文本协议（旧版 Host）下退化为流水线：逐个发送、不等待响应，同样只需要约一次往返；
+    本机直接访问时逐个在调用方线程中执行。
+    execute() 返回与操作顺序一致的结果列表；失败的操作在对应位置是异常对象
+    （VersionConflictError / RuntimeError），不影响其他操作。
+    """
+    def __init__(self, client: SharedMemoryClient):
+        self.client = client
+        self._ops = []  # (opcode, flags, payload, 结果转换, 期望版本, 文本协议下的发送函数)
+
+    def __len__(self):
+        return len(self._ops)
+
+    def _add(self, opcode, payload, convert, fallback, flags=0, expected_version=None):
+        self._ops.append((opcode, flags, payload, convert, expected_version, fallback))
+        return self
+
+    def read_bytes(self):
+        """读取单值内容，结果为原始字节"""
+        return self._add(OP_READ, b"", _identity, self.client.read_bytes_async)
+
+    def write_bytes(self, data):
+        """写入原始字节，结果为 None"""
+        return self._add(OP_WRITE, bytes(data), _ignore_result,
+                         lambda timeout: self.client.write_bytes_async(data, timeout))
+
+    def write(self, text: str):
+        """写入文本（去除末尾空白），结果为 None"""
+        return self.write_bytes(encode_text(text))
+
+    def patch(self, offset: int, data, expected_version: int = None, truncate: bool = False):
+        """在 offset 处写入 data，结果为写入后的版本号"""
+        flags, payload = pack_patch(offset, data, expected_version, truncate)
+        return self._add(OP_PATCH, payload, unpack_version,
+                         lambda timeout: self.client.patch_async(
+                             offset, data, expected_version, truncate, timeout),
+                         flags, expected_version)
+
+    def get_bytes(self, key):
+        """读取槽位，结果为原始字节，键不存在时为 None"""
+        key = _encode_key(key)
+        return self._add(OP_GET, key, _identity,
+                         lambda timeout: self.client.get_bytes_async(key, timeout))
+
+    def put_bytes(self, key, data):
+        """写入槽位，结果为 None"""
+        key = _encode_key(key)
+        return self._add(OP_PUT, pack_put(key, data), _ignore_result,
+                         lambda timeout: self.client.put_bytes_async(key, data, timeout))
+
+    def execute_async(self, timeout: float = None):
+        """发送所有操作，返回 Future（结果为结果列表）"""
+        ops = self._ops
+        future = Future()
+        if not ops:
+            _set_result(future, [])
+            return future
+        if not self.client.proto or self.client.is_local:
+            # 文本协议（和本机访问）的各请求已按类型解析好结果，只需丢弃写入的 "OK" 负载
+            return _gather([op[5](timeout) for op in ops],
+                           [_ignore_result if op[3] is _ignore_result else _identity for op in ops])
+        inner = self.client.request_async(
+            OP_BATCH, pack_batch([(opcode, flags, payload) for opcode, flags, payload, *_ in ops]),
+            timeout)
+
+        def done(f):
+            try:
+                replies = unpack_batch_results(f.result())
+                if len(replies) != len(ops):
+                    raise RuntimeError(f"批量响应数量不匹配: {len(replies)} != {len(ops)}")
+            except Exception as e:
+                _set_exception(future, e)
+                return
+            _set_result(future, [_batch_result(op, reply) for op, reply in zip(ops, replies)])
+        inner.add_done_callback(done)
+        return future
+
+    def execute(self, timeout: float = None):
+        """发送所有操作并等待，返回结果列表"""
+        try:
+            return self.client._wait(self.execute_async(timeout), timeout)
+        except socket.timeout:
+            raise RuntimeError("批量请求超时：服务器未响应")
+        except Exception as e:
+            raise RuntimeError(f"批量请求失败: {e}")
+
+
+def _batch_result(op, reply):
+    """把 BATCH 响应中的一项转换为结果（失败时为异常对象）"""
+    _, _, _, convert, expected_version, _ = op
+    opcode, payload = reply
+    try:
+        if opcode == OP_OK:
+            return convert(payload)
+        if opcode == OP_NOT_FOUND:
+            return None
+        if opcode == OP_CONFLICT:
+            return VersionConflictError(expected_version, unpack_version(payload))
+        if opcode == OP_ERROR:
+            return RuntimeError(f"服务器错误: {payload.decode('utf-8', errors='replace')}")
+        return RuntimeError(f"无效的服务器响应: 操作码 {opcode}")
+    except Exception as e:
+        return e
+
+
+def _gather(futures, converts):
+    """合并多个 Future：全部完成后以结果列表结束，失败的位置为异常对象"""
+    future = Future()
+    results = [None] * len(futures)
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def make_done(i):
+        def done(f):
+            try:
+                results[i] = converts[i](f.result())
+            except Exception as e:
+                results[i] = e
+            with lock:
+                remaining[0] -= 1
+                finished = remaining[0] == 0
+            if finished:
+                _set_result(future, results)
+        return done
+
+    for i, f in enumerate(futures):
+        f.add_done_callback(make_done(i))
+    return future
+
+
+def _parse_codecs(compression):
+    """把压缩算法名（或名称列表）转换为按偏好排列的算法 ID 元组"""
+    if compression is None:
+        return ()
+    names = [compression] if isinstance(compression, str) else list(compression)
+    codecs = []
+    for name in names:
+        if name not in CODEC_NAMES:
+            raise ValueError(f"未知的压缩算法: {name}（可选: {', '.join(CODEC_NAMES)}）")
+        if CODEC_NAMES[name] != CODEC_NONE:
+            codecs.append(CODEC_NAMES[name])
+    return tuple(codecs)
+
+
+def encode_text(text: str):
+    return text.rstrip().encode("utf-8")
+
+
+def decode_text(data):
+    return bytes(data).rstrip(b"\x00").decode("utf-8", errors="replace")
+
+
+def _encode_key(key):
+    """槽位键编码为字节；文本协议以空白分隔字段，键中不能含空白"""
+    data = key.encode("utf-8") if isinstance(key, str) else bytes(key)
+    if not data or len(data.split()) != 1 or data.strip() != data:
+        raise ValueError(f"无效的键: {key!r}")
+    return data
+
+
+def _set_result(future, result):
+    try:
+        future.set_result(result)
+    except InvalidStateError:
+        pass  # 等待方已取消
+
+
+def _set_exception(future, error):
+    try:
+        future.set_exception(error)
+    except InvalidStateError:
+        pass
+
+
+def _resolve_text(future, line: bytes, expected_version: int = None):
+    """解析文本响应（"OK [content]"、"NOT_FOUND"、"CONFLICT <version>" 或 "ERROR <message>"）"""
+    response_str = line.decode("utf-8", errors="replace").rstrip("\n")
+    if response_str == "OK":
+        _set_result(future, b"")
+    elif response_str == "NOT_FOUND":
+        _set_result(future, None)
+    elif response_str.startswith("OK "):
+        _set_result(future, response_str[3:].encode("utf-8"))
+    elif response_str.startswith("CONFLICT "):
+        _set_exception(future, VersionConflictError(expected_version, int(response_str[9:])))
+    elif response_str.startswith("ERROR "):
+        _set_exception(future, RuntimeError(f"服务器错误: {response_str[6:]}"))
+    else:
+        _set_exception(future, RuntimeError(f"无效的服务器响应: {response_str}"))
+
+
+class ClientWorker:
+    """后台 I/O 线程：独占一个 SharedMemoryClient 的连接，调用方线程（如 Tk 主线程）永不阻塞
+
+    所有操作立即返回，完成后以 on_done(result, error) 回调通知；回调通过 deliver(fn)
+    交回调用方线程执行（Tk 中传入 lambda fn: root.after(0, fn)）。
+    请求以流水线方式发送：刷新读取不会等待在途的写入，反之亦然。
+    """
+    def __init__(self, client: SharedMemoryClient, deliver):
+        self.client = client
+        self.deliver = deliver
+        self.jobs = queue.Queue()
+        self.thread = None
+        self._reads_in_flight = 0
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="shm-client-io", daemon=True)
+        self.thread.start()
+        return self
+
+    def _run(self):
+        while True:
+            try:
+                job = self.jobs.get(timeout=EXPIRE_INTERVAL)
+            except queue.Empty:
+                job = None
+            self.client.expire_requests()
+            if job is None:
+                continue
+            if job is _STOP:
+                break
+            fn, on_done = job
+            try:
+                result = fn()
+            except Exception as e:
+                self._finish(on_done, None, e)
+                continue
+            if isinstance(result, Future):
+                # 不等待响应，由接收线程完成 Future 后回调
+                result.add_done_callback(lambda f, cb=on_done: self._finish_future(cb, f))
+            else:
+                self._finish(on_done, result, None)
+        self.client.close()
+
+    def _finish(self, on_done, result, error):
+        if on_done is not None:
+            self.deliver(lambda: on_done(result, error))
+
+    def _finish_future(self, on_done, future):
+        try:
+            self._finish(on_done, future.result(), None)
+        except Exception as e:
+            self._finish(on_done, None, e)
+
+    def submit(self, fn, on_done=None):
+        """在 I/O 线程中执行 fn()；fn 返回 Future 时在其完成后回调"""
+        self.jobs.put((fn, on_done))
+
+    def connect(self, on_done=None):
+        self.submit(self.client.connect, on_done)
+
+    def write(self, text: str, on_done=None):
+        self.submit(lambda: self.client.write_bytes_async(encode_text(text)), on_done)
+
+    def patch(self, offset: int, data, expected_version: int = None, truncate: bool = False,
+              on_done=None):
+        """在 offset 处写入 data；on_done 的结果为写入后的版本号"""
+        self.submit(lambda: self.client.patch_async(offset, data, expected_version, truncate), on_done)
+
+    def _read(self, fn, convert, on_done):
+        """提交读取；已有读取在途时不再发送新的读取，返回 False"""
+        if self._reads_in_flight:
+            return False
+        self._reads_in_flight += 1
+
+        def done(result, error):
+            self._reads_in_flight -= 1
+            if on_done is not None:
+                on_done(convert(result) if error is None else None, error)
+        self.submit(fn, done)
+        return True
+
+    def read(self, on_done=None):
+        """读取文本内容"""
+        return self._read(self.client.read_bytes_async, decode_text, on_done)
+
+    def read_if_newer(self, since_version, on_done=None):
+        """条件读取；on_done 的结果为 (版本号, 文本)，内容未变化时文本为 None"""
+        return self._read(lambda: self.client.read_if_newer_async(since_version),
+                          lambda r: (r[0], None if r[1] is None else decode_text(r[1])), on_done)
+
+    def close(self):
+        """关闭连接并结束 I/O 线程（不等待）"""
+        self.jobs.put(_STOP)
@@ -0,0 +1,495 @@
+"""共享内存哈希表模块
+整个哈希表存放在一个共享内存段中，同一台机器上的任何进程挂载段后即可 O(1) 查找，
+无需经过 TCP，也不需要复制整个数据集
+
+哈希表按哈希值的低位分成若干分段（stripe），每个分段是一张独立的开放寻址（线性探测）子表，
+有自己的锁字和 seqlock 计数器：写者只锁定键所在的分段，读者不加锁，乐观读取后校验该分段的计数器。
+
+段布局（段头与单值布局相同，LAYOUT_OFFSET 处记为 LAYOUT_HASHMAP）:
+    偏移            大小                     内容
+    0               64                       段头（见 shared_memory_utils）
+    64              4                        bucket_count   桶总数（2 的幂）
+    68              4                        stripe_count   分段数（2 的幂）
+    72              4                        key_size       键的最大长度
+    76              4                        value_size     值的最大长度
+    80              4                        max_load       最大负载因子（百分比）
+    128             64 * stripe_count        分段头（每个分段独占一个缓存行，避免伪共享）
+    ...             bucket_size * buckets    桶
+
+分段头（64 字节）:
+    0     8     seq         序列计数器
+    8     4     lock_word   锁字
+    12    4     count       已使用的桶数
+    16    4     tombstones  已删除（墓碑）的桶数
+
+桶（bucket_size = 16 + key_size + value_size，8 字节对齐）:
+    0     1     state       0=空, 1=使用中, 2=已删除
+    2     2     key_len
+    4     4     value_len
+    8     4     hash        键的 CRC32
+    16    ...   key         键
+    ...   ...   value       值（从 16 + key_size 开始）
+"""
+import math
+import struct
+import threading
+import time
+import zlib
+from multiprocessing import shared_memory
+
+from shared_memory_utils import (
+    HEADER_SIZE, LAYOUT_OFFSET, LAYOUT_HASHMAP, LOCK_KIND_SPIN, MIN_SEGMENT_SIZE,
+    SEQLOCK_READ_RETRIES, SegmentMovedError, _read_locked,
+    create_segment, segment_size, segment_layout, segment_lock_kind, segment_generation,
+    segment_redirect, publish_redirect, attach_segment, open_lock
+)
+
+TABLE_OFFSET = HEADER_SIZE
+TABLE_FMT = "<IIIII"
+STRIPE_OFFSET = 128
+STRIPE_SIZE = 64
+STRIPE_SEQ = 0
+STRIPE_LOCK = 8
+STRIPE_STATS = 12
+STRIPE_STATS_FMT = "<II"
+
+BUCKET_FMT = "<BxHII4x"
+BUCKET_HEADER_SIZE = struct.calcsize(BUCKET_FMT)
+BUCKET_EMPTY = 0
+BUCKET_USED = 1
+BUCKET_DELETED = 2
+
+DEFAULT_KEY_SIZE = 32
+DEFAULT_VALUE_SIZE = 64
+DEFAULT_STRIPES = 16
+DEFAULT_MAX_LOAD = 0.75
+
+
+class HashMapFullError(RuntimeError):
+    """键所在的分段已达到最大负载因子，需要 rehash 到更大的段"""
+    def __init__(self, stripe: int, count: int):
+        super().__init__(f"哈希表已满: 分段 {stripe} 已有 {count} 个条目")
+        self.stripe = stripe
+        self.count = count
+
+
+def _align8(n: int):
+    return (n + 7) & ~7
+
+
+def _next_pow2(n: int):
+    return 1 << max(0, int(n) - 1).bit_length()
+
+
+def _bucket_size(key_size: int, value_size: int):
+    return _align8(BUCKET_HEADER_SIZE + key_size + value_size)
+
+
+def _bucket_base(stripe_count: int):
+    return STRIPE_OFFSET + stripe_count * STRIPE_SIZE
+
+
+def hashmap_geometry(capacity: int, key_size: int = DEFAULT_KEY_SIZE,
+                     value_size: int = DEFAULT_VALUE_SIZE, stripes: int = DEFAULT_STRIPES,
+                     max_load: float = DEFAULT_MAX_LOAD):
+    """计算容纳 capacity 个条目所需的 (bucket_count, stripe_count, 段大小)"""
+    if capacity <= 0:
+        raise ValueError(f"容量必须大于 0: {capacity}")
+    if not 0 < max_load < 1:
+        raise ValueError(f"最大负载因子必须在 (0, 1) 之间: {max_load}")
+    if key_size <= 0 or key_size > 0xFFFF or value_size < 0:
+        raise ValueError(f"无效的键/值大小: {key_size}/{value_size}")
+    stripe_count = _next_pow2(max(1, stripes))
+    bucket_count = max(_next_pow2(math.ceil(capacity / max_load)), stripe_count)
+    size = _bucket_base(stripe_count) + bucket_count * _bucket_size(key_size, value_size)
+    # 小表也不能小于段的最小大小，多出的部分不使用
+    return bucket_count, stripe_count, max(size, MIN_SEGMENT_SIZE)
+
+
+def init_hashmap(shm: shared_memory.SharedMemory, bucket_count: int, stripe_count: int,
+                 key_size: int = DEFAULT_KEY_SIZE, value_size: int = DEFAULT_VALUE_SIZE,
+                 max_load: float = DEFAULT_MAX_LOAD):
+    """在已初始化段头的段上建立哈希表布局（bucket_count、stripe_count 为 2 的幂）"""
+    end = _bucket_base(stripe_count) + bucket_count * _bucket_size(key_size, value_size)
+    if end > segment_size(shm):
+        raise ValueError(f"段大小不足以容纳哈希表: {end} > {segment_size(shm)} bytes")
+    buf = shm.buf
+    buf[TABLE_OFFSET:end] = bytes(end - TABLE_OFFSET)
+    struct.pack_into(TABLE_FMT, buf, TABLE_OFFSET, bucket_count, stripe_count, key_size,
+                     value_size, int(round(max_load * 100)))
+    buf[LAYOUT_OFFSET] = LAYOUT_HASHMAP
+
+
+def create_hashmap_segment(capacity: int, key_size: int = DEFAULT_KEY_SIZE,
+                           value_size: int = DEFAULT_VALUE_SIZE, stripes: int = DEFAULT_STRIPES,
+                           max_load: float = DEFAULT_MAX_LOAD, lock_kind: int = LOCK_KIND_SPIN,
+                           generation: int = 0):
+    """创建能容纳 capacity 个条目的哈希表段"""
+    bucket_count, stripe_count, size = hashmap_geometry(capacity, key_size, value_size,
+                                                        stripes, max_load)
+    shm = create_segment(size, generation, lock_kind)
+    try:
+        init_hashmap(shm, bucket_count, stripe_count, key_size, value_size, max_load)
+    except Exception:
+        shm.close()
+        shm.unlink()
+        raise
+    return shm
+
+
+class _MapSegment:
+    """一个哈希表段在本进程中的视图（几何参数和各分段的锁）
+
+    rehash/迁移时整体替换，正在进行的操作继续使用旧视图，不会看到一半新一半旧的参数。
+    """
+    def __init__(self, shm: shared_memory.SharedMemory):
+        if segment_layout(shm) != LAYOUT_HASHMAP:
+            raise ValueError("段未使用哈希表布局")
+        self.shm = shm
+        (self.bucket_count, self.stripe_count, self.key_size, self.value_size,
+         max_load) = struct.unpack_from(TABLE_FMT, shm.buf, TABLE_OFFSET)
+        self.max_load = max_load / 100.0
+        self.per_stripe = self.bucket_count // self.stripe_count
+        self.stripe_bits = self.stripe_count.bit_length() - 1
+        self.stripe_limit = max(1, int(self.per_stripe * self.max_load))
+        self.bucket_size = _bucket_size(self.key_size, self.value_size)
+        self.bucket_base = _bucket_base(self.stripe_count)
+        self.locks = []
+        for i in range(self.stripe_count):
+            stripe = STRIPE_OFFSET + i * STRIPE_SIZE
+            self.locks.append(open_lock(shm, stripe + STRIPE_LOCK, stripe + STRIPE_SEQ))
+
+    def bucket(self, stripe: int, index: int):
+        return self.bucket_base + (stripe * self.per_stripe + index) * self.bucket_size
+
+    def state(self, stripe: int, index: int):
+        return self.shm.buf[self.bucket(stripe, index)]
+
+    def stats(self, stripe: int):
+        """返回分段的 (count, tombstones)"""
+        return struct.unpack_from(STRIPE_STATS_FMT, self.shm.buf,
+                                  STRIPE_OFFSET + stripe * STRIPE_SIZE + STRIPE_STATS)
+
+    def set_stats(self, stripe: int, count: int, tombstones: int):
+        struct.pack_into(STRIPE_STATS_FMT, self.shm.buf,
+                         STRIPE_OFFSET + stripe * STRIPE_SIZE + STRIPE_STATS, count, tombstones)
+
+    def probe(self, stripe: int, key: bytes, h: int):
+        """线性探测，返回 (键所在的桶序号或 None, 第一个可写入的桶序号或 None)
+
+        读者不加锁调用时可能读到写入一半的桶，这里只做有界的读取，结果由 seqlock 校验丢弃。
+        """
+        buf = self.shm.buf
+        mask = self.per_stripe - 1
+        index = (h >> self.stripe_bits) & mask
+        free = None
+        for _ in range(self.per_stripe):
+            off = self.bucket(stripe, index)
+            state, key_len, _, bucket_hash = struct.unpack_from(BUCKET_FMT, buf, off)
+            if state == BUCKET_EMPTY:
+                return None, index if free is None else free
+            if state == BUCKET_DELETED:
+                if free is None:
+                    free = index
+            elif bucket_hash == h and key_len == len(key):
+                key_start = off + BUCKET_HEADER_SIZE
+                if buf[key_start:key_start+key_len] == key:
+                    return index, free
+            index = (index + 1) & mask
+        return None, free
+
+    def value(self, stripe: int, index: int):
+        off = self.bucket(stripe, index)
+        (value_len,) = struct.unpack_from("<I", self.shm.buf, off + 4)
+        start = off + BUCKET_HEADER_SIZE + self.key_size
+        return bytes(self.shm.buf[start:start+min(value_len, self.value_size)])
+
+    def store(self, stripe: int, index: int, key: bytes, h: int, value):
+        """写入整个桶（调用方持有分段锁）"""
+        buf = self.shm.buf
+        off = self.bucket(stripe, index)
+        key_start = off + BUCKET_HEADER_SIZE
+        value_start = key_start + self.key_size
+        buf[key_start:key_start+len(key)] = key
+        buf[value_start:value_start+len(value)] = value
+        struct.pack_into(BUCKET_FMT, buf, off, BUCKET_USED, len(key), len(value), h)
+
+    def entries(self, stripe: int):
+        """遍历分段中使用中的桶，产生 (key, hash, value)"""
+        buf = self.shm.buf
+        for index in range(self.per_stripe):
+            off = self.bucket(stripe, index)
+            state, key_len, _, h = struct.unpack_from(BUCKET_FMT, buf, off)
+            if state == BUCKET_USED:
+                key_start = off + BUCKET_HEADER_SIZE
+                yield bytes(buf[key_start:key_start+key_len]), h, self.value(stripe, index)
+
+    def insert_new(self, key: bytes, h: int, value):
+        """在未发布的段中插入（rehash 时使用，不加锁），调用方保证键不重复"""
+        stripe = h & (self.stripe_count - 1)
+        count, tombstones = self.stats(stripe)
+        if count + 1 > self.stripe_limit:
+            raise HashMapFullError(stripe, count)
+        _, index = self.probe(stripe, key, h)
+        self.store(stripe, index, key, h, value)
+        self.set_stats(stripe, count + 1, tombstones)
+
+    def close_locks(self):
+        for lock in self.locks:
+            if hasattr(lock, "close"):
+                lock.close()
+
+
+class SharedHashMap:
+    """共享内存中的定容哈希表（开放寻址 + 分段锁）
+
+    - get 不加锁，通过键所在分段的 seqlock 乐观读取；写入只锁定一个分段
+    - 分段达到最大负载因子时 put 抛出 HashMapFullError；auto_rehash=True 时
+      自动 rehash 到容量翻倍的新段后重试
+    - rehash 在旧段头中发布 redirect，其他进程在下一次操作时自动迁移到新段；
+      旧段保留在 retired_segments 中，直到 close()/unlink()。新段归调用 rehash 的进程所有，
+      因此 rehash（和 auto_rehash）应只在创建哈希表的进程中使用
+    """
+    def __init__(self, shm: shared_memory.SharedMemory, auto_rehash: bool = False):
+        self.auto_rehash = auto_rehash
+        self.retired_segments = []  # rehash/迁移前的 _MapSegment
+        self._seg = _MapSegment(shm)
+        self._rebind_lock = threading.Lock()
+
+    @classmethod
+    def attach(cls, name: str, auto_rehash: bool = False):
+        """按名称挂载哈希表段（沿 redirect 迁移到最新的段）
+
+        挂载的段不登记到本进程的 resource_tracker，本进程退出时不会删掉创建者的段。
+        """
+        return cls(attach_segment(name, track=False), auto_rehash)
+
+    @property
+    def shm(self):
+        return self._seg.shm
+
+    @property
+    def capacity(self):
+        """不触发 HashMapFullError 时最多可保证容纳的条目数"""
+        seg = self._seg
+        return seg.stripe_limit * seg.stripe_count
+
+    def _encode_key(self, key):
+        data = key.encode("utf-8") if isinstance(key, str) else bytes(key)
+        if not data:
+            raise ValueError("键不能为空")
+        if len(data) > self._seg.key_size:
+            raise ValueError(f"键太长: {len(data)} > {self._seg.key_size} bytes")
+        return data
+
+    def _current(self):
+        """返回当前段的视图；段已被其他进程 rehash 时先迁移到新段"""
+        seg = self._seg
+        if segment_redirect(seg.shm) is None:
+            return seg
+        with self._rebind_lock:
+            if self._seg is seg:
+                self.retired_segments.append(seg)
+                self._seg = _MapSegment(attach_segment(seg.shm.name, track=False))
+            return self._seg
+
+    # ---- 读取 ----
+
+    def get_bytes(self, key, timeout: float = 5.0):
+        """读取键对应的原始字节，键不存在时返回 None"""
+        key = self._encode_key(key)
+        h = zlib.crc32(key)
+        seg = self._current()
+        stripe = h & (seg.stripe_count - 1)
+        lock = seg.locks[stripe]
+        seqlock = lock.seqlock
+        for _ in range(SEQLOCK_READ_RETRIES):
+            start = seqlock.read_begin()
+            if start is None:
+                time.sleep(0)
+                continue
+            index, _ = seg.probe(stripe, key, h)
+            result = None if index is None else seg.value(stripe, index)
+            if seqlock.read_validate(start):
+                return result
+        # 写入非常频繁时退化为加锁读取
+        acquire, release = _read_locked(lock)
+        acquire(timeout)
+        try:
+            index, _ = seg.probe(stripe, key, h)
+            return None if index is None else seg.value(stripe, index)
+        finally:
+            release()
+
+    def get(self, key, timeout: float = 5.0):
+        """读取键对应的文本，键不存在时返回 None"""
+        data = self.get_bytes(key, timeout)
+        return None if data is None else data.decode("utf-8", errors="replace")
+
+    def __contains__(self, key):
+        return self.get_bytes(key) is not None
+
+    # ---- 写入 ----
+
+    def _locked_update(self, key, fn, timeout):
+        """锁定键所在的分段后调用 fn(seg, stripe, key, h)；段在此期间被 rehash 时迁移后重试"""
+        key = self._encode_key(key)
+        h = zlib.crc32(key)
+        while True:
+            seg = self._current()
+            stripe = h & (seg.stripe_count - 1)
+            lock = seg.locks[stripe]
+            lock.acquire(timeout)
+            try:
+                if segment_redirect(seg.shm) is not None:
+                    continue
+                lock.seqlock.write_begin()
+                try:
+                    return fn(seg, stripe, key, h)
+                finally:
+                    lock.seqlock.write_end()
+            finally:
+                lock.release()
+
+    def put_bytes(self, key, value, timeout: float = 5.0):
+        """写入键对应的原始字节（键不存在时插入）"""
+        if len(value) > self._seg.value_size:
+            raise ValueError(f"值太长: {len(value)} > {self._seg.value_size} bytes")
+
+        def put(seg, stripe, key, h):
+            index, free = seg.probe(stripe, key, h)
+            if index is not None:
+                seg.store(stripe, index, key, h, value)
+                return
+            count, tombstones = seg.stats(stripe)
+            if count + 1 > seg.stripe_limit:
+                raise HashMapFullError(stripe, count)
+            if free is None or count + tombstones + 1 > seg.stripe_limit:
+                # 墓碑过多，探测链变长：原地整理分段后重新探测
+                self._compact(seg, stripe)
+                tombstones = 0
+                _, free = seg.probe(stripe, key, h)
+            elif seg.state(stripe, free) == BUCKET_DELETED:
+                tombstones -= 1
+            seg.store(stripe, free, key, h, value)
+            seg.set_stats(stripe, count + 1, tombstones)
+
+        while True:
+            try:
+                return self._locked_update(key, put, timeout)
+            except HashMapFullError:
+                if not self.auto_rehash:
+                    raise
+                self.rehash()
+
+    def put(self, key, value: str, timeout: float = 5.0):
+        """写入键对应的文本"""
+        self.put_bytes(key, value.encode("utf-8"), timeout)
+
+    def delete(self, key, timeout: float = 5.0):
+        """删除键，返回键是否存在"""
+        def delete(seg, stripe, key, h):
+            index, _ = seg.probe(stripe, key, h)
+            if index is None:
+                return False
+            count, tombstones = seg.stats(stripe)
+            # 下一个桶为空时不需要墓碑，没有探测链经过这个桶
+            next_index = (index + 1) & (seg.per_stripe - 1)
+            if seg.state(stripe, next_index) == BUCKET_EMPTY:
+                state = BUCKET_EMPTY
+            else:
+                state = BUCKET_DELETED
+                tombstones += 1
+            seg.shm.buf[seg.bucket(stripe, index)] = state
+            seg.set_stats(stripe, count - 1, tombstones)
+            return True
+
+        return self._locked_update(key, delete, timeout)
+
+    def _compact(self, seg, stripe):
+        """清除分段中的墓碑并重新插入所有条目（调用方持有分段锁并已开始 seqlock 写入）"""
+        entries = list(seg.entries(stripe))
+        start = seg.bucket(stripe, 0)
+        seg.shm.buf[start:start+seg.per_stripe*seg.bucket_size] = bytes(
+            seg.per_stripe * seg.bucket_size)
+        for key, h, value in entries:
+            _, index = seg.probe(stripe, key, h)
+            seg.store(stripe, index, key, h, value)
+        seg.set_stats(stripe, len(entries), 0)
+
+    # ---- 统计与 rehash ----
+
+    def stats(self):
+        """负载统计（不加锁，各分段的计数可能来自不同时刻）"""
+        seg = self._current()
+        counts = [seg.stats(i) for i in range(seg.stripe_count)]
+        count = sum(c for c, _ in counts)
+        return {
+            "buckets": seg.bucket_count,
+            "stripes": seg.stripe_count,
+            "capacity": seg.stripe_limit * seg.stripe_count,
+            "count": count,
+            "tombstones": sum(t for _, t in counts),
+            "load_factor": count / seg.bucket_count,
+            "max_stripe_load": max(c for c, _ in counts) / seg.per_stripe,
+            "max_load": seg.max_load,
+            "generation": segment_generation(seg.shm),
+        }
+
+    def __len__(self):
+        seg = self._current()
+        return sum(seg.stats(i)[0] for i in range(seg.stripe_count))
+
+    def rehash(self, capacity: int = None, timeout: float = 5.0):
+        """把所有条目迁移到新段（默认容量翻倍），在旧段头中发布 redirect，返回新段
+
+        迁移期间持有旧段的全部分段锁，写者等待迁移完成后自动写入新段；
+        读者在迁移期间仍可读取旧段（内容已冻结）。
+        """
+        seg = self._current()
+        if capacity is None:
+            capacity = 2 * seg.stripe_limit * seg.stripe_count
+        acquired = []
+        try:
+            for lock in seg.locks:
+                lock.acquire(timeout)
+                acquired.append(lock)
+            new_name = segment_redirect(seg.shm)
+            if new_name is not None:
+                raise SegmentMovedError(new_name)
+            new_shm = create_hashmap_segment(
+                capacity, seg.key_size, seg.value_size, seg.stripe_count, seg.max_load,
+                segment_lock_kind(seg.shm), segment_generation(seg.shm) + 1)
+            try:
+                new_seg = _MapSegment(new_shm)
+                for stripe in range(seg.stripe_count):
+                    for key, h, value in seg.entries(stripe):
+                        new_seg.insert_new(key, h, value)
+                publish_redirect(seg.shm, new_shm)
+            except Exception:
+                new_shm.close()
+                new_shm.unlink()
+                raise
+        finally:
+            for lock in reversed(acquired):
+                lock.release()
+        with self._rebind_lock:
+            self.retired_segments.append(seg)
+            self._seg = new_seg
+        return new_shm
+
+    # ---- 生命周期 ----
+
+    def close(self):
+        """关闭本进程对当前段和旧段的映射"""
+        for seg in self.retired_segments + [self._seg]:
+            seg.close_locks()
+            seg.shm.close()
+
+    def unlink(self):
+        """销毁当前段和旧段（以及信号量锁），由创建哈希表的进程在最后调用"""
+        for seg in self.retired_segments + [self._seg]:
+            for lock in seg.locks:
+                if hasattr(lock, "unlink"):
+                    lock.unlink()
+            seg.shm.unlink()
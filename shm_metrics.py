@@ -0,0 +1,293 @@
+"""运行指标模块
+进程内的计数器、仪表和延迟直方图，用于在生产环境中定位锁竞争和慢请求：
+- 锁：获取等待时间、超时次数、排他持有时间（按锁类型）
+- 段读写：shm_write/shm_patch/shm_read 的次数、字节数、耗时，seqlock 退化为加锁读取的次数
+- TCP：命令数（按操作码）、收发字节数、错误数、当前连接数（每个连接的明细见 Host 的 STATS）
+
+默认关闭，关闭时热路径只多一次属性检查；enable() 后开始记录。指标按进程统计：
+本机直接访问共享内存的 Client 进程在自己的进程内统计，不计入 Host。
+
+导出方式：snapshot() 返回 dict（STATS 命令的 JSON 负载），render_prometheus() 返回
+Prometheus 文本格式，MetricsServer 在本机提供 HTTP 端点（GET /metrics、GET /stats）。
+"""
+import bisect
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 直方图桶上界（秒），1-2-5 序列覆盖 1 微秒 ~ 10 秒
+DEFAULT_BUCKETS = tuple(m * 10.0 ** e for e in range(-6, 1) for m in (1, 2, 5)) + (10.0,)
+METRICS_HOST = "127.0.0.1"
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Counter:
+    """单调递增的计数器，labels 为按 label_names 顺序排列的值元组"""
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, label_names=()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(label_names)
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def get(self, labels=()):
+        return self.values.get(labels, 0)
+
+    def reset(self):
+        with self._lock:
+            self.values.clear()
+
+    def samples(self):
+        """返回 [(labels, value)]"""
+        with self._lock:
+            return list(self.values.items())
+
+
+class Gauge(Counter):
+    """可增可减的仪表（如当前连接数）"""
+    kind = "gauge"
+
+    def set(self, value, labels=()):
+        with self._lock:
+            self.values[labels] = value
+
+
+class Histogram:
+    """固定桶的直方图；分位数按桶上界估算（误差不超过一个桶）"""
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self.series = {}  # labels -> [各桶计数（最后一个为 +Inf）, 总和, 最大值]
+        self._lock = threading.Lock()
+
+    def observe(self, value, labels=()):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0.0]
+            series[0][index] += 1
+            series[1] += value
+            if value > series[2]:
+                series[2] = value
+
+    def reset(self):
+        with self._lock:
+            self.series.clear()
+
+    def samples(self):
+        """返回 [(labels, 各桶计数, 总和, 最大值)]"""
+        with self._lock:
+            return [(labels, list(s[0]), s[1], s[2]) for labels, s in self.series.items()]
+
+    def quantile(self, counts, q: float):
+        """按桶计数估算分位数（返回所在桶的上界，落在 +Inf 桶时返回最后一个上界）"""
+        total = sum(counts)
+        if total == 0:
+            return 0.0
+        rank = q * total
+        seen = 0
+        for bound, n in zip(self.buckets, counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return self.buckets[-1]
+
+
+class Metrics:
+    """进程内的指标集合（见模块全局的 METRICS）"""
+    def __init__(self):
+        self.enabled = False
+        self.started = time.time()
+        self.lock_wait = Histogram("shm_lock_wait_seconds", "获取锁的等待时间", ("kind", "mode"))
+        self.lock_hold = Histogram("shm_lock_hold_seconds", "排他锁的持有时间", ("kind",))
+        self.lock_timeouts = Counter("shm_lock_timeouts_total",
+                                     "获取锁超时次数（不含 timeout=0 的尝试）", ("kind", "mode"))
+        self.shm_ops = Counter("shm_ops_total", "段读写操作次数", ("op",))
+        self.shm_bytes = Counter("shm_bytes_total", "段读写的数据字节数", ("op",))
+        self.shm_duration = Histogram("shm_op_seconds", "段读写耗时（含等待锁）", ("op",))
+        self.shm_read_fallbacks = Counter("shm_read_fallbacks_total",
+                                          "seqlock 乐观读取多次重试失败、退化为加锁读取的次数")
+        self.tcp_commands = Counter("shm_tcp_commands_total", "Host 收到的命令数", ("command",))
+        self.tcp_bytes = Counter("shm_tcp_bytes_total", "Host 收发的字节数（压缩后）", ("direction",))
+        self.tcp_errors = Counter("shm_tcp_errors_total", "Host 回复的错误数")
+        self.tcp_connections = Gauge("shm_tcp_connections", "当前连接数")
+        self.all = (self.lock_wait, self.lock_hold, self.lock_timeouts, self.shm_ops,
+                    self.shm_bytes, self.shm_duration, self.shm_read_fallbacks, self.tcp_commands,
+                    self.tcp_bytes, self.tcp_errors, self.tcp_connections)
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        """清空所有指标（当前连接数除外）"""
+        for metric in self.all:
+            if metric is not self.tcp_connections:
+                metric.reset()
+        self.started = time.time()
+
+    # ---- 热路径的记录函数（调用方先检查 enabled） ----
+
+    def record_shm(self, op: str, nbytes: int, started: float):
+        labels = (op,)
+        self.shm_ops.inc(labels)
+        self.shm_bytes.inc(labels, nbytes)
+        self.shm_duration.observe(time.perf_counter() - started, labels)
+
+    def record_acquire(self, kind: str, mode: str, started: float):
+        """记录一次成功获取锁，返回获取完成的时间（用于计算持有时间）"""
+        now = time.perf_counter()
+        self.lock_wait.observe(now - started, (kind, mode))
+        return now
+
+    def record_timeout(self, kind: str, mode: str, timeout: float):
+        if timeout > 0:
+            self.lock_timeouts.inc((kind, mode))
+
+    def record_release(self, kind: str, acquired_at):
+        if acquired_at is not None:
+            self.lock_hold.observe(time.perf_counter() - acquired_at, (kind,))
+
+    # ---- 导出 ----
+
+    def snapshot(self):
+        """以 dict 返回所有指标（直方图给出次数，以及总和、p50/p99 估算和最大值，单位微秒）"""
+        result = {"enabled": self.enabled, "uptime": time.time() - self.started}
+        for metric in self.all:
+            entries = []
+            if isinstance(metric, Histogram):
+                for labels, counts, total, peak in metric.samples():
+                    entries.append({
+                        "labels": dict(zip(metric.label_names, labels)),
+                        "count": sum(counts),
+                        "sum": total * 1e6,
+                        "p50": metric.quantile(counts, 0.50) * 1e6,
+                        "p99": metric.quantile(counts, 0.99) * 1e6,
+                        "max": peak * 1e6,
+                    })
+            else:
+                for labels, value in metric.samples():
+                    entries.append({"labels": dict(zip(metric.label_names, labels)),
+                                    "value": value})
+            result[metric.name] = entries
+        return result
+
+    def render_prometheus(self):
+        """以 Prometheus 文本格式（0.0.4）导出"""
+        lines = []
+        for metric in self.all:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            if isinstance(metric, Histogram):
+                for labels, counts, total, _ in metric.samples():
+                    cumulative = 0
+                    for bound, n in zip(metric.buckets + (float("inf"),), counts):
+                        cumulative += n
+                        le = "+Inf" if bound == float("inf") else repr(bound)
+                        label_text = _format_labels(metric.label_names, labels, ("le", le))
+                        lines.append(f"{metric.name}_bucket{label_text} {cumulative}")
+                    label_text = _format_labels(metric.label_names, labels)
+                    lines.append(f"{metric.name}_sum{label_text} {total!r}")
+                    lines.append(f"{metric.name}_count{label_text} {cumulative}")
+            else:
+                for labels, value in metric.samples():
+                    lines.append(f"{metric.name}{_format_labels(metric.label_names, labels)} "
+                                 f"{value}")
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+               for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+METRICS = Metrics()
+
+
+def enable():
+    """开始记录本进程的指标"""
+    METRICS.enable()
+
+
+def disable():
+    METRICS.disable()
+
+
+class MetricsServer:
+    """本机 HTTP 指标端点：GET /metrics 返回 Prometheus 文本，GET /stats 返回 JSON
+
+    stats: 无参回调，返回 /stats 的结果（如 Host 的 stats()，附带连接明细）；默认为 snapshot()
+    默认只监听 127.0.0.1；启动时会启用指标记录。
+    """
+    def __init__(self, port: int = 0, host: str = METRICS_HOST, stats=None):
+        self.host = host
+        self.port = port
+        self.stats = stats or METRICS.snapshot
+        self.httpd = None
+        self.thread = None
+
+    def start(self):
+        """启动 HTTP 服务线程，返回实际监听的 (host, port)"""
+        enable()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = self.path.split("?", 1)[0]
+                if path == "/metrics":
+                    body = METRICS.render_prometheus().encode("utf-8")
+                    content_type = PROMETHEUS_CONTENT_TYPE
+                elif path == "/stats":
+                    body = json.dumps(server.stats(), ensure_ascii=False).encode("utf-8")
+                    content_type = "application/json; charset=utf-8"
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # 抓取请求很频繁，不输出访问日志
+
+        self.httpd = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="shm-metrics",
+                                       daemon=True)
+        self.thread.start()
+        return self.httpd.server_address[:2]
+
+    def stop(self):
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+        if self.thread is not None:
+            self.thread.join(timeout=5.0)
+            self.thread = None
+
+    @property
+    def address(self):
+        return self.httpd.server_address[:2] if self.httpd is not None else None
@@ -0,0 +1,247 @@
+"""Client 连接池模块
+维护若干条到同一个 Host 的常驻连接，供多个线程共享：请求轮流分配到健康的连接上；
+连接断开后由维护线程按指数退避自动重连（重新握手并校验 shm_id），定期发送心跳检查空闲连接
+
+每条连接本身支持多个线程同时发起请求（按 request_id 流水线匹配响应），连接池不做独占借出。
+"""
+import random
+import threading
+import time
+
+from shm_client import DEFAULT_TIMEOUT, SharedMemoryClient
+
+DEFAULT_POOL_SIZE = 4
+HEALTH_INTERVAL = 5.0     # 空闲连接的心跳间隔（秒）
+RECONNECT_MIN = 0.1       # 第一次重连前的等待（秒），之后逐次翻倍
+RECONNECT_MAX = 30.0
+
+
+class _PooledConnection:
+    """连接池中的一条连接及其重连状态"""
+    __slots__ = ("client", "alive", "failures", "next_attempt", "last_used")
+
+    def __init__(self, client: SharedMemoryClient):
+        self.client = client
+        self.alive = False
+        self.failures = 0
+        self.next_attempt = 0.0   # 下一次重连的时间（time.monotonic）
+        self.last_used = 0.0
+
+
+class ClientPool:
+    """到同一个 Host 的连接池
+
+    shm_id: 期望的共享内存 ID，每次（重新）连接都会校验；ID 不一致时视为连接失败，继续按退避重试。
+            为 None 时不校验（Host 重启后段名变化也照常重连）
+    size: 常驻连接数
+    timeout: 连接和请求的超时；没有可用连接时调用方最多等待这么久
+    compression / local: 传给每条连接的压缩算法和本机直接访问开关（见 SharedMemoryClient）
+    on_state: 连接状态变化的回调 on_state(index, alive, error)，在维护线程或接收线程中调用
+    """
+    def __init__(self, host: str, port: int, shm_id: str = None, size: int = DEFAULT_POOL_SIZE,
+                 timeout: float = DEFAULT_TIMEOUT, compression=None, local: bool = True,
+                 health_interval: float = HEALTH_INTERVAL, reconnect_min: float = RECONNECT_MIN,
+                 reconnect_max: float = RECONNECT_MAX, on_state=None):
+        if size <= 0:
+            raise ValueError(f"连接数必须大于 0: {size}")
+        self.host = host
+        self.port = port
+        self.shm_id = shm_id
+        self.size = size
+        self.timeout = timeout
+        self.compression = compression
+        self.local = local
+        self.health_interval = health_interval
+        self.reconnect_min = reconnect_min
+        self.reconnect_max = reconnect_max
+        self.on_state = on_state
+        self.last_error = None
+        self.connections = []
+        self._next = 0
+        self._cond = threading.Condition()
+        self._wakeup = threading.Event()
+        self._closed = True
+        self._thread = None
+
+    # ---- 生命周期 ----
+
+    def start(self):
+        """建立所有连接（失败的连接交给维护线程重连）并启动维护线程，返回 self"""
+        self._closed = False
+        self.connections = [_PooledConnection(self._new_client(i)) for i in range(self.size)]
+        for index, conn in enumerate(self.connections):
+            self._connect(index, conn)
+        self._thread = threading.Thread(target=self._maintain, name="shm-pool", daemon=True)
+        self._thread.start()
+        return self
+
+    def close(self):
+        """关闭所有连接并停止维护线程"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5.0)
+            self._thread = None
+        for conn in self.connections:
+            conn.alive = False
+            conn.client.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def healthy_count(self):
+        """当前可用的连接数"""
+        return sum(1 for conn in self.connections if conn.alive)
+
+    # ---- 连接管理 ----
+
+    def _new_client(self, index: int):
+        return SharedMemoryClient(self.host, self.port, shm_id=self.shm_id, timeout=self.timeout,
+                                  compression=self.compression, local=self.local,
+                                  on_disconnect=lambda: self._on_disconnect(index))
+
+    def _state(self, index, alive, error=None):
+        if self.on_state:
+            self.on_state(index, alive, error)
+
+    def _connect(self, index: int, conn: _PooledConnection):
+        """（重新）连接并握手；失败时按指数退避安排下一次重连"""
+        client = conn.client
+        client.close()
+        try:
+            client.connect()
+        except Exception as e:
+            conn.failures += 1
+            delay = min(self.reconnect_max, self.reconnect_min * (2 ** (conn.failures - 1)))
+            # 加入随机抖动，避免 Host 恢复时所有连接同时重连
+            conn.next_attempt = time.monotonic() + delay * random.uniform(0.5, 1.0)
+            self.last_error = e
+            self._state(index, False, e)
+            return False
+        with self._cond:
+            conn.failures = 0
+            conn.last_used = time.monotonic()
+            conn.alive = True
+            self._cond.notify_all()
+        self._state(index, True)
+        return True
+
+    def _mark_dead(self, index: int, conn: _PooledConnection, error=None):
+        with self._cond:
+            if not conn.alive:
+                return
+            conn.alive = False
+            conn.next_attempt = time.monotonic()
+        if error is not None:
+            self.last_error = error
+        self._state(index, False, error)
+        self._wakeup.set()
+
+    def _on_disconnect(self, index: int):
+        if index < len(self.connections):
+            self._mark_dead(index, self.connections[index], RuntimeError("服务器关闭连接"))
+
+    def _maintain(self):
+        """维护线程：到期重连断开的连接，对空闲超过心跳间隔的连接发送心跳"""
+        while not self._closed:
+            now = time.monotonic()
+            wait = self.health_interval
+            for index, conn in enumerate(self.connections):
+                if self._closed:
+                    return
+                if not conn.alive:
+                    if now >= conn.next_attempt:
+                        self._connect(index, conn)
+                    if not conn.alive:
+                        wait = min(wait, max(0.0, conn.next_attempt - time.monotonic()))
+                elif now - conn.last_used >= self.health_interval:
+                    try:
+                        conn.client.ping(timeout=min(self.timeout, self.health_interval))
+                        conn.last_used = time.monotonic()
+                    except Exception as e:
+                        self._mark_dead(index, conn, e)
+                        wait = 0.0
+            self._wakeup.wait(wait)
+            self._wakeup.clear()
+
+    def _acquire(self):
+        """轮流选择一条可用的连接；没有可用连接时最多等待 timeout 秒"""
+        deadline = time.monotonic() + self.timeout
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise RuntimeError("连接池已关闭")
+                for _ in range(len(self.connections)):
+                    index = self._next % len(self.connections)
+                    self._next += 1
+                    conn = self.connections[index]
+                    if conn.alive:
+                        return index, conn
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise RuntimeError(f"没有可用的连接: {self.last_error}")
+                self._cond.wait(remaining)
+
+    # ---- 请求 ----
+
+    def run(self, fn, retry: bool = False):
+        """在一条可用的连接上执行 fn(client) 并返回其结果
+
+        执行期间连接断开时，该连接交给维护线程重连；retry=True 时换一条连接重试一次
+        （只应用于重复执行无副作用的操作：读取、整段写入、槽位写入）。
+        """
+        attempts = 2 if retry else 1
+        while True:
+            index, conn = self._acquire()
+            conn.last_used = time.monotonic()
+            try:
+                return fn(conn.client)
+            except Exception as e:
+                if conn.client.healthy:
+                    raise  # 请求本身失败（服务器错误、版本冲突、超时），连接仍可用
+                self._mark_dead(index, conn, e)
+                attempts -= 1
+                if attempts <= 0:
+                    raise
+
+    def read_bytes(self):
+        """读取远程共享内存的原始字节"""
+        return self.run(lambda client: client.read_bytes(), retry=True)
+
+    def read(self):
+        """读取远程共享内存的文本内容"""
+        return self.run(lambda client: client.read(), retry=True)
+
+    def write_bytes(self, data):
+        """写入原始字节到远程共享内存"""
+        self.run(lambda client: client.write_bytes(data), retry=True)
+
+    def write(self, text: str):
+        """写入文本到远程共享内存"""
+        self.run(lambda client: client.write(text), retry=True)
+
+    def patch(self, offset: int, data, expected_version: int = None, truncate: bool = False):
+        """在 offset 处写入 data，返回写入后的版本号（连接断开时不重试，结果未知）"""
+        return self.run(lambda client: client.patch(offset, data, expected_version, truncate))
+
+    def get_bytes(self, key):
+        """读取远程槽位的原始字节，键不存在时返回 None"""
+        return self.run(lambda client: client.get_bytes(key), retry=True)
+
+    def get(self, key):
+        """读取远程槽位的文本，键不存在时返回 None"""
+        return self.run(lambda client: client.get(key), retry=True)
+
+    def put_bytes(self, key, data):
+        """写入原始字节到远程槽位"""
+        self.run(lambda client: client.put_bytes(key, data), retry=True)
+
+    def put(self, key, value: str):
+        """写入文本到远程槽位"""
+        self.run(lambda client: client.put(key, value), retry=True)
@@ -0,0 +1,488 @@
+"""二进制 TCP 协议模块
+定长帧头 + 长度前缀的二进制帧格式，以及带缓冲的帧读取器
+
+帧格式（小端序，帧头共 12 字节）:
+    偏移  大小  内容
+    0     1     opcode      操作码
+    1     1     flags       标志位
+    2     2     reserved    保留（置 0）
+    4     4     request_id  请求 ID，响应帧回传相同的 ID
+    8     4     length      负载长度
+    12    ...   payload     负载（原始字节，不做编码转换）
+
+协商流程（兼容旧的文本协议）:
+    Host → Client: 元数据行（与旧版相同）
+    Client → Host: "PROTO <version>\\n"
+    Host → Client: "PROTO <version>\\n"     之后双方改用二进制帧
+    旧版 Host 不会回应 PROTO 命令，Client 等待超时后继续使用文本协议。
+    Client → Host: COMPRESS 帧（可选，负载为按偏好排列的压缩算法 ID）
+    Host → Client: OK（负载为选定的算法 ID）；不支持的旧版 Host 回复 ERROR，视为不压缩
+    Client → Host: HOST_INFO 帧（可选，检查 Host 是否在本机）
+    Host → Client: OK（负载为 Host 的本机标识）；与 Client 的本机标识相同时直接挂载共享内存段
+
+压缩（按连接协商）:
+    负载不小于阈值的帧按协商的算法压缩，并在 flags 中置 FLAG_COMPRESSED；
+    小负载和压缩后没有变小的负载原样发送。接收端按该标志位解压，对上层透明。
+"""
+import lzma
+import socket
+import struct
+import threading
+import zlib
+
+PROTO_VERSION = 1
+PROTO_CMD = "PROTO"
+PROTO_NEGOTIATE_TIMEOUT = 1.0  # 等待 Host 回应 PROTO 的时间，超时视为旧版 Host
+
+FRAME_HEADER_FMT = "<BBHII"
+FRAME_HEADER_SIZE = struct.calcsize(FRAME_HEADER_FMT)
+MAX_FRAME_PAYLOAD = 1 << 30
+
+# 请求操作码
+OP_READ = 0x01
+OP_WRITE = 0x02
+OP_SYNC_UPDATE = 0x03
+OP_SUBSCRIBE = 0x04       # 订阅变更推送，负载 1 字节: SUBSCRIBE_VERSION / SUBSCRIBE_CONTENT
+OP_PATCH = 0x05           # 在指定偏移处写入，负载: uint64 偏移 + uint64 期望版本 + 数据
+OP_READ_IF_NEWER = 0x06   # 条件读取，负载: uint64 已知版本；OK 负载: uint64 版本 + 内容
+OP_GET = 0x07             # 读取槽位，负载: 键；OK 负载: 值
+OP_PUT = 0x08             # 写入槽位，负载: uint16 键长度 + 键 + 值
+OP_BATCH = 0x09           # 批量请求，负载: (uint8 操作码 + uint8 flags + uint32 长度 + 负载) * N；
+                          # OK 负载: (uint8 结果操作码 + uint32 长度 + 负载) * N
+OP_PING = 0x0B            # 心跳，OK 负载为空（连接池的健康检查）
+OP_COMPRESS = 0x0A        # 协商压缩，负载: uint8 算法 ID * N（按偏好排列）；OK 负载: uint8 选定的算法 ID
+OP_HOST_INFO = 0x0C       # 查询 Host 的本机标识（见 host_token），OK 负载: UTF-8 标识
+OP_STATS = 0x0D           # 查询 Host 的运行指标（见 shm_metrics），OK 负载: UTF-8 JSON
+# 响应操作码
+OP_OK = 0x80
+OP_ERROR = 0x81
+OP_CONFLICT = 0x83        # 条件写入的版本不匹配，负载: uint64 当前版本
+OP_NOT_MODIFIED = 0x84    # 条件读取时内容未变化，负载: uint64 当前版本
+OP_NOT_FOUND = 0x85       # GET 的键不存在
+# Host 主动推送（request_id 固定为 0）
+OP_NOTIFY = 0x82          # 负载: uint64 版本号 [+ 内容]
+OP_MESSAGES = 0x86        # 环形缓冲区的一批消息，负载: (uint32 长度 + 消息) * N
+OP_DELTA = 0x87           # 增量推送，负载: uint64 基准版本 + uint64 版本 + uint64 偏移 + uint8 截断 + 数据
+
+# 请求操作码的名称（指标中的命令标签）
+OP_NAMES = {
+    OP_READ: "READ", OP_WRITE: "WRITE", OP_SYNC_UPDATE: "SYNC_UPDATE", OP_SUBSCRIBE: "SUBSCRIBE",
+    OP_PATCH: "PATCH", OP_READ_IF_NEWER: "READ_IF_NEWER", OP_GET: "GET", OP_PUT: "PUT",
+    OP_BATCH: "BATCH", OP_COMPRESS: "COMPRESS", OP_PING: "PING", OP_HOST_INFO: "HOST_INFO",
+    OP_STATS: "STATS",
+}
+
+SUBSCRIBE_VERSION = 0     # 只推送版本号
+SUBSCRIBE_CONTENT = 1     # 推送版本号和完整内容（省去一次 READ 往返）
+SUBSCRIBE_STREAM = 2      # 订阅 Host 的环形缓冲区，按顺序推送每一条消息（OP_MESSAGES）
+SUBSCRIBE_DELTA = 3       # 先推送完整快照，之后每次变更只推送相对上一次推送的补丁（OP_DELTA，用于副本复制）
+NOTIFY_VERSION_FMT = "<Q"
+NOTIFY_VERSION_SIZE = struct.calcsize(NOTIFY_VERSION_FMT)
+
+# PATCH 帧的 flags
+PATCH_FLAG_IF_VERSION = 0x01  # 只有版本号等于期望版本时才写入
+PATCH_FLAG_TRUNCATE = 0x02    # 写入后数据长度截断为 偏移 + 数据长度
+FLAG_COMPRESSED = 0x80        # 任意帧: 负载已按连接协商的算法压缩（与各操作自己的 flags 不冲突）
+
+DELTA_HEADER_FMT = "<QQQB"
+DELTA_HEADER_SIZE = struct.calcsize(DELTA_HEADER_FMT)
+DELTA_BASE_ANY = (1 << 64) - 1  # DELTA 的基准版本: 完整快照，不依赖订阅者已有的内容
+PATCH_HEADER_FMT = "<QQ"
+PATCH_HEADER_SIZE = struct.calcsize(PATCH_HEADER_FMT)
+PUT_KEY_LEN_FMT = "<H"
+PUT_KEY_LEN_SIZE = struct.calcsize(PUT_KEY_LEN_FMT)
+BATCH_OP_FMT = "<BBI"
+BATCH_OP_SIZE = struct.calcsize(BATCH_OP_FMT)
+BATCH_RESULT_FMT = "<BI"
+BATCH_RESULT_SIZE = struct.calcsize(BATCH_RESULT_FMT)
+MAX_BATCH_OPS = 4096
+MESSAGE_LEN_FMT = "<I"
+
+# 压缩算法
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_LZMA = 2
+CODEC_NAMES = {"none": CODEC_NONE, "zlib": CODEC_ZLIB, "lzma": CODEC_LZMA}
+DEFAULT_CODECS = (CODEC_ZLIB, CODEC_LZMA)  # Host 默认接受的算法
+COMPRESS_THRESHOLD = 1024  # 小于该长度的负载不压缩（bytes）
+ZLIB_LEVEL = 1             # 偏向速度的压缩级别：慢链路上主要收益来自体积，级别再高收益有限
+LZMA_PRESET = 1
+MESSAGE_LEN_SIZE = struct.calcsize(MESSAGE_LEN_FMT)
+
+
+class ProtocolError(RuntimeError):
+    """收到不符合协议的数据"""
+
+
+def pack_header(opcode: int, request_id: int, length: int, flags: int = 0):
+    """打包帧头"""
+    return struct.pack(FRAME_HEADER_FMT, opcode, flags, 0, request_id, length)
+
+
+def unpack_header(header):
+    """解析帧头，返回 (opcode, flags, request_id, length)"""
+    opcode, flags, _, request_id, length = struct.unpack(FRAME_HEADER_FMT, header)
+    if length > MAX_FRAME_PAYLOAD:
+        raise ProtocolError(f"帧负载过大: {length} bytes")
+    return opcode, flags, request_id, length
+
+
+def send_frame(sock: socket.socket, opcode: int, request_id: int, payload=b"", flags: int = 0):
+    """发送一帧；支持 sendmsg 的平台上帧头和负载一次系统调用发出，不拼接"""
+    header = pack_header(opcode, request_id, len(payload), flags)
+    if not payload:
+        sock.sendall(header)
+        return
+    if hasattr(sock, "sendmsg"):
+        sent = sock.sendmsg([header, payload])
+        total = len(header) + len(payload)
+        if sent == total:
+            return
+        # 部分发送：补发剩余部分
+        if sent < len(header):
+            sock.sendall(header[sent:])
+            sock.sendall(payload)
+        else:
+            sock.sendall(memoryview(payload)[sent - len(header):])
+        return
+    sock.sendall(header)
+    sock.sendall(payload)
+
+
+class Compression:
+    """一个连接上协商好的压缩方式：发送时按阈值压缩，接收时按 FLAG_COMPRESSED 解压"""
+    def __init__(self, codec: int = CODEC_NONE, threshold: int = COMPRESS_THRESHOLD):
+        if codec not in CODEC_NAMES.values():
+            raise ValueError(f"未知的压缩算法: {codec}")
+        self.codec = codec
+        self.threshold = threshold
+
+    def encode(self, payload, flags: int = 0):
+        """返回 (flags, payload)；不压缩时原样返回"""
+        if self.codec == CODEC_NONE or len(payload) < self.threshold:
+            return flags, payload
+        if self.codec == CODEC_ZLIB:
+            packed = zlib.compress(payload, ZLIB_LEVEL)
+        else:
+            packed = lzma.compress(payload, preset=LZMA_PRESET)
+        if len(packed) >= len(payload):
+            return flags, payload  # 不可压缩的数据
+        return flags | FLAG_COMPRESSED, packed
+
+    def decode(self, flags: int, payload):
+        """返回 (去掉 FLAG_COMPRESSED 的 flags, 解压后的负载)"""
+        if not flags & FLAG_COMPRESSED:
+            return flags, payload
+        if self.codec == CODEC_ZLIB:
+            decompressor = zlib.decompressobj()
+            data = decompressor.decompress(payload, MAX_FRAME_PAYLOAD)
+            if decompressor.unconsumed_tail:
+                raise ProtocolError(f"解压后的帧负载过大: > {MAX_FRAME_PAYLOAD} bytes")
+        elif self.codec == CODEC_LZMA:
+            decompressor = lzma.LZMADecompressor()
+            try:
+                data = decompressor.decompress(payload, MAX_FRAME_PAYLOAD)
+            except lzma.LZMAError as e:
+                raise ProtocolError(f"解压失败: {e}")
+            if not decompressor.eof:
+                raise ProtocolError(f"解压后的帧负载过大: > {MAX_FRAME_PAYLOAD} bytes")
+        else:
+            raise ProtocolError("收到压缩帧，但连接未协商压缩")
+        return flags & ~FLAG_COMPRESSED, data
+
+
+NO_COMPRESSION = Compression()
+
+
+def choose_codec(requested, accepted=DEFAULT_CODECS):
+    """Host 端按 Client 的偏好顺序选择第一个双方都支持的算法"""
+    for codec in requested:
+        if codec in accepted:
+            return codec
+    return CODEC_NONE
+
+
+class FrameWriter:
+    """线程安全的帧发送器：同一连接上的响应和推送帧不会交错"""
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.lock = threading.Lock()
+        self.compression = NO_COMPRESSION
+
+    def send(self, opcode: int, request_id: int, payload=b"", flags: int = 0):
+        flags, payload = self.compression.encode(payload, flags)
+        with self.lock:
+            send_frame(self.sock, opcode, request_id, payload, flags)
+
+
+def pack_notify(version: int, content=b""):
+    """打包 NOTIFY 推送负载"""
+    return struct.pack(NOTIFY_VERSION_FMT, version) + bytes(content)
+
+
+def pack_version(version: int):
+    """打包版本号（PATCH 的 OK 响应和 CONFLICT 响应的负载）"""
+    return struct.pack(NOTIFY_VERSION_FMT, version)
+
+
+def unpack_version(payload):
+    """解析版本号负载"""
+    if len(payload) < NOTIFY_VERSION_SIZE:
+        raise ProtocolError("版本号负载过短")
+    return struct.unpack_from(NOTIFY_VERSION_FMT, payload)[0]
+
+
+def pack_delta(base_version: int, version: int, offset: int, data, truncate: bool):
+    """打包 DELTA 推送负载"""
+    return struct.pack(DELTA_HEADER_FMT, base_version, version, offset, int(truncate)) + bytes(data)
+
+
+def unpack_delta(payload):
+    """解析 DELTA 推送负载，返回 (base_version, version, offset, data, truncate)"""
+    if len(payload) < DELTA_HEADER_SIZE:
+        raise ProtocolError("DELTA 负载过短")
+    base_version, version, offset, truncate = struct.unpack_from(DELTA_HEADER_FMT, payload)
+    return base_version, version, offset, payload[DELTA_HEADER_SIZE:], bool(truncate)
+
+
+def pack_patch(offset: int, data, expected_version: int = None, truncate: bool = False):
+    """打包 PATCH 请求，返回 (flags, payload)"""
+    flags = 0
+    if expected_version is not None:
+        flags |= PATCH_FLAG_IF_VERSION
+    if truncate:
+        flags |= PATCH_FLAG_TRUNCATE
+    header = struct.pack(PATCH_HEADER_FMT, offset, expected_version or 0)
+    return flags, header + bytes(data)
+
+
+def unpack_patch(flags: int, payload):
+    """解析 PATCH 请求，返回 (offset, data, expected_version, truncate)"""
+    if len(payload) < PATCH_HEADER_SIZE:
+        raise ProtocolError("PATCH 负载过短")
+    offset, version = struct.unpack_from(PATCH_HEADER_FMT, payload)
+    expected_version = version if flags & PATCH_FLAG_IF_VERSION else None
+    return offset, payload[PATCH_HEADER_SIZE:], expected_version, bool(flags & PATCH_FLAG_TRUNCATE)
+
+
+def pack_put(key: bytes, value):
+    """打包 PUT 请求负载"""
+    return struct.pack(PUT_KEY_LEN_FMT, len(key)) + key + bytes(value)
+
+
+def unpack_put(payload):
+    """解析 PUT 请求，返回 (key, value)"""
+    if len(payload) < PUT_KEY_LEN_SIZE:
+        raise ProtocolError("PUT 负载过短")
+    (key_len,) = struct.unpack_from(PUT_KEY_LEN_FMT, payload)
+    end = PUT_KEY_LEN_SIZE + key_len
+    if len(payload) < end:
+        raise ProtocolError("PUT 负载过短")
+    return payload[PUT_KEY_LEN_SIZE:end], payload[end:]
+
+
+def pack_batch(ops):
+    """打包 BATCH 请求负载，ops 为 (opcode, flags, payload) 列表"""
+    parts = []
+    for opcode, flags, payload in ops:
+        parts.append(struct.pack(BATCH_OP_FMT, opcode, flags, len(payload)))
+        parts.append(bytes(payload))
+    return b"".join(parts)
+
+
+def unpack_batch(payload):
+    """解析 BATCH 请求负载，返回 (opcode, flags, payload) 列表"""
+    ops = []
+    pos = 0
+    while pos < len(payload):
+        if len(ops) >= MAX_BATCH_OPS:
+            raise ProtocolError(f"批量请求的操作数超过上限: {MAX_BATCH_OPS}")
+        if pos + BATCH_OP_SIZE > len(payload):
+            raise ProtocolError("BATCH 负载过短")
+        opcode, flags, n = struct.unpack_from(BATCH_OP_FMT, payload, pos)
+        pos += BATCH_OP_SIZE
+        if pos + n > len(payload):
+            raise ProtocolError("BATCH 负载过短")
+        ops.append((opcode, flags, payload[pos:pos+n]))
+        pos += n
+    return ops
+
+
+def pack_batch_results(results):
+    """打包 BATCH 响应负载，results 为 (结果操作码, 负载) 列表"""
+    parts = []
+    for opcode, payload in results:
+        parts.append(struct.pack(BATCH_RESULT_FMT, opcode, len(payload)))
+        parts.append(bytes(payload))
+    return b"".join(parts)
+
+
+def unpack_batch_results(payload):
+    """解析 BATCH 响应负载，返回 (结果操作码, 负载) 列表"""
+    results = []
+    pos = 0
+    while pos < len(payload):
+        if pos + BATCH_RESULT_SIZE > len(payload):
+            raise ProtocolError("BATCH 响应过短")
+        opcode, n = struct.unpack_from(BATCH_RESULT_FMT, payload, pos)
+        pos += BATCH_RESULT_SIZE
+        if pos + n > len(payload):
+            raise ProtocolError("BATCH 响应过短")
+        results.append((opcode, payload[pos:pos+n]))
+        pos += n
+    return results
+
+
+def pack_messages(messages):
+    """打包 MESSAGES 推送负载"""
+    parts = []
+    for data in messages:
+        parts.append(struct.pack(MESSAGE_LEN_FMT, len(data)))
+        parts.append(bytes(data))
+    return b"".join(parts)
+
+
+def unpack_messages(payload):
+    """解析 MESSAGES 推送负载，返回消息列表"""
+    messages = []
+    pos = 0
+    while pos < len(payload):
+        if pos + MESSAGE_LEN_SIZE > len(payload):
+            raise ProtocolError("MESSAGES 负载过短")
+        (n,) = struct.unpack_from(MESSAGE_LEN_FMT, payload, pos)
+        pos += MESSAGE_LEN_SIZE
+        if pos + n > len(payload):
+            raise ProtocolError("MESSAGES 负载过短")
+        messages.append(payload[pos:pos+n])
+        pos += n
+    return messages
+
+
+def unpack_notify(payload):
+    """解析 NOTIFY 推送负载，返回 (version, content)"""
+    if len(payload) < NOTIFY_VERSION_SIZE:
+        raise ProtocolError("NOTIFY 负载过短")
+    (version,) = struct.unpack_from(NOTIFY_VERSION_FMT, payload)
+    return version, payload[NOTIFY_VERSION_SIZE:]
+
+
+class FrameReader:
+    """带缓冲的 socket 读取器
+
+    使用预分配的 bytearray 和 recv_into 读取，避免逐块拼接 bytes 带来的二次方开销；
+    同时支持读取文本行（元数据、协商）和二进制帧。
+    """
+    def __init__(self, sock: socket.socket, bufsize: int = 64 * 1024):
+        self.sock = sock
+        self.buf = bytearray(bufsize)
+        self.start = 0
+        self.end = 0
+        self.compression = NO_COMPRESSION
+
+    def _fill(self):
+        """从 socket 读取更多数据，连接关闭时抛出 ConnectionError"""
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif self.end == len(self.buf):
+            if self.start > 0:
+                # 把未消费的数据移到缓冲区开头
+                remaining = self.end - self.start
+                self.buf[:remaining] = self.buf[self.start:self.end]
+                self.start, self.end = 0, remaining
+            else:
+                self.buf.extend(bytes(len(self.buf)))
+        n = self.sock.recv_into(memoryview(self.buf)[self.end:])
+        if n == 0:
+            raise ConnectionError("连接已关闭")
+        self.end += n
+
+    def read_exact(self, n: int):
+        """读取恰好 n 字节"""
+        if self.start + n > len(self.buf):
+            # 剩余空间不足：一次性整理/扩容到能容纳整个负载，避免多次扩容
+            pending = self.buf[self.start:self.end]
+            if n > len(self.buf):
+                self.buf = bytearray(n)
+            self.buf[:len(pending)] = pending
+            self.start, self.end = 0, len(pending)
+        while self.end - self.start < n:
+            self._fill()
+        data = bytes(self.buf[self.start:self.start+n])
+        self.start += n
+        return data
+
+    def read_line(self, max_length: int = 64 * 1024):
+        """读取一行（包含结尾的 \\n）"""
+        while True:
+            pos = self.buf.find(b"\n", self.start, self.end)
+            if pos != -1:
+                line = bytes(self.buf[self.start:pos+1])
+                self.start = pos + 1
+                return line
+            if self.end - self.start > max_length:
+                raise ProtocolError("行过长")
+            self._fill()
+
+    def read_frame(self):
+        """读取一帧，返回 (opcode, flags, request_id, payload)"""
+        opcode, flags, request_id, length = unpack_header(self.read_exact(FRAME_HEADER_SIZE))
+        payload = self.read_exact(length) if length else b""
+        flags, payload = self.compression.decode(flags, payload)
+        return opcode, flags, request_id, payload
+
+    def buffered(self):
+        """缓冲区中尚未消费的字节数"""
+        return self.end - self.start
+
+
+def negotiate_client(sock: socket.socket, reader: FrameReader,
+                     timeout: float = PROTO_NEGOTIATE_TIMEOUT):
+    """Client 端协商二进制协议，返回协商到的版本；Host 不支持时返回 0（继续使用文本协议）"""
+    old_timeout = sock.gettimeout()
+    sock.sendall(f"{PROTO_CMD} {PROTO_VERSION}\n".encode("utf-8"))
+    sock.settimeout(timeout)
+    try:
+        line = reader.read_line()
+    except socket.timeout:
+        return 0
+    finally:
+        sock.settimeout(old_timeout)
+    parts = line.decode("utf-8", errors="replace").split()
+    if len(parts) != 2 or parts[0] != PROTO_CMD:
+        raise ProtocolError(f"无效的协商响应: {line!r}")
+    return int(parts[1])
+
+
+def negotiate_compression(sock: socket.socket, reader: FrameReader, codecs):
+    """Client 端在二进制协议上协商压缩（在接收线程启动前调用），返回 Host 选定的算法
+
+    不支持 COMPRESS 的旧版 Host 回复 ERROR，返回 CODEC_NONE。
+    """
+    send_frame(sock, OP_COMPRESS, 0, bytes(codecs))
+    opcode, _, _, payload = reader.read_frame()
+    if opcode != OP_OK:
+        return CODEC_NONE
+    if len(payload) != 1 or payload[0] not in CODEC_NAMES.values():
+        raise ProtocolError(f"无效的压缩协商响应: {payload!r}")
+    return payload[0]
+
+
+def query_host_token(sock: socket.socket, reader: FrameReader):
+    """Client 端查询 Host 的本机标识（在接收线程启动前调用）；不支持 HOST_INFO 的旧版 Host 返回 None"""
+    send_frame(sock, OP_HOST_INFO, 0)
+    opcode, _, _, payload = reader.read_frame()
+    if opcode != OP_OK:
+        return None
+    return payload.decode("utf-8", errors="replace")
+
+
+def parse_proto_request(line: str):
+    """解析 Client 的 PROTO 请求，返回双方都支持的版本；不是 PROTO 请求时返回 None"""
+    parts = line.strip().split()
+    if len(parts) != 2 or parts[0] != PROTO_CMD:
+        return None
+    try:
+        requested = int(parts[1])
+    except ValueError:
+        return None
+    return min(requested, PROTO_VERSION)
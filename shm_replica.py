@@ -0,0 +1,244 @@
+"""副本 Host 模块
+从上游 Host 复制单值内容到本机的共享内存段：本机进程直接挂载读取，同时作为 Host 为下游客户端
+（包括下一级副本）提供服务，把读取负载分散到多台机器上，不增加上游的负担
+
+复制通过增量订阅（SUBSCRIBE_DELTA）完成：连接时收到完整快照，之后每次变更只收到补丁。
+副本是只读的：远程写入回复 ERROR，本机 Client 也不直接写入，写入应发往上游 Host。
+与上游的连接断开后按指数退避重连，重连后重新接收快照；断开期间继续以最后同步的内容提供服务。
+"""
+import random
+import threading
+import time
+
+from shared_memory_utils import BUF_SIZE, DATA_OFFSET, LOCK_KIND_SPIN, segment_size
+from shm_client import DEFAULT_TIMEOUT, SharedMemoryClient
+from shm_pool import RECONNECT_MAX, RECONNECT_MIN
+from shm_protocol import COMPRESS_THRESHOLD, DEFAULT_CODECS, DELTA_BASE_ANY
+from shm_ring import DEFAULT_MAX_CONSUMERS, RING_BLOCK
+from shm_server import DEFAULT_BACKLOG, DEFAULT_MAX_CONNECTIONS, SharedMemoryHost
+
+
+class ReplicaHost:
+    """上游 Host 的只读副本
+
+    upstream_shm_id: 期望的上游共享内存 ID，每次（重新）连接都会校验；为 None 时不校验
+    size: 本机段的初始大小；上游内容超过容量时自动扩容（本机读者沿 redirect 迁移）
+    ring_size: 大于 0 时同时转发上游环形缓冲区的消息流（上游也需要启用环形缓冲区）
+    compression: 与上游连接的压缩算法（见 SharedMemoryClient）
+    其余服务参数与 SharedMemoryHost 相同（快照参数作用于本机副本：warm_start 时上游不可达也能先提供
+    最近的内容，连接后由上游的完整快照覆盖）
+    on_sync: 每次应用快照或补丁后的回调 on_sync(upstream_version)，在接收线程中调用
+    on_state: 上游连接状态变化的回调 on_state(connected, error)，在维护线程或接收线程中调用
+    """
+    def __init__(self, upstream_host: str, upstream_port: int, upstream_shm_id: str = None,
+                 size: int = BUF_SIZE, lock_kind: int = LOCK_KIND_SPIN, host: str = "0.0.0.0",
+                 port: int = 0, backlog: int = DEFAULT_BACKLOG,
+                 max_connections: int = DEFAULT_MAX_CONNECTIONS, ring_size: int = 0,
+                 ring_policy: int = RING_BLOCK, ring_consumers: int = DEFAULT_MAX_CONSUMERS,
+                 codecs=DEFAULT_CODECS, compress_threshold: int = COMPRESS_THRESHOLD,
+                 compression=None, timeout: float = DEFAULT_TIMEOUT,
+                 reconnect_min: float = RECONNECT_MIN, reconnect_max: float = RECONNECT_MAX,
+                 metrics_port: int = None, snapshot_path: str = None,
+                 snapshot_interval: float = 0, warm_start: bool = False,
+                 on_sync=None, on_state=None, on_update=None, on_status=None):
+        self.upstream_host = upstream_host
+        self.upstream_port = upstream_port
+        self.upstream_shm_id = upstream_shm_id
+        self.ring_size = ring_size
+        self.compression = compression
+        self.timeout = timeout
+        self.reconnect_min = reconnect_min
+        self.reconnect_max = reconnect_max
+        self.on_sync = on_sync
+        self.on_state = on_state
+        self.mirror = SharedMemoryHost(
+            size, lock_kind=lock_kind, host=host, port=port, backlog=backlog,
+            max_connections=max_connections, ring_size=ring_size, ring_policy=ring_policy,
+            ring_consumers=ring_consumers, codecs=codecs, compress_threshold=compress_threshold,
+            read_only=True, metrics_port=metrics_port, snapshot_path=snapshot_path,
+            snapshot_interval=snapshot_interval, warm_start=warm_start, on_update=on_update,
+            on_status=on_status)
+        self.client = None
+        self.upstream_version = None  # 最后同步的上游版本号（本机段的版本号独立计数）
+        self.synced = False           # 当前连接上已收到快照
+        self.last_error = None
+        self._failures = 0
+        self._next_attempt = 0.0
+        self._wakeup = threading.Event()
+        self._closed = True
+        self._thread = None
+
+    # ---- 生命周期 ----
+
+    def start(self):
+        """创建本机段、启动服务并连接上游（失败时由维护线程重连），返回实际监听的 (host, port)"""
+        address = self.mirror.start()
+        self._closed = False
+        self.client = SharedMemoryClient(
+            self.upstream_host, self.upstream_port, shm_id=self.upstream_shm_id,
+            timeout=self.timeout, compression=self.compression, on_delta=self._on_delta,
+            on_messages=self._on_messages if self.ring_size else None,
+            on_disconnect=self._on_disconnect)
+        self._connect()
+        self._thread = threading.Thread(target=self._maintain, name="shm-replica", daemon=True)
+        self._thread.start()
+        return address
+
+    def stop(self):
+        """断开上游、停止服务并释放本机段"""
+        self._closed = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5.0)
+            self._thread = None
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+        self.synced = False
+        self.mirror.stop()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+        return False
+
+    @property
+    def running(self):
+        return self.mirror.running
+
+    @property
+    def connected(self):
+        """与上游的连接可用且已同步"""
+        return self.synced and self.client is not None and self.client.healthy
+
+    @property
+    def shm_id(self):
+        """本机段对外公开的 shm_id（与上游的不同）"""
+        return self.mirror.shm_id
+
+    @property
+    def address(self):
+        return self.mirror.address
+
+    @property
+    def capacity(self):
+        return self.mirror.capacity
+
+    @property
+    def ring_shm(self):
+        """本机的环形缓冲区段（转发上游消息流时）"""
+        return self.mirror.ring_shm
+
+    # ---- 上游连接 ----
+
+    def _state(self, connected, error=None):
+        if self.on_state:
+            self.on_state(connected, error)
+
+    def _connect(self):
+        """（重新）连接上游并增量订阅；快照在 connect() 返回前已经应用"""
+        self.synced = False
+        self.client.close()
+        try:
+            self.client.connect()
+        except Exception as e:
+            self._failures += 1
+            delay = min(self.reconnect_max, self.reconnect_min * (2 ** (self._failures - 1)))
+            self._next_attempt = time.monotonic() + delay * random.uniform(0.5, 1.0)
+            self.last_error = e
+            self._state(False, e)
+            return False
+        self._failures = 0
+        self._state(True)
+        return True
+
+    def _on_disconnect(self):
+        self.synced = False
+        self.last_error = RuntimeError("上游 Host 关闭连接")
+        self._next_attempt = time.monotonic()
+        self._state(False, self.last_error)
+        self._wakeup.set()
+
+    def _maintain(self):
+        """维护线程：连接断开后按退避时间重连"""
+        while not self._closed:
+            wait = None
+            if self.client is not None and not self.client.healthy:
+                remaining = self._next_attempt - time.monotonic()
+                if remaining <= 0:
+                    self._connect()
+                    continue
+                wait = remaining
+            self._wakeup.wait(wait)
+            self._wakeup.clear()
+
+    # ---- 复制 ----
+
+    def _on_delta(self, base_version, version, offset, data, truncate):
+        """应用快照或补丁（接收线程中按顺序调用）
+
+        抛出异常时接收线程按连接断开处理，重连后重新接收快照。
+        """
+        if base_version != DELTA_BASE_ANY and base_version != self.upstream_version:
+            # Host 只向持有基准版本的订阅者发送补丁，不一致说明本地状态不可信
+            raise RuntimeError(f"增量基准不一致: {base_version} != {self.upstream_version}")
+        needed = offset + len(data)
+        if needed > self.mirror.capacity:
+            # 上游扩容后内容变大，本机段同样扩容
+            self.mirror.grow(max(segment_size(self.mirror.shm) * 2, needed + DATA_OFFSET))
+        if base_version == DELTA_BASE_ANY:
+            # 重连后的快照与已有内容相同时不写入，避免向下游重复推送
+            if data != self.mirror.read_bytes():
+                self.mirror.write_bytes(data)
+        elif data or truncate:
+            self.mirror.patch(offset, data, truncate=truncate)
+        self.upstream_version = version
+        self.synced = True
+        if self.on_sync:
+            self.on_sync(version)
+
+    def _on_messages(self, messages):
+        """转发上游的消息流到本机环形缓冲区（缓冲区满时阻塞接收线程，背压到上游）"""
+        self.mirror.push_many(messages, timeout=self.timeout)
+
+    # ---- 读取 ----
+
+    def read(self):
+        """读取本机副本中的文本"""
+        return self.mirror.read()
+
+    def read_bytes(self):
+        """读取本机副本中的原始字节"""
+        return self.mirror.read_bytes()
+
+    def stats(self):
+        """本机服务的指标和连接明细，另附上游同步状态"""
+        stats = self.mirror.stats()
+        stats["upstream"] = {
+            "address": f"{self.upstream_host}:{self.upstream_port}",
+            "connected": self.connected,
+            "version": self.upstream_version,
+            "last_error": None if self.last_error is None else str(self.last_error),
+        }
+        return stats
+
+    def snapshot(self, path: str = None):
+        """立即保存本机副本的快照（见 SharedMemoryHost.snapshot）"""
+        return self.mirror.snapshot(path)
+
+    @property
+    def restored(self):
+        """热启动时恢复的快照（SnapshotInfo），未恢复时为 None"""
+        return self.mirror.restored
+
+    @property
+    def metrics_address(self):
+        return self.mirror.metrics_address
+
+    @property
+    def version(self):
+        """本机段内容的版本号（与上游版本号独立）"""
+        return self.mirror.version
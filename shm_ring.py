@@ -0,0 +1,383 @@
+"""共享内存环形缓冲区模块（队列模式）
+单生产者 / 多消费者的无锁环形缓冲区：生产者追加消息后原子地发布 head，
+每个消费者在段内有自己的游标，按自己的进度读取，所有中间消息都不会丢失
+
+两种满队列策略:
+    RING_BLOCK      生产者等待最慢的消费者（背压），消息不丢失
+    RING_OVERWRITE  生产者从不等待，覆盖最旧的消息；过慢的消费者跳到最旧的有效消息并计入 dropped
+
+段布局（段头与单值布局相同，LAYOUT_OFFSET 处记为 LAYOUT_RING）:
+    偏移            大小                  内容
+    0               64                    段头（见 shared_memory_utils）
+    64              8                     capacity       数据区大小（8 的倍数）
+    72              4                     max_consumers  消费者槽位数
+    76              4                     policy         满队列策略
+    80              4                     head_seq       head 处下一条消息的序号
+    88              8                     publish_seq    发布 head/head_seq 的 seqlock 计数器
+    128             8                     head           已发布的写入位置（单调递增，原子）
+    192             8                     tail           最旧的有效消息位置（仅覆盖模式，原子）
+    256             64 * max_consumers    消费者槽位
+    ...             capacity              数据区
+
+消费者槽位（64 字节，各占一个缓存行）:
+    0     8     cursor      下一条要读取的消息位置（原子）
+    8     4     state       0=空闲, 1=使用中（原子 CAS 认领）
+    16    8     dropped     被覆盖而跳过的消息数
+
+消息记录（8 字节对齐）:
+    0     4     length      消息长度；0xFFFFFFFF 表示回绕标记（跳到数据区开头）
+    4     4     seq         消息序号（uint32 回绕），回绕标记的序号为下一条消息的序号
+    8     ...   data
+"""
+import struct
+import time
+from multiprocessing import shared_memory
+
+from shared_memory_utils import (
+    HEADER_SIZE, MIN_SEGMENT_SIZE, LAYOUT_OFFSET, LAYOUT_RING, SeqLock, SharedMemoryAtomic,
+    atomic_backend, create_segment, segment_layout
+)
+
+RING_BLOCK = 0
+RING_OVERWRITE = 1
+
+META_OFFSET = HEADER_SIZE
+META_FMT = "<QII"
+HEAD_SEQ_OFFSET = META_OFFSET + 16
+PUBLISH_SEQ_OFFSET = META_OFFSET + 24
+HEAD_OFFSET = 128
+TAIL_OFFSET = 192
+CONSUMER_OFFSET = 256
+CONSUMER_SIZE = 64
+CONSUMER_CURSOR = 0
+CONSUMER_STATE = 8
+CONSUMER_DROPPED = 16
+CONSUMER_FREE = 0
+CONSUMER_ACTIVE = 1
+
+RECORD_FMT = "<II"
+RECORD_HEADER_SIZE = struct.calcsize(RECORD_FMT)
+WRAP_MARKER = 0xFFFFFFFF
+SEQ_MASK = 0xFFFFFFFF
+DEFAULT_MAX_CONSUMERS = 16
+DEFAULT_POP_BATCH = 64
+
+
+class RingFullError(TimeoutError):
+    """阻塞模式下等待消费者腾出空间超时"""
+
+
+def _align8(n: int):
+    return (n + 7) & ~7
+
+
+def _data_offset(max_consumers: int):
+    return CONSUMER_OFFSET + max_consumers * CONSUMER_SIZE
+
+
+def _wait(try_once, timeout):
+    """指数退避等待（与锁的等待策略相同），try_once 返回真值或超时后返回其结果"""
+    start_time = time.time()
+    delay = 0.00005
+    while True:
+        result = try_once()
+        if result or timeout is not None and time.time() - start_time >= timeout:
+            return result
+        time.sleep(delay)
+        delay = min(delay * 2, 0.01)
+
+
+def init_ring(shm: shared_memory.SharedMemory, capacity: int,
+              max_consumers: int = DEFAULT_MAX_CONSUMERS, policy: int = RING_BLOCK):
+    """在已初始化段头的段上建立环形缓冲区布局"""
+    if capacity <= 0 or capacity % 8:
+        raise ValueError(f"环形缓冲区大小必须是 8 的正整数倍: {capacity}")
+    if max_consumers <= 0:
+        raise ValueError(f"消费者数必须大于 0: {max_consumers}")
+    if policy not in (RING_BLOCK, RING_OVERWRITE):
+        raise ValueError(f"未知的满队列策略: {policy}")
+    start = _data_offset(max_consumers)
+    if start + capacity > shm.size:
+        raise ValueError(f"段大小不足以容纳环形缓冲区: {start + capacity} > {shm.size} bytes")
+    buf = shm.buf
+    buf[META_OFFSET:start] = bytes(start - META_OFFSET)
+    struct.pack_into(META_FMT, buf, META_OFFSET, capacity, max_consumers, policy)
+    buf[LAYOUT_OFFSET] = LAYOUT_RING
+
+
+def create_ring_segment(capacity: int, max_consumers: int = DEFAULT_MAX_CONSUMERS,
+                        policy: int = RING_BLOCK):
+    """创建数据区大小为 capacity（向上取整到 8 的倍数）的环形缓冲区段"""
+    if atomic_backend() is None:
+        raise OSError("环形缓冲区需要原子操作支持（libatomic 或 fcntl）")
+    capacity = _align8(int(capacity))
+    shm = create_segment(max(_data_offset(max_consumers) + capacity, MIN_SEGMENT_SIZE))
+    try:
+        init_ring(shm, capacity, max_consumers, policy)
+    except Exception:
+        shm.close()
+        shm.unlink()
+        raise
+    return shm
+
+
+class _RingView:
+    """环形缓冲区段在本进程中的视图：几何参数和 head/tail 原子变量"""
+    def __init__(self, shm: shared_memory.SharedMemory):
+        if segment_layout(shm) != LAYOUT_RING:
+            raise ValueError("段未使用环形缓冲区布局")
+        self.shm = shm
+        self.capacity, self.max_consumers, self.policy = struct.unpack_from(
+            META_FMT, shm.buf, META_OFFSET)
+        self.data_offset = _data_offset(self.max_consumers)
+        # 单条消息最多占数据区的一半，保证回绕标记 + 消息总能放下
+        self.max_message = self.capacity // 2 - RECORD_HEADER_SIZE
+        self.head = SharedMemoryAtomic(shm, HEAD_OFFSET, 8)
+        self.tail = SharedMemoryAtomic(shm, TAIL_OFFSET, 8)
+        self.publish_seq = SeqLock(shm, PUBLISH_SEQ_OFFSET)
+
+    def consumer_offset(self, index: int):
+        return CONSUMER_OFFSET + index * CONSUMER_SIZE
+
+    def cursor(self, index: int):
+        return SharedMemoryAtomic(self.shm, self.consumer_offset(index) + CONSUMER_CURSOR, 8)
+
+    def consumer_state(self, index: int):
+        return SharedMemoryAtomic(self.shm, self.consumer_offset(index) + CONSUMER_STATE, 4)
+
+    def dropped(self, index: int):
+        return struct.unpack_from("<Q", self.shm.buf,
+                                  self.consumer_offset(index) + CONSUMER_DROPPED)[0]
+
+    def record(self, pos: int):
+        """读取 pos 处的记录头，返回 (长度, 序号, 数据区内偏移)"""
+        off = pos % self.capacity
+        n, seq = struct.unpack_from(RECORD_FMT, self.shm.buf, self.data_offset + off)
+        return n, seq, off
+
+    def next_record(self, pos: int):
+        """返回 pos 处记录之后的位置"""
+        n, _, off = self.record(pos)
+        if n == WRAP_MARKER:
+            return pos + self.capacity - off
+        return pos + _align8(RECORD_HEADER_SIZE + n)
+
+
+class RingProducer:
+    """环形缓冲区的生产者（每个段同一时刻只能有一个生产者）
+
+    push 阻塞等待空间（RING_BLOCK）或覆盖最旧的消息（RING_OVERWRITE）；
+    写入完成后才原子地发布 head，消费者永远看不到写入一半的消息。
+    """
+    def __init__(self, shm: shared_memory.SharedMemory):
+        self.ring = _RingView(shm)
+        self.cursors = [self.ring.cursor(i) for i in range(self.ring.max_consumers)]
+        self.states = [self.ring.consumer_state(i) for i in range(self.ring.max_consumers)]
+        self._head = self.ring.head.load()
+        (self._seq,) = struct.unpack_from("<I", shm.buf, HEAD_SEQ_OFFSET)
+
+    def _min_cursor(self):
+        """活跃消费者中最慢的游标；没有消费者时返回 head"""
+        slowest = self._head
+        for state, cursor in zip(self.states, self.cursors):
+            if state.load() == CONSUMER_ACTIVE:
+                slowest = min(slowest, cursor.load())
+        return slowest
+
+    def _reserve(self, need: int, timeout):
+        """确保 [head, head + need) 可以写入：阻塞模式等待消费者，覆盖模式推进 tail"""
+        ring = self.ring
+        limit = self._head + need - ring.capacity
+        if ring.policy == RING_OVERWRITE:
+            tail = ring.tail.load()
+            if tail < limit:
+                # 先发布新的 tail，再覆盖数据；读到旧位置的消费者据此发现自己被覆盖
+                while tail < limit:
+                    tail = ring.next_record(tail)
+                ring.tail.store(tail)
+            return
+        if not _wait(lambda: self._min_cursor() >= limit, timeout):
+            raise RingFullError(f"环形缓冲区已满，等待消费者超时（{timeout}秒）")
+
+    def _append(self, data, timeout):
+        """写入一条消息（不发布 head）"""
+        ring = self.ring
+        n = len(data)
+        if n > ring.max_message:
+            raise ValueError(f"消息太长: {n} > {ring.max_message} bytes")
+        record = _align8(RECORD_HEADER_SIZE + n)
+        off = self._head % ring.capacity
+        contiguous = ring.capacity - off
+        need = record if record <= contiguous else contiguous + record
+        self._reserve(need, timeout)
+        buf = ring.shm.buf
+        if record > contiguous:
+            # 尾部放不下：写回绕标记，消息从数据区开头写入
+            struct.pack_into(RECORD_FMT, buf, ring.data_offset + off, WRAP_MARKER, self._seq)
+            self._head += contiguous
+            off = 0
+        start = ring.data_offset + off
+        struct.pack_into(RECORD_FMT, buf, start, n, self._seq)
+        buf[start+RECORD_HEADER_SIZE:start+RECORD_HEADER_SIZE+n] = data
+        self._head += record
+        self._seq = (self._seq + 1) & SEQ_MASK
+
+    def _publish(self):
+        """发布 head 及其对应的消息序号；两者由 seqlock 保护，新消费者能读到一致的一对"""
+        ring = self.ring
+        ring.publish_seq.write_begin()
+        struct.pack_into("<I", ring.shm.buf, HEAD_SEQ_OFFSET, self._seq)
+        ring.head.store(self._head)
+        ring.publish_seq.write_end()
+
+    def push(self, data, timeout: float = 5.0):
+        """追加一条消息；阻塞模式下队列满时最多等待 timeout 秒，超时抛出 RingFullError
+
+        timeout=0 时不等待，timeout=None 时一直等待。
+        """
+        self._append(data, timeout)
+        self._publish()
+
+    def try_push(self, data):
+        """不等待地追加一条消息，队列满时返回 False"""
+        try:
+            self.push(data, timeout=0)
+            return True
+        except RingFullError:
+            return False
+
+    def push_many(self, messages, timeout: float = 5.0):
+        """批量追加，所有消息写完后只发布一次 head；中途超时时已写入的消息仍会发布"""
+        try:
+            for data in messages:
+                self._append(data, timeout)
+        finally:
+            self._publish()
+
+
+class RingConsumer:
+    """环形缓冲区的消费者，认领段内的一个消费者槽位，从当前 head 开始读取
+
+    游标在每次 pop/pop_many 结束时原子地写回段内，生产者据此判断可用空间。
+    pop 系列方法的 timeout: None 为一直等待，0 为不等待。
+    """
+    def __init__(self, shm: shared_memory.SharedMemory):
+        self.ring = _RingView(shm)
+        self.index = None
+        for i in range(self.ring.max_consumers):
+            state = self.ring.consumer_state(i)
+            if state.compare_exchange(CONSUMER_FREE, CONSUMER_ACTIVE):
+                self.index = i
+                self.state = state
+                break
+        if self.index is None:
+            raise RuntimeError(f"消费者数已达上限: {self.ring.max_consumers}")
+        self.cursor = self.ring.cursor(self.index)
+        # 先认领再设置游标：认领后生产者最多按旧游标保守等待，不会覆盖尚未读取的消息
+        self._pos, self._seq = self._load_head()
+        self.cursor.store(self._pos)
+        self._dropped_offset = self.ring.consumer_offset(self.index) + CONSUMER_DROPPED
+        struct.pack_into("<Q", shm.buf, self._dropped_offset, 0)
+
+    def _load_head(self):
+        """读取一致的 (head, head 处消息的序号)"""
+        ring = self.ring
+        while True:
+            start = ring.publish_seq.read_begin()
+            if start is None:
+                continue
+            head = ring.head.load()
+            (seq,) = struct.unpack_from("<I", ring.shm.buf, HEAD_SEQ_OFFSET)
+            if ring.publish_seq.read_validate(start):
+                return head, seq
+
+    @property
+    def dropped(self):
+        """因生产者覆盖而跳过的消息数（仅覆盖模式）"""
+        return self.ring.dropped(self.index)
+
+    def lag(self):
+        """尚未读取的字节数"""
+        return self.ring.head.load() - self._pos
+
+    def _skip_overwritten(self, tail: int):
+        """游标落后于 tail（消息已被覆盖）时跳到 tail，按序号之差计入 dropped"""
+        _, seq, _ = self.ring.record(tail)
+        if self.ring.tail.load() != tail:
+            return  # tail 处的记录也已被覆盖，下一轮按新的 tail 重试
+        skipped = (seq - self._seq) & SEQ_MASK
+        struct.pack_into("<Q", self.ring.shm.buf, self._dropped_offset, self.dropped + skipped)
+        self._seq = seq
+        self._pos = tail
+
+    def _read_available(self, max_count: int):
+        """读取游标与 head 之间最多 max_count 条消息，不等待"""
+        ring = self.ring
+        buf = ring.shm.buf
+        overwrite = ring.policy == RING_OVERWRITE
+        head = ring.head.load()
+        messages = []
+        while self._pos < head and len(messages) < max_count:
+            if overwrite:
+                tail = ring.tail.load()
+                if self._pos < tail:
+                    self._skip_overwritten(tail)
+                    continue
+            n, seq, off = ring.record(self._pos)
+            if n == WRAP_MARKER:
+                self._pos += ring.capacity - off
+                continue
+            if n > ring.max_message:
+                if overwrite and ring.tail.load() > self._pos:
+                    continue  # 读到了正在被覆盖的记录，下一轮跳到 tail
+                raise RuntimeError(f"环形缓冲区数据损坏: 位置 {self._pos} 的消息长度 {n}")
+            start = ring.data_offset + off + RECORD_HEADER_SIZE
+            data = bytes(buf[start:start+n])
+            if overwrite and ring.tail.load() > self._pos:
+                continue  # 复制期间被覆盖，丢弃这次复制
+            messages.append(data)
+            self._pos += _align8(RECORD_HEADER_SIZE + n)
+            self._seq = (seq + 1) & SEQ_MASK
+        if messages or self.cursor.load() != self._pos:
+            self.cursor.store(self._pos)
+        return messages
+
+    def pop_many(self, max_count: int = DEFAULT_POP_BATCH, timeout: float = 5.0):
+        """批量读取：等待至少一条消息（最多 timeout 秒），返回最多 max_count 条，超时返回空列表"""
+        return _wait(lambda: self._read_available(max_count), timeout)
+
+    def pop(self, timeout: float = 5.0):
+        """读取一条消息，超时返回 None"""
+        messages = self.pop_many(1, timeout)
+        return messages[0] if messages else None
+
+    def try_pop(self):
+        """不等待地读取一条消息，没有消息时返回 None"""
+        return self.pop(timeout=0)
+
+    def close(self):
+        """释放消费者槽位，生产者不再等待该消费者"""
+        if self.index is not None:
+            self.state.store(CONSUMER_FREE)
+            self.index = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+
+def ring_stats(shm: shared_memory.SharedMemory):
+    """返回环形缓冲区的状态：head、tail、各活跃消费者的游标/积压/丢弃数"""
+    ring = _RingView(shm)
+    head = ring.head.load()
+    consumers = []
+    for i in range(ring.max_consumers):
+        if ring.consumer_state(i).load() == CONSUMER_ACTIVE:
+            cursor = ring.cursor(i).load()
+            consumers.append({"index": i, "cursor": cursor, "lag": head - cursor,
+                              "dropped": ring.dropped(i)})
+    return {"capacity": ring.capacity, "policy": ring.policy, "head": head,
+            "tail": ring.tail.load(), "consumers": consumers}
@@ -0,0 +1,1088 @@
+"""asyncio Host 服务模块
+单线程事件循环处理所有客户端连接（文本协议和二进制协议），替代每个连接一个线程的模型；
+SharedMemoryHost 在此之上管理共享内存段的生命周期，可脱离界面运行
+
+共享内存操作先以 timeout=0 在事件循环中直接执行；只有锁被占用、需要等待时，
+才交给一个小线程池执行，避免阻塞事件循环。
+环形缓冲区的流式订阅由一个泵任务统一转发：有消息时逐个订阅者非阻塞地批量读取，
+空闲时按退避间隔轮询（Host 本进程的 push 会立即唤醒）。
+增量订阅（SUBSCRIBE_DELTA，供副本 Host 复制）先收到完整快照，之后每次推送只包含
+相对上一次推送内容的补丁；订阅者持有的版本与上一次推送不一致时改为推送完整快照。
+每个连接的命令数、收发字节数和错误数总是记录（STATS 命令返回明细）；进程级的指标
+（见 shm_metrics）只在启用后记录。
+"""
+import asyncio
+import functools
+import json
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from shared_memory_utils import (
+    BUF_SIZE, LOCK_OFFSET, DATA_OFFSET, SYNC_UPDATE_CMD, LOCK_KIND_SPIN, LAYOUT_SINGLE,
+    ReadOnlyError, SegmentMovedError, VersionConflictError,
+    shm_read, shm_write, shm_read_bytes, shm_write_bytes, shm_patch, shm_read_if_newer, open_lock,
+    create_segment, grow_segment, segment_size, segment_capacity, segment_version, segment_layout,
+    host_token, diff_patch, mark_read_only
+)
+from shm_metrics import METRICS, MetricsServer
+from shm_snapshot import Snapshotter, read_snapshot_info, restore_snapshot, save_snapshot
+from shm_protocol import (
+    OP_READ, OP_WRITE, OP_SYNC_UPDATE, OP_SUBSCRIBE, OP_PATCH, OP_READ_IF_NEWER, OP_GET, OP_PUT,
+    OP_BATCH, OP_COMPRESS, OP_PING, OP_HOST_INFO, OP_STATS, OP_NAMES,
+    OP_OK, OP_ERROR, OP_NOTIFY, OP_CONFLICT, OP_NOT_MODIFIED, OP_NOT_FOUND, OP_MESSAGES, OP_DELTA,
+    SUBSCRIBE_VERSION, SUBSCRIBE_CONTENT, SUBSCRIBE_STREAM, SUBSCRIBE_DELTA, DELTA_BASE_ANY,
+    FRAME_HEADER_SIZE,
+    ProtocolError, pack_header, unpack_header, parse_proto_request, pack_notify, pack_delta,
+    pack_version, unpack_version, unpack_patch, unpack_put, pack_messages,
+    unpack_batch, pack_batch_results,
+    DEFAULT_CODECS, COMPRESS_THRESHOLD, NO_COMPRESSION, Compression, choose_codec
+)
+from shm_ring import (
+    RING_BLOCK, DEFAULT_MAX_CONSUMERS, RingConsumer, RingProducer, create_ring_segment
+)
+from shm_slots import SlotTable, create_slot_segment
+
+DEFAULT_BACKLOG = 128
+DEFAULT_MAX_CONNECTIONS = 1024
+DEFAULT_EXECUTOR_WORKERS = 4
+MAX_TEXT_WRITE = 1 << 30
+PUSH_HIGH_WATER = 8 * 1024 * 1024  # 订阅者发送缓冲超过该值视为过慢，断开连接
+STREAM_HIGH_WATER = 1024 * 1024    # 流式订阅者发送缓冲超过该值时暂停读取（背压到环形缓冲区）
+STREAM_BATCH = 256                 # 每个流式订阅者每轮最多转发的消息数
+STREAM_IDLE_MIN = 0.00005          # 泵任务空闲时的轮询间隔（秒），逐次翻倍
+STREAM_IDLE_MAX = 0.01
+
+# 一个操作造成的变更（批量请求取各操作中最大的一个，只通知一次）
+CHANGE_NONE = 0
+CHANGE_UPDATE = 1  # 只回调 on_update（槽位写入）
+CHANGE_WRITE = 2   # 单值内容变化，回调 on_update 并推送给订阅者
+TEXT_COMMANDS = ("READ_IF_NEWER", "READ", "WRITE", "PATCH", "GET", "PUT", "DONE", SYNC_UPDATE_CMD,
+                 "STATS", "PROTO")
+
+
+class ConnectionStats:
+    """单个连接的流量统计（只在事件循环线程中更新）"""
+    __slots__ = ("peer", "connected_at", "protocol", "commands", "bytes_in", "bytes_out", "errors",
+                 "gauged")
+
+    def __init__(self, peer):
+        self.peer = peer
+        self.gauged = False  # 是否已计入进程级的当前连接数（连接期间才启用指标时不计入）
+        self.connected_at = time.time()
+        self.protocol = "text"
+        self.commands = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.errors = 0
+
+    def as_dict(self):
+        peer = self.peer
+        return {
+            "peer": f"{peer[0]}:{peer[1]}" if isinstance(peer, tuple) else str(peer),
+            "protocol": self.protocol,
+            "connected_seconds": time.time() - self.connected_at,
+            "commands": self.commands,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "errors": self.errors,
+        }
+
+
+class AsyncHostServer:
+    """基于 asyncio 的 Host 服务，在后台线程中运行自己的事件循环
+
+    get_segment: 无参回调，返回当前的 (shm, lock)；段扩容后返回新段
+    shm_id: 元数据中发送给客户端的共享内存 ID（扩容后保持不变）
+    get_table: 无参回调，返回槽位布局的 SlotTable；为 None 或返回 None 时不支持 GET/PUT
+    get_ring: 无参回调，返回环形缓冲区段；为 None 或返回 None 时不支持 SUBSCRIBE_STREAM
+    codecs: 接受 Client 协商的压缩算法；compress_threshold: 小于该长度的负载不压缩
+    read_only: 为 True 时拒绝远程写入（副本 Host）
+    on_update: 远程写入成功后的回调 on_update(addr)，在事件循环线程中调用
+    on_status: 状态消息回调 on_status(message)，在事件循环线程中调用
+    """
+    def __init__(self, get_segment, shm_id: str, host: str = "0.0.0.0", port: int = 0,
+                 backlog: int = DEFAULT_BACKLOG, max_connections: int = DEFAULT_MAX_CONNECTIONS,
+                 executor_workers: int = DEFAULT_EXECUTOR_WORKERS,
+                 get_table=None, get_ring=None, codecs=DEFAULT_CODECS,
+                 compress_threshold: int = COMPRESS_THRESHOLD, read_only: bool = False,
+                 on_update=None, on_status=None):
+        self.get_segment = get_segment
+        self.get_table = get_table
+        self.get_ring = get_ring
+        self.codecs = tuple(codecs)
+        self.compress_threshold = compress_threshold
+        self.read_only = read_only
+        self.shm_id = shm_id
+        self.host = host
+        self.port = port
+        self.backlog = backlog
+        self.max_connections = max_connections
+        self.executor = ThreadPoolExecutor(max_workers=executor_workers,
+                                           thread_name_prefix="shm-io")
+        self.on_update = on_update
+        self.on_status = on_status
+        self.loop = None
+        self.server = None
+        self.thread = None
+        self.connections = set()
+        self.subscribers = {}  # StreamWriter -> 订阅模式
+        self.streams = {}      # StreamWriter -> RingConsumer（流式订阅者）
+        self.compression = {}  # StreamWriter -> Compression（协商了压缩的连接）
+        self.delta_bases = {}  # StreamWriter -> 增量订阅者持有的内容版本
+        self.pushed_versions = {}  # StreamWriter -> 已推送给版本/内容订阅者的最新版本
+        self.conn_stats = {}   # StreamWriter -> ConnectionStats
+        self._last_push = None  # 最近一次推送的 (版本, 内容)，计算增量的基准
+        self._push_pending = False
+        self._stream_task = None
+        self._stream_wakeup = None
+        self._stream_idle = False
+        self._started = threading.Event()
+        self._start_error = None
+
+    # ---- 生命周期 ----
+
+    def start(self):
+        """在后台线程中启动事件循环和监听，返回实际监听的 (host, port)"""
+        self.thread = threading.Thread(target=self._run, name="shm-host-loop", daemon=True)
+        self.thread.start()
+        self._started.wait()
+        if self._start_error is not None:
+            raise self._start_error
+        return self.server.sockets[0].getsockname()[:2]
+
+    def _run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.server = self.loop.run_until_complete(asyncio.start_server(
+                self._handle_connection, self.host, self.port, backlog=self.backlog))
+        except Exception as e:
+            self._start_error = e
+            self._started.set()
+            self.loop.close()
+            return
+        self._started.set()
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.run_until_complete(self._shutdown())
+            self.loop.close()
+
+    async def _shutdown(self):
+        self.server.close()
+        await self.server.wait_closed()
+        for writer in list(self.connections):
+            writer.close()
+        tasks = [t for t in asyncio.all_tasks(self.loop) if t is not asyncio.current_task()]
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stop(self):
+        """停止服务：关闭监听和所有连接，等待事件循环线程退出"""
+        if self.loop is not None and self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+        if self.thread is not None:
+            self.thread.join(timeout=5.0)
+        self.executor.shutdown(wait=False)
+
+    def connection_count(self):
+        return len(self.connections)
+
+    def stats(self):
+        """返回进程级指标（见 shm_metrics）、Host 状态和每个连接的统计明细（STATS 命令的结果）"""
+        result = METRICS.snapshot()
+        try:
+            shm, _ = self.get_segment()
+            result["host"] = {
+                "shm_id": self.shm_id,
+                "size": segment_size(shm),
+                "version": segment_version(shm),
+                "read_only": self.read_only,
+                "connections": len(self.connections),
+                "subscribers": len(self.subscribers),
+                "streams": len(self.streams),
+            }
+        except Exception:
+            pass  # Host 正在停止，段已释放
+        result["connections"] = [s.as_dict() for s in list(self.conn_stats.values())]
+        return result
+
+    def _count_in(self, writer, command, nbytes):
+        """记录收到的一条命令（每连接统计总是记录，进程级指标启用后记录）"""
+        stats = self.conn_stats.get(writer)
+        if stats is not None:
+            stats.commands += 1
+            stats.bytes_in += nbytes
+        if METRICS.enabled:
+            METRICS.tcp_commands.inc((command,))
+            METRICS.tcp_bytes.inc(("in",), nbytes)
+
+    def _count_in_body(self, writer, nbytes):
+        """记录文本命令之后的数据部分（WRITE/PATCH/PUT）"""
+        stats = self.conn_stats.get(writer)
+        if stats is not None:
+            stats.bytes_in += nbytes
+        if METRICS.enabled:
+            METRICS.tcp_bytes.inc(("in",), nbytes)
+
+    def _count_out(self, writer, nbytes, error=False):
+        stats = self.conn_stats.get(writer)
+        if stats is not None:
+            stats.bytes_out += nbytes
+            if error:
+                stats.errors += 1
+        if METRICS.enabled:
+            METRICS.tcp_bytes.inc(("out",), nbytes)
+            if error:
+                METRICS.tcp_errors.inc()
+
+    def _write_text(self, writer, data: bytes):
+        """发送一行文本响应（"ERROR" 开头的响应计入错误数）"""
+        writer.write(data)
+        self._count_out(writer, len(data), data.startswith(b"ERROR"))
+
+    def _status(self, message):
+        if self.on_status:
+            self.on_status(message)
+
+    # ---- 共享内存访问 ----
+
+    async def _run_shm(self, fn, *args):
+        """先不等待锁直接执行；锁被占用时改到线程池中按正常超时等待"""
+        try:
+            return fn(*args, timeout=0)
+        except TimeoutError:
+            return await self.loop.run_in_executor(self.executor, lambda: fn(*args))
+
+    def _single_segment(self):
+        """返回单值布局的 (shm, lock)；槽位布局的段不支持 READ/WRITE 等整段操作"""
+        shm, lock = self.get_segment()
+        if segment_layout(shm) != LAYOUT_SINGLE:
+            raise ValueError("段使用槽位布局，请使用 GET/PUT")
+        return shm, lock
+
+    def _check_writable(self):
+        if self.read_only:
+            raise ReadOnlyError()
+
+    def _table(self):
+        table = self.get_table() if self.get_table else None
+        if table is None:
+            raise ValueError("Host 未启用槽位布局")
+        return table
+
+    async def _read(self, as_text=False):
+        shm, lock = self._single_segment()
+        return await self._run_shm(shm_read if as_text else shm_read_bytes, shm, lock, DATA_OFFSET)
+
+    async def _read_if_newer(self, since_version):
+        """条件读取，返回 (版本号, 数据)；内容未变化时数据为 None"""
+        shm, lock = self._single_segment()
+        return await self._run_shm(shm_read_if_newer, shm, lock, since_version)
+
+    async def _write(self, data, as_text=False):
+        """写入共享内存（写入期间段被扩容时，改写到新段）"""
+        self._check_writable()
+        fn = shm_write if as_text else shm_write_bytes
+        try:
+            shm, lock = self._single_segment()
+            await self._run_shm(fn, shm, data, lock)
+        except SegmentMovedError:
+            shm, lock = self._single_segment()
+            await self._run_shm(fn, shm, data, lock)
+
+    async def _patch(self, offset, data, expected_version, truncate):
+        """在指定偏移处写入，返回写入后的版本号（写入期间段被扩容时，改写到新段）"""
+        self._check_writable()
+        fn = functools.partial(shm_patch, expected_version=expected_version, truncate=truncate)
+        try:
+            shm, lock = self._single_segment()
+            return await self._run_shm(fn, shm, offset, data, lock)
+        except SegmentMovedError:
+            shm, lock = self._single_segment()
+            return await self._run_shm(fn, shm, offset, data, lock)
+
+    async def _get(self, key):
+        """读取槽位，键不存在时返回 None"""
+        return await self._run_shm(self._table().get_bytes, key)
+
+    async def _put(self, key, value):
+        """写入槽位（只获取该槽位的锁，写其他槽位的请求不会被阻塞）"""
+        self._check_writable()
+        await self._run_shm(self._table().put_bytes, key, value)
+
+    def _send_frame(self, writer, opcode, request_id, payload=b"", flags=0):
+        """按连接协商的压缩方式发送一帧"""
+        flags, payload = self.compression.get(writer, NO_COMPRESSION).encode(payload, flags)
+        writer.writelines([pack_header(opcode, request_id, len(payload), flags), payload])
+        self._count_out(writer, FRAME_HEADER_SIZE + len(payload), opcode == OP_ERROR)
+
+    def _after_write(self, addr):
+        self.notify_threadsafe()
+        if self.on_update:
+            self.on_update(addr)
+
+    def _apply_change(self, addr, change):
+        if change == CHANGE_WRITE:
+            self._after_write(addr)
+        elif change == CHANGE_UPDATE and self.on_update:
+            self.on_update(addr)
+
+    async def _execute(self, opcode, flags, payload):
+        """执行一个数据操作（单独的请求帧或 BATCH 中的一项），返回 (响应操作码, 响应负载, 变更)"""
+        if opcode == OP_PING:
+            return OP_OK, b"", CHANGE_NONE
+        if opcode == OP_HOST_INFO:
+            return OP_OK, host_token().encode("utf-8"), CHANGE_NONE
+        if opcode == OP_STATS:
+            return OP_OK, json.dumps(self.stats(), ensure_ascii=False).encode("utf-8"), CHANGE_NONE
+        if opcode == OP_READ:
+            return OP_OK, await self._read(), CHANGE_NONE
+        if opcode == OP_WRITE:
+            # 负载为原始字节，直接写入
+            await self._write(payload)
+            return OP_OK, b"", CHANGE_WRITE
+        if opcode == OP_READ_IF_NEWER:
+            version, data = await self._read_if_newer(unpack_version(payload))
+            if data is None:
+                return OP_NOT_MODIFIED, pack_version(version), CHANGE_NONE
+            return OP_OK, pack_notify(version, data), CHANGE_NONE
+        if opcode == OP_PATCH:
+            try:
+                version = await self._patch(*unpack_patch(flags, payload))
+            except VersionConflictError as e:
+                return OP_CONFLICT, pack_version(e.actual), CHANGE_NONE
+            return OP_OK, pack_version(version), CHANGE_WRITE
+        if opcode == OP_GET:
+            data = await self._get(payload)
+            if data is None:
+                return OP_NOT_FOUND, b"", CHANGE_NONE
+            return OP_OK, data, CHANGE_NONE
+        if opcode == OP_PUT:
+            await self._put(*unpack_put(payload))
+            return OP_OK, b"", CHANGE_UPDATE
+        return OP_ERROR, f"未知操作码: {opcode}".encode("utf-8"), CHANGE_NONE
+
+    async def _execute_batch(self, payload):
+        """按顺序执行批量请求中的各项操作，返回 (结果列表, 变更)
+
+        各项操作各自原子，整个批量不是一个事务：某一项失败时以 ERROR 结果返回，后续操作照常执行。
+        """
+        results = []
+        change = CHANGE_NONE
+        for opcode, flags, op_payload in unpack_batch(payload):
+            try:
+                if opcode == OP_BATCH:
+                    raise ValueError("批量请求不能嵌套")
+                result, data, op_change = await self._execute(opcode, flags, op_payload)
+            except Exception as e:
+                result, data, op_change = OP_ERROR, str(e).encode("utf-8"), CHANGE_NONE
+            results.append((result, data))
+            change = max(change, op_change)
+        return results, change
+
+    # ---- 变更推送 ----
+
+    def notify_threadsafe(self):
+        """请求向订阅者推送最新版本（任意线程可调用，连续多次请求合并为一次推送）"""
+        if self.loop is None or self.loop.is_closed():
+            return
+        try:
+            self.loop.call_soon_threadsafe(self._schedule_push)
+        except RuntimeError:
+            pass  # 事件循环已关闭
+
+    def _schedule_push(self):
+        if self._push_pending or not self.subscribers:
+            return
+        self._push_pending = True
+        self.loop.create_task(self._push())
+
+    async def _push(self):
+        self._push_pending = False
+        subscribers = list(self.subscribers.items())
+        if not subscribers:
+            return
+        modes = {mode for _, mode in subscribers}
+        try:
+            shm, lock = self._single_segment()
+            if SUBSCRIBE_CONTENT in modes or SUBSCRIBE_DELTA in modes:
+                # 版本号和内容来自同一个一致快照，增量订阅者据此校验基准
+                version, content = await self._read_if_newer(None)
+            else:
+                version, content = segment_version(shm), b""
+        except Exception:
+            return
+        # 以下不再 await：并发的推送任务之间不会交错修改增量基准
+        base = self._last_push
+        if SUBSCRIBE_DELTA in modes and (base is None or version > base[0]):
+            self._last_push = (version, content)
+        patch = None
+        if base is not None and version > base[0]:
+            patch = diff_patch(base[1], content) or (len(content), b"", False)
+        encoded = {}  # (推送类型, 压缩算法) -> (flags, 负载)：相同内容只压缩一次
+        for writer, mode in subscribers:
+            transport = writer.transport
+            if transport.is_closing() or transport.get_write_buffer_size() > PUSH_HIGH_WATER:
+                # 订阅者过慢或已断开，停止推送并关闭连接
+                self.subscribers.pop(writer, None)
+                self.delta_bases.pop(writer, None)
+                self.pushed_versions.pop(writer, None)
+                writer.close()
+                continue
+            opcode = OP_NOTIFY
+            if mode == SUBSCRIBE_DELTA:
+                held = self.delta_bases.get(writer)
+                if held is not None and held >= version:
+                    continue  # 已持有该版本（或更新的版本）
+                opcode = OP_DELTA
+                kind = "delta" if patch is not None and held == base[0] else "snapshot"
+                self.delta_bases[writer] = version
+            else:
+                # 并发的推送任务读取内容后的完成顺序不定：已推送过更新的版本时不再推送旧版本
+                if self.pushed_versions.get(writer, -1) > version:
+                    continue
+                self.pushed_versions[writer] = version
+                kind = mode
+            compression = self.compression.get(writer, NO_COMPRESSION)
+            key = (kind, compression.codec)
+            if key not in encoded:
+                if kind == "delta":
+                    payload = pack_delta(base[0], version, *patch)
+                elif kind == "snapshot":
+                    payload = pack_delta(DELTA_BASE_ANY, version, 0, content, True)
+                else:
+                    payload = pack_notify(version, content if mode == SUBSCRIBE_CONTENT else b"")
+                encoded[key] = compression.encode(payload)
+            flags, payload = encoded[key]
+            writer.writelines([pack_header(opcode, 0, len(payload), flags), payload])
+            self._count_out(writer, FRAME_HEADER_SIZE + len(payload))
+
+    async def _subscribe_delta(self, writer):
+        """增量订阅：先推送完整快照，之后的推送以快照的版本为基准"""
+        version, content = await self._read_if_newer(None)
+        payload = pack_delta(DELTA_BASE_ANY, version, 0, content, True)
+        self._send_frame(writer, OP_DELTA, 0, payload)
+        self.subscribers[writer] = SUBSCRIBE_DELTA
+        self.delta_bases[writer] = version
+        self.pushed_versions.pop(writer, None)
+        base = self._last_push
+        if base is None or (version > base[0] and base[0] not in self.delta_bases.values()):
+            # 没有其他订阅者持有旧基准时，以快照作为下一次增量的基准
+            self._last_push = (version, content)
+
+    # ---- 环形缓冲区流式推送 ----
+
+    def _subscribe_stream(self, writer):
+        """为连接创建环形缓冲区消费者（从当前 head 开始），并确保泵任务在运行"""
+        ring = self.get_ring() if self.get_ring else None
+        if ring is None:
+            raise ValueError("Host 未启用环形缓冲区")
+        if writer not in self.streams:
+            self.streams[writer] = RingConsumer(ring)
+        if self._stream_task is None or self._stream_task.done():
+            self._stream_wakeup = asyncio.Event()
+            self._stream_task = self.loop.create_task(self._pump_streams())
+
+    def _unsubscribe_stream(self, writer):
+        consumer = self.streams.pop(writer, None)
+        if consumer is not None:
+            consumer.close()
+
+    def wake_streams_threadsafe(self):
+        """有新消息时唤醒空闲的泵任务（任意线程可调用；泵任务忙时不做任何事）"""
+        if not self._stream_idle or self.loop is None or self.loop.is_closed():
+            return
+        self._stream_idle = False
+        try:
+            self.loop.call_soon_threadsafe(self._stream_wakeup.set)
+        except RuntimeError:
+            pass  # 事件循环已关闭
+
+    async def _pump_streams(self):
+        """把各流式订阅者的新消息打包为 OP_MESSAGES 推送；发送缓冲过大的订阅者暂不读取"""
+        idle = STREAM_IDLE_MIN
+        while self.streams:
+            forwarded = False
+            for writer, consumer in list(self.streams.items()):
+                transport = writer.transport
+                if transport.is_closing():
+                    self._unsubscribe_stream(writer)
+                    continue
+                if transport.get_write_buffer_size() > STREAM_HIGH_WATER:
+                    continue
+                messages = consumer.pop_many(STREAM_BATCH, timeout=0)
+                if messages:
+                    self._send_frame(writer, OP_MESSAGES, 0, pack_messages(messages))
+                    forwarded = True
+            if forwarded:
+                idle = STREAM_IDLE_MIN
+                await asyncio.sleep(0)  # 让出事件循环，处理其他连接的请求
+                continue
+            self._stream_wakeup.clear()
+            self._stream_idle = True
+            try:
+                await asyncio.wait_for(self._stream_wakeup.wait(), idle)
+                idle = STREAM_IDLE_MIN
+            except asyncio.TimeoutError:
+                idle = min(idle * 2, STREAM_IDLE_MAX)
+            self._stream_idle = False
+
+    # ---- 连接处理 ----
+
+    async def _handle_connection(self, reader, writer):
+        addr = writer.get_extra_info("peername")
+        if len(self.connections) >= self.max_connections:
+            writer.write("ERROR 连接数已达上限\n".encode("utf-8"))
+            writer.close()
+            return
+        self.connections.add(writer)
+        stats = self.conn_stats[writer] = ConnectionStats(addr)
+        if METRICS.enabled:
+            stats.gauged = True
+            METRICS.tcp_connections.inc()
+        try:
+            shm, _ = self.get_segment()
+            size = segment_size(shm)
+            meta = f"{self.shm_id} {size} 0 {size-1} {LOCK_OFFSET} {DATA_OFFSET}\n"
+            self._write_text(writer, meta.encode("utf-8"))
+            await writer.drain()
+            self._status(f"客户端已连接: {addr}")
+            await self._serve_text(reader, writer, addr)
+        except (ConnectionError, asyncio.IncompleteReadError, ProtocolError):
+            pass
+        except asyncio.CancelledError:
+            pass  # 服务停止时取消，按正常关闭处理
+        except Exception as e:
+            self._status(f"连接错误: {e}")
+        finally:
+            self.connections.discard(writer)
+            stats = self.conn_stats.pop(writer, None)
+            if stats is not None and stats.gauged:
+                METRICS.tcp_connections.inc(amount=-1)
+            self.subscribers.pop(writer, None)
+            self.delta_bases.pop(writer, None)
+            self.pushed_versions.pop(writer, None)
+            self._unsubscribe_stream(writer)
+            self.compression.pop(writer, None)
+            writer.close()
+
+    async def _serve_text(self, reader, writer, addr):
+        """文本协议（兼容旧版客户端），收到 PROTO 后切换到二进制协议"""
+        while True:
+            line = await reader.readline()
+            if not line:
+                return
+            msg = line.decode("utf-8", errors="replace")
+            command = next((c for c in TEXT_COMMANDS if msg.startswith(c)), "UNKNOWN")
+            self._count_in(writer, command, len(line))
+
+            # 协商二进制协议：回应后切换到二进制帧
+            proto = parse_proto_request(msg)
+            if proto is not None:
+                self._write_text(writer, f"PROTO {proto}\n".encode("utf-8"))
+                await writer.drain()
+                if proto > 0:
+                    self.conn_stats[writer].protocol = "binary"
+                    await self._serve_binary(reader, writer, addr)
+                    return
+                continue
+
+            cmd = msg.strip()
+            if cmd == "READ":
+                try:
+                    content = await self._read(as_text=True)
+                    self._write_text(writer, f"OK {content}\n".encode("utf-8"))
+                except Exception as e:
+                    self._write_text(writer, f"ERROR {str(e)}\n".encode("utf-8"))
+            elif cmd.startswith("READ_IF_NEWER "):
+                # "READ_IF_NEWER <version>" -> "NOT_MODIFIED <version>" 或 "OK <version> <content>"
+                try:
+                    version, data = await self._read_if_newer(int(cmd[14:].strip()))
+                    if data is None:
+                        self._write_text(writer, f"NOT_MODIFIED {version}\n".encode("utf-8"))
+                    else:
+                        content = data.rstrip(b"\x00").decode("utf-8", errors="replace")
+                        self._write_text(writer, f"OK {version} {content}\n".encode("utf-8"))
+                except Exception as e:
+                    self._write_text(writer, f"ERROR {str(e)}\n".encode("utf-8"))
+            elif cmd.startswith("WRITE "):
+                # "WRITE <length>\n<content>\n"
+                try:
+                    length = int(cmd[6:].strip())
+                    if length < 0 or length > MAX_TEXT_WRITE:
+                        raise ValueError(f"无效的长度: {length}")
+                except ValueError as e:
+                    self._write_text(writer, f"ERROR {str(e)}\n".encode("utf-8"))
+                    await writer.drain()
+                    continue
+                body = await reader.readexactly(length + 1)  # +1 for final \n
+                self._count_in_body(writer, len(body))
+                try:
+                    await self._write(body[:length].decode("utf-8", errors="replace"), as_text=True)
+                    self._write_text(writer, b"OK\n")
+                    self._after_write(addr)
+                except Exception as e:
+                    self._write_text(writer, f"ERROR {str(e)}\n".encode("utf-8"))
+            elif cmd.startswith("PATCH "):
+                # "PATCH <offset> <length> <期望版本|-> <truncate 0|1>\n<data>\n"
+                try:
+                    fields = cmd.split()
+                    if len(fields) != 5:
+                        raise ValueError(f"无效的 PATCH 命令: {cmd}")
+                    offset, length = int(fields[1]), int(fields[2])
+                    expected_version = None if fields[3] == "-" else int(fields[3])
+                    truncate = fields[4] == "1"
+                    if length < 0 or length > MAX_TEXT_WRITE:
+                        raise ValueError(f"无效的长度: {length}")
+                except ValueError as e:
+                    self._write_text(writer, f"ERROR {str(e)}\n".encode("utf-8"))
+                    await writer.drain()
+                    continue
+                body = await reader.readexactly(length + 1)  # +1 for final \n
+                self._count_in_body(writer, len(body))
+                try:
+                    version = await self._patch(offset, body[:length], expected_version, truncate)
+                    self._write_text(writer, f"OK {version}\n".encode("utf-8"))
+                    self._after_write(addr)
+                except VersionConflictError as e:
+                    self._write_text(writer, f"CONFLICT {e.actual}\n".encode("utf-8"))
+                except Exception as e:
+                    self._write_text(writer, f"ERROR {str(e)}\n".encode("utf-8"))
+            elif cmd.startswith("GET "):
+                # "GET <key>" -> "OK <value>" 或 "NOT_FOUND"
+                try:
+                    data = await self._get(cmd[4:].strip())
+                    if data is None:
+                        self._write_text(writer, b"NOT_FOUND\n")
+                    else:
+                        self._write_text(writer, b"OK " + data + b"\n")
+                except Exception as e:
+                    self._write_text(writer, f"ERROR {str(e)}\n".encode("utf-8"))
+            elif cmd.startswith("PUT "):
+                # "PUT <key> <length>\n<value>\n"
+                try:
+                    fields = cmd.split()
+                    if len(fields) != 3:
+                        raise ValueError(f"无效的 PUT 命令: {cmd}")
+                    key, length = fields[1], int(fields[2])
+                    if length < 0 or length > MAX_TEXT_WRITE:
+                        raise ValueError(f"无效的长度: {length}")
+                except ValueError as e:
+                    self._write_text(writer, f"ERROR {str(e)}\n".encode("utf-8"))
+                    await writer.drain()
+                    continue
+                body = await reader.readexactly(length + 1)  # +1 for final \n
+                self._count_in_body(writer, len(body))
+                try:
+                    await self._put(key, body[:length])
+                    self._write_text(writer, b"OK\n")
+                    if self.on_update:
+                        self.on_update(addr)
+                except Exception as e:
+                    self._write_text(writer, f"ERROR {str(e)}\n".encode("utf-8"))
+            elif cmd == "STATS":
+                # "STATS" -> "OK <JSON>"（JSON 不含换行）
+                stats = json.dumps(self.stats(), ensure_ascii=False)
+                self._write_text(writer, f"OK {stats}\n".encode("utf-8"))
+            elif cmd == "DONE":
+                # 兼容旧协议：客户端写入完成
+                self._after_write(addr)
+            elif cmd == SYNC_UPDATE_CMD:
+                # 客户端请求同步更新
+                if self.on_update:
+                    self.on_update(addr)
+            await writer.drain()
+
+    async def _serve_binary(self, reader, writer, addr):
+        """二进制帧协议"""
+        sock = writer.get_extra_info("socket")
+        if sock is not None:
+            # 小帧（响应、推送）立即发出，避免 Nagle 算法与延迟确认叠加造成约 40ms 延迟
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        def reply(opcode, request_id, payload=b""):
+            self._send_frame(writer, opcode, request_id, payload)
+
+        while True:
+            opcode, flags, request_id, length = unpack_header(
+                await reader.readexactly(FRAME_HEADER_SIZE))
+            payload = await reader.readexactly(length) if length else b""
+            self._count_in(writer, OP_NAMES.get(opcode, "UNKNOWN"), FRAME_HEADER_SIZE + length)
+            flags, payload = self.compression.get(writer, NO_COMPRESSION).decode(flags, payload)
+            try:
+                if opcode == OP_COMPRESS:
+                    # 响应本身不压缩，之后的帧按选定的算法压缩
+                    codec = choose_codec(payload, self.codecs)
+                    reply(OP_OK, request_id, bytes([codec]))
+                    self.compression[writer] = Compression(codec, self.compress_threshold)
+                elif opcode == OP_BATCH:
+                    results, change = await self._execute_batch(payload)
+                    reply(OP_OK, request_id, pack_batch_results(results))
+                    self._apply_change(addr, change)
+                elif opcode == OP_SYNC_UPDATE:
+                    # 本机 Client 直接写入共享内存后发送，同样推送给订阅者
+                    reply(OP_OK, request_id)
+                    self._after_write(addr)
+                elif opcode == OP_SUBSCRIBE:
+                    mode = payload[0] if payload else SUBSCRIBE_VERSION
+                    if mode == SUBSCRIBE_STREAM:
+                        self._subscribe_stream(writer)
+                        reply(OP_OK, request_id)
+                    elif mode == SUBSCRIBE_DELTA:
+                        # 快照先于响应发出；响应负载回传模式，旧版 Host 的响应没有负载
+                        await self._subscribe_delta(writer)
+                        reply(OP_OK, request_id, bytes([SUBSCRIBE_DELTA]))
+                    else:
+                        self.subscribers[writer] = mode
+                        self.delta_bases.pop(writer, None)
+                        reply(OP_OK, request_id)
+                else:
+                    result, data, change = await self._execute(opcode, flags, payload)
+                    reply(result, request_id, data)
+                    self._apply_change(addr, change)
+            except Exception as e:
+                reply(OP_ERROR, request_id, str(e).encode("utf-8"))
+            await writer.drain()
+
+
+def release_lock(lock):
+    """销毁锁占用的系统资源（信号量锁需要 unlink）"""
+    if hasattr(lock, "unlink"):
+        try:
+            lock.unlink()
+        finally:
+            lock.close()
+
+
+class SharedMemoryHost:
+    """无界面的 Host：创建共享内存段并通过 AsyncHostServer 对外提供服务
+
+    slots: 大于 0 时段使用槽位布局（键值表），通过 get/put 访问；slot_size 为定长槽位的容量，
+           0 表示变长槽位
+    ring_size: 大于 0 时另外创建该容量的环形缓冲区段，通过 push/push_many 发布消息，
+               远程客户端以 SUBSCRIBE_STREAM 订阅；ring_policy 为满队列策略
+    codecs / compress_threshold: 接受的压缩算法和压缩阈值（见 AsyncHostServer）
+    read_only: 为 True 时拒绝远程写入，并在段头中置只读标志（本机 Client 同样不直接写入），
+               内容只能由本进程的 write/patch 修改（副本 Host，见 shm_replica）
+    metrics_port: 不为 None 时启用本进程的指标记录，并在 127.0.0.1 的该端口（0 = 随机）提供
+                  HTTP 指标端点（见 shm_metrics.MetricsServer）
+    snapshot_path: 快照文件路径（见 shm_snapshot）；设置后停止时保存最后一次快照，可调用 snapshot()
+    snapshot_interval: 大于 0 时每隔该秒数检查一次，内容变化时保存快照
+    warm_start: 为 True 且快照文件存在时，启动时先从快照恢复内容（段不够大时按快照的段大小创建）
+    on_update: 远程写入后的回调 on_update(addr)，在服务线程中调用
+    on_status: 状态消息回调 on_status(message)，在服务线程中调用
+    """
+    def __init__(self, size: int = BUF_SIZE, lock_kind: int = LOCK_KIND_SPIN,
+                 host: str = "0.0.0.0", port: int = 0, backlog: int = DEFAULT_BACKLOG,
+                 max_connections: int = DEFAULT_MAX_CONNECTIONS, slots: int = 0,
+                 slot_size: int = 0, ring_size: int = 0, ring_policy: int = RING_BLOCK,
+                 ring_consumers: int = DEFAULT_MAX_CONSUMERS, codecs=DEFAULT_CODECS,
+                 compress_threshold: int = COMPRESS_THRESHOLD, read_only: bool = False,
+                 metrics_port: int = None, snapshot_path: str = None,
+                 snapshot_interval: float = 0, warm_start: bool = False,
+                 on_update=None, on_status=None):
+        self.size = size
+        self.ring_size = ring_size
+        self.ring_policy = ring_policy
+        self.ring_consumers = ring_consumers
+        self.codecs = codecs
+        self.compress_threshold = compress_threshold
+        self.read_only = read_only
+        self.metrics_port = metrics_port
+        self.metrics_server = None
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self.warm_start = warm_start
+        self.snapshotter = None
+        self.restored = None  # 热启动时恢复的快照（SnapshotInfo）
+        self.lock_kind = lock_kind
+        self.slots = slots
+        self.slot_size = slot_size
+        self.host = host
+        self.port = port
+        self.backlog = backlog
+        self.max_connections = max_connections
+        self.on_update = on_update
+        self.on_status = on_status
+        # 当前的 (shm, lock)：扩容时整体替换，服务线程读到的段和锁总是配套的
+        self.segment = (None, None)
+        self.table = None  # 槽位布局时的 SlotTable
+        self.ring_shm = None  # 环形缓冲区段（本机进程可按名称挂载并创建 RingConsumer）
+        self.producer = None
+        self.shm_id = None  # 对外公开的 shm_id（扩容后保持不变）
+        self.server = None
+        self.address = None  # 实际监听的 (host, port)
+        self.retired_segments = []  # 扩容后保留的旧段（停止时释放）
+
+    @property
+    def shm(self):
+        return self.segment[0]
+
+    @property
+    def lock(self):
+        return self.segment[1]
+
+    @property
+    def running(self):
+        return self.server is not None
+
+    @property
+    def capacity(self):
+        """当前段可存放的最大数据长度"""
+        return segment_capacity(self.shm)
+
+    def start(self):
+        """创建共享内存段并启动服务，返回实际监听的 (host, port)"""
+        snapshot = None
+        if self.warm_start and self.snapshot_path and os.path.exists(self.snapshot_path):
+            snapshot = read_snapshot_info(self.snapshot_path)
+        size = self.size if snapshot is None else max(self.size, snapshot.segment_size)
+        if self.slots:
+            shm = create_slot_segment(size, self.slots, self.slot_size, self.lock_kind)
+            self.table = SlotTable(shm)
+        else:
+            shm = create_segment(size, lock_kind=self.lock_kind)
+        if self.read_only:
+            mark_read_only(shm)
+        self.shm_id = shm.name
+        self.segment = (shm, open_lock(shm))
+        try:
+            if snapshot is not None:
+                # 在开始服务之前恢复，客户端连接后看到的就是快照的内容
+                self.restored = restore_snapshot(self.snapshot_path, self.shm, self.lock,
+                                                 self.table)
+            if self.ring_size:
+                self.ring_shm = create_ring_segment(self.ring_size, self.ring_consumers,
+                                                    self.ring_policy)
+                self.producer = RingProducer(self.ring_shm)
+            self.server = AsyncHostServer(
+                lambda: self.segment, self.shm_id, host=self.host, port=self.port,
+                backlog=self.backlog, max_connections=self.max_connections,
+                get_table=lambda: self.table, get_ring=lambda: self.ring_shm,
+                codecs=self.codecs, compress_threshold=self.compress_threshold,
+                read_only=self.read_only, on_update=self.on_update, on_status=self.on_status)
+            self.address = self.server.start()
+            if self.metrics_port is not None:
+                self.metrics_server = MetricsServer(self.metrics_port, stats=self.stats)
+                self.metrics_server.start()
+            if self.snapshot_path:
+                self.snapshotter = Snapshotter(
+                    self.snapshot_path, lambda: self.segment + (self.table,),
+                    self.snapshot_interval or 1.0, on_snapshot=self._on_snapshot)
+                if self.snapshot_interval > 0:
+                    self.snapshotter.start()
+        except Exception:
+            if self.server is not None:
+                self.server.stop()
+            self.server = None
+            self._release_segments()
+            raise
+        return self.address
+
+    def stop(self):
+        """停止服务并释放所有共享内存段（设置了快照文件时在释放前保存最后一次快照）"""
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+            self.metrics_server = None
+        if self.server:
+            self.server.stop()
+            self.server = None
+        self.address = None
+        if self.snapshotter is not None:
+            # 服务停止后不再有写入，最后一次快照包含所有已接受的修改
+            self.snapshotter.stop()
+            if self.shm:
+                try:
+                    self.snapshotter.snapshot(force=False)
+                except Exception as e:
+                    self._on_snapshot(None, e)
+            self.snapshotter = None
+        self._release_segments()
+
+    @property
+    def metrics_address(self):
+        """HTTP 指标端点实际监听的 (host, port)，未启用时为 None"""
+        return self.metrics_server.address if self.metrics_server is not None else None
+
+    def stats(self):
+        """返回与 STATS 命令相同的指标和连接明细"""
+        server = self.server
+        if server is None:
+            raise RuntimeError("Host 未启动")
+        return server.stats()
+
+    def snapshot(self, path: str = None):
+        """立即保存快照并返回 SnapshotInfo（不持有写锁，见 shm_snapshot）
+
+        path 为 None 时保存到 snapshot_path。
+        """
+        if not self.shm:
+            raise RuntimeError("共享内存未创建")
+        if path is None or path == self.snapshot_path:
+            if self.snapshotter is None:
+                raise ValueError("未设置快照文件")
+            return self.snapshotter.snapshot()
+        return save_snapshot(path, self.shm, self.lock, self.table)
+
+    def _on_snapshot(self, info, error):
+        if error is not None and self.on_status:
+            self.on_status(f"保存快照失败: {error}")
+
+    def _release_segments(self):
+        if self.shm:
+            release_lock(self.lock)
+            if self.table is not None:
+                release_lock(self.table)
+                self.table = None
+            try:
+                self.shm.close()
+            finally:
+                self.shm.unlink()
+            self.segment = (None, None)
+            self.shm_id = None
+        # 释放扩容前保留的旧段
+        for old_shm, old_lock in self.retired_segments:
+            try:
+                release_lock(old_lock)
+                old_shm.close()
+                old_shm.unlink()
+            except Exception:
+                pass
+        self.retired_segments = []
+        if self.ring_shm:
+            self.producer = None
+            try:
+                self.ring_shm.close()
+            finally:
+                self.ring_shm.unlink()
+            self.ring_shm = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+        return False
+
+    def grow(self, new_size: int):
+        """在线扩容：分配更大的段并通过 redirect 发布，读者无需重启即可迁移"""
+        if not self.shm:
+            raise RuntimeError("共享内存未创建")
+        old_segment = self.segment
+        new_shm = grow_segment(old_segment[0], old_segment[1], new_size)
+        # 先打开新段的锁再一次性发布 (shm, lock)，服务线程不会拿到新段配旧锁
+        new_segment = (new_shm, open_lock(new_shm))
+        # 旧段保留到 Host 停止，供仍挂载旧段的读者沿 redirect 迁移
+        self.retired_segments.append(old_segment)
+        self.segment = new_segment
+        return new_shm
+
+    def read(self):
+        """读取共享内存中的文本"""
+        shm, lock = self.segment
+        return shm_read(shm, lock, DATA_OFFSET)
+
+    def read_bytes(self):
+        """读取共享内存中的原始字节"""
+        shm, lock = self.segment
+        return shm_read_bytes(shm, lock)
+
+    @property
+    def version(self):
+        """段内容的版本号（每次写入 +1）"""
+        return segment_version(self.shm)
+
+    def read_if_newer(self, since_version):
+        """条件读取文本，返回 (版本号, 文本)；版本号未变化时不复制数据，文本为 None"""
+        shm, lock = self.segment
+        version, data = shm_read_if_newer(shm, lock, since_version)
+        if data is None:
+            return version, None
+        return version, data.rstrip(b"\x00").decode("utf-8", errors="replace")
+
+    def write(self, text: str):
+        """写入文本并通知订阅的客户端（写入期间段被扩容时，改写到新段）"""
+        try:
+            shm, lock = self.segment
+            shm_write(shm, text, lock)
+        except SegmentMovedError:
+            shm, lock = self.segment
+            shm_write(shm, text, lock)
+        self.notify()
+
+    def write_bytes(self, data):
+        """写入原始字节并通知订阅的客户端（写入期间段被扩容时，改写到新段）"""
+        try:
+            shm, lock = self.segment
+            shm_write_bytes(shm, data, lock)
+        except SegmentMovedError:
+            shm, lock = self.segment
+            shm_write_bytes(shm, data, lock)
+        self.notify()
+
+    def patch(self, offset: int, data, expected_version: int = None, truncate: bool = False):
+        """在数据区的 offset 处写入（可选按版本号条件写入），返回写入后的版本号
+
+        写入期间段被扩容时，改写到新段。
+        """
+        fn = functools.partial(shm_patch, expected_version=expected_version, truncate=truncate)
+        try:
+            shm, lock = self.segment
+            version = fn(shm, offset, data, lock)
+        except SegmentMovedError:
+            shm, lock = self.segment
+            version = fn(shm, offset, data, lock)
+        self.notify()
+        return version
+
+    def _require_table(self):
+        if self.table is None:
+            raise RuntimeError("Host 未启用槽位布局")
+        return self.table
+
+    def get(self, key):
+        """读取槽位中的文本，键不存在时返回 None"""
+        return self._require_table().get(key)
+
+    def get_bytes(self, key):
+        """读取槽位中的原始字节，键不存在时返回 None"""
+        return self._require_table().get_bytes(key)
+
+    def put(self, key, value: str):
+        """写入槽位（键不存在时新建）"""
+        self._require_table().put(key, value)
+
+    def put_bytes(self, key, data):
+        """以原始字节写入槽位（键不存在时新建）"""
+        self._require_table().put_bytes(key, data)
+
+    def _require_producer(self):
+        if self.producer is None:
+            raise RuntimeError("Host 未启用环形缓冲区")
+        return self.producer
+
+    def push(self, data, timeout: float = 5.0):
+        """向环形缓冲区追加一条消息（str 按 UTF-8 编码），并唤醒流式推送"""
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self._require_producer().push(data, timeout)
+        if self.server:
+            self.server.wake_streams_threadsafe()
+
+    def push_many(self, messages, timeout: float = 5.0):
+        """批量追加消息，只发布一次 head"""
+        self._require_producer().push_many(
+            [m.encode("utf-8") if isinstance(m, str) else m for m in messages], timeout)
+        if self.server:
+            self.server.wake_streams_threadsafe()
+
+    def notify(self):
+        """通知已订阅的客户端进行更新（连续多次写入会合并为一次推送）"""
+        if self.server:
+            self.server.notify_threadsafe()
@@ -0,0 +1,380 @@
+"""槽位布局模块
+在一个共享内存段中存放多条互相独立的记录（键 → 值），每个槽位有自己的锁、序列计数器和长度字段，
+写不同槽位的写者之间互不争用
+
+段布局（段头与单值布局相同，LAYOUT_OFFSET 处记为 LAYOUT_SLOTS）:
+    偏移            大小             内容
+    0               64               段头（见 shared_memory_utils）
+    64              4                slot_count   槽位目录的容量
+    68              4                slot_size    定长槽位的数据容量，0 = 变长槽位
+    72              4                used         已使用的目录项数（目录项只增不删）
+    76              4                dir_lock     目录锁字，只在新建键时获取
+    80              8                next_free    变长槽位的下一个可分配位置
+    88              8                保留
+    96              64 * slot_count  槽位目录
+    ...             ...              槽位区
+
+目录项（64 字节）:
+    0     8     region      槽位区的偏移（变长槽位迁移时改写）
+    8     4     capacity    槽位数据容量
+    12    2     key_len     键长度
+    14    2     保留
+    16    48    key         键（UTF-8）
+
+槽位区（8 字节对齐）:
+    0     8     seq         该槽位的 seqlock 序列计数器
+    8     4     lock_word   该槽位的锁字
+    12    4     str_len     数据长度
+    16    ...   data        数据
+
+变长槽位的容量在新建键时确定；之后写入更长的值时，在槽位区末尾分配容量至少翻倍的新区域，
+写好数据后在目录锁下改写目录项（旧区域不回收）。其他进程缓存的旧槽位在读写时核对目录项，
+发现已迁移后改用新区域。定长槽位的容量固定，写入超过 slot_size 的值抛出 ValueError。
+"""
+import struct
+import threading
+import time
+from multiprocessing import shared_memory
+
+from shared_memory_utils import (
+    HEADER_SIZE, LAYOUT_OFFSET, LAYOUT_SLOTS, LOCK_KIND_SPIN, READ_MODE_SEQLOCK,
+    WRITE_FILL_DELTA, SegmentMovedError, _write_locked, create_segment, segment_size,
+    segment_layout, segment_redirect, open_lock, shm_read_bytes
+)
+from shm_metrics import METRICS
+
+TABLE_OFFSET = HEADER_SIZE
+SLOT_COUNT_OFFSET = TABLE_OFFSET
+SLOT_SIZE_OFFSET = TABLE_OFFSET + 4
+USED_OFFSET = TABLE_OFFSET + 8
+DIR_LOCK_OFFSET = TABLE_OFFSET + 12   # 4 字节对齐，支持原子 CAS
+NEXT_FREE_OFFSET = TABLE_OFFSET + 16
+DIR_OFFSET = TABLE_OFFSET + 32
+U32_FMT = "<I"
+U64_FMT = "<Q"
+
+DIR_ENTRY_FMT = "<QIH2x"
+DIR_ENTRY_SIZE = 64
+MAX_KEY_SIZE = DIR_ENTRY_SIZE - struct.calcsize(DIR_ENTRY_FMT)
+
+SLOT_SEQ = 0
+SLOT_LOCK = 8
+SLOT_LEN = 12
+SLOT_HEADER_SIZE = 16
+MIN_SLOT_CAPACITY = 64  # 变长槽位未指定容量时的最小容量
+
+
+def _align8(n: int):
+    return (n + 7) & ~7
+
+
+def _encode_key(key):
+    data = key.encode("utf-8") if isinstance(key, str) else bytes(key)
+    if not data:
+        raise ValueError("键不能为空")
+    if len(data) > MAX_KEY_SIZE:
+        raise ValueError(f"键太长: {len(data)} > {MAX_KEY_SIZE} bytes")
+    return data
+
+
+def _data_start(slot_count: int):
+    return _align8(DIR_OFFSET + slot_count * DIR_ENTRY_SIZE)
+
+
+def init_slot_table(shm: shared_memory.SharedMemory, slot_count: int, slot_size: int = 0):
+    """在已初始化段头的段上建立槽位布局
+
+    slot_size > 0 时为定长槽位，每个槽位的数据容量都是 slot_size，槽位区在此预先划分；
+    slot_size = 0 时为变长槽位，新建键时按需从槽位区分配。
+    """
+    if slot_count <= 0:
+        raise ValueError(f"槽位数必须大于 0: {slot_count}")
+    if slot_size < 0:
+        raise ValueError(f"槽位大小不能为负数: {slot_size}")
+    start = _data_start(slot_count)
+    need = start + (slot_count * _align8(SLOT_HEADER_SIZE + slot_size) if slot_size else 0)
+    size = segment_size(shm)
+    if need > size:
+        raise ValueError(f"段大小不足以容纳 {slot_count} 个槽位: {need} > {size} bytes")
+    buf = shm.buf
+    buf[TABLE_OFFSET:start] = bytes(start - TABLE_OFFSET)
+    struct.pack_into(U32_FMT, buf, SLOT_COUNT_OFFSET, slot_count)
+    struct.pack_into(U32_FMT, buf, SLOT_SIZE_OFFSET, slot_size)
+    struct.pack_into(U64_FMT, buf, NEXT_FREE_OFFSET, start)
+    buf[LAYOUT_OFFSET] = LAYOUT_SLOTS
+
+
+def create_slot_segment(size: int, slot_count: int, slot_size: int = 0,
+                        lock_kind: int = LOCK_KIND_SPIN):
+    """创建使用槽位布局的共享内存段"""
+    shm = create_segment(size, lock_kind=lock_kind)
+    try:
+        init_slot_table(shm, slot_count, slot_size)
+    except Exception:
+        shm.close()
+        shm.unlink()
+        raise
+    return shm
+
+
+class _Slot:
+    """一个槽位在本进程中的访问对象（目录项位置、锁、数据区位置）"""
+    __slots__ = ("entry", "region", "capacity", "lock", "data_offset", "buf_size")
+
+    def __init__(self, shm, entry: int, region: int, capacity: int):
+        self.entry = entry
+        self.region = region
+        self.capacity = capacity
+        self.lock = open_lock(shm, region + SLOT_LOCK, region + SLOT_SEQ)
+        self.data_offset = region + SLOT_HEADER_SIZE
+        self.buf_size = self.data_offset + capacity
+
+
+class SlotTable:
+    """槽位布局的段上的键值表
+
+    读写只获取对应槽位的锁（读取默认走该槽位的 seqlock，不加锁）；
+    只有第一次写入某个键（新建目录项）或变长槽位需要迁移时才获取目录锁。目录项只增不删，
+    本进程缓存的键 → 槽位映射只在槽位迁移后失效，每次读写时核对目录项中的区域偏移。
+    """
+    def __init__(self, shm: shared_memory.SharedMemory):
+        if segment_layout(shm) != LAYOUT_SLOTS:
+            raise ValueError("段未使用槽位布局")
+        self.shm = shm
+        (self.slot_count,) = struct.unpack_from(U32_FMT, shm.buf, SLOT_COUNT_OFFSET)
+        (self.slot_size,) = struct.unpack_from(U32_FMT, shm.buf, SLOT_SIZE_OFFSET)
+        self.dir_lock = open_lock(shm, DIR_LOCK_OFFSET)
+        self._slots = {}     # 键 -> _Slot
+        self._retired = []   # 已迁移的旧槽位（关闭时释放锁句柄）
+        self._scanned = 0    # 已扫描进缓存的目录项数
+        self._cache_lock = threading.Lock()
+
+    def _used(self):
+        (used,) = struct.unpack_from(U32_FMT, self.shm.buf, USED_OFFSET)
+        return min(used, self.slot_count)
+
+    def _scan(self):
+        """把其他进程新建的目录项加入缓存（调用方持有 _cache_lock）"""
+        used = self._used()
+        buf = self.shm.buf
+        for i in range(self._scanned, used):
+            entry = DIR_OFFSET + i * DIR_ENTRY_SIZE
+            region, capacity, key_len = struct.unpack_from(DIR_ENTRY_FMT, buf, entry)
+            key_start = entry + struct.calcsize(DIR_ENTRY_FMT)
+            key = bytes(buf[key_start:key_start+key_len])
+            self._slots[key] = _Slot(self.shm, entry, region, capacity)
+        self._scanned = used
+
+    def _find(self, key: bytes):
+        slot = self._slots.get(key)
+        if slot is None:
+            with self._cache_lock:
+                self._scan()
+                slot = self._slots.get(key)
+        return slot
+
+    def _moved(self, slot: _Slot):
+        """目录项是否已指向其他区域（槽位已被迁移）"""
+        (region,) = struct.unpack_from(U64_FMT, self.shm.buf, slot.entry)
+        return region != slot.region
+
+    def _current(self, key: bytes, slot: _Slot):
+        """返回键当前的槽位：缓存的槽位已被迁移时重新读取目录项"""
+        if not self._moved(slot):
+            return slot
+        with self._cache_lock:
+            current = self._slots[key]
+            if current is slot:
+                # 迁移时先写容量再写区域偏移，读到新偏移时容量也是新的
+                region, capacity, _ = struct.unpack_from(DIR_ENTRY_FMT, self.shm.buf, slot.entry)
+                current = self._slots[key] = _Slot(self.shm, slot.entry, region, capacity)
+                self._retired.append(slot)
+            return current
+
+    def _allocate(self, capacity: int):
+        """从槽位区末尾分配一个区域（调用方持有目录锁），空间不足时返回 None"""
+        buf = self.shm.buf
+        (region,) = struct.unpack_from(U64_FMT, buf, NEXT_FREE_OFFSET)
+        end = region + SLOT_HEADER_SIZE + capacity
+        if end > segment_size(self.shm):
+            return None
+        struct.pack_into(U64_FMT, buf, NEXT_FREE_OFFSET, end)
+        return region
+
+    def _create(self, key: bytes, capacity: int, timeout: float):
+        """在目录锁保护下新建目录项并分配槽位区；键已被其他进程创建时直接返回"""
+        self.dir_lock.acquire(timeout)
+        try:
+            with self._cache_lock:
+                self._scan()
+                slot = self._slots.get(key)
+                if slot is not None:
+                    return slot
+                index = self._used()
+                if index >= self.slot_count:
+                    raise ValueError(f"槽位已满: {self.slot_count}")
+                buf = self.shm.buf
+                if self.slot_size:
+                    capacity = self.slot_size
+                    region = _data_start(self.slot_count) + index * _align8(
+                        SLOT_HEADER_SIZE + capacity)
+                else:
+                    capacity = _align8(max(capacity, MIN_SLOT_CAPACITY))
+                    region = self._allocate(capacity)
+                    if region is None:
+                        raise ValueError(f"槽位空间不足: 需要 {capacity} bytes")
+                entry = DIR_OFFSET + index * DIR_ENTRY_SIZE
+                key_start = entry + struct.calcsize(DIR_ENTRY_FMT)
+                struct.pack_into(DIR_ENTRY_FMT, buf, entry, region, capacity, len(key))
+                buf[key_start:key_start+len(key)] = key
+                # 目录项写完后才发布，其他进程只读取 used 之内的目录项
+                struct.pack_into(U32_FMT, buf, USED_OFFSET, index + 1)
+                slot = _Slot(self.shm, entry, region, capacity)
+                self._slots[key] = slot
+                self._scanned = index + 1
+                return slot
+        finally:
+            self.dir_lock.release()
+
+    def _relocate(self, key: bytes, slot: _Slot, data, timeout: float):
+        """把变长槽位迁移到容量更大的新区域并写入 data（调用方持有旧槽位的锁）
+
+        新区域写好数据后才改写目录项，读者不会读到空的新槽位。
+        """
+        n = len(data)
+        self.dir_lock.acquire(timeout)
+        try:
+            # 容量至少翻倍，值逐渐变长时不会每次写入都迁移；空间不够翻倍时只分配所需的容量
+            capacity = _align8(max(n, 2 * slot.capacity))
+            region = self._allocate(capacity)
+            if region is None:
+                capacity = _align8(n)
+                region = self._allocate(capacity)
+                if region is None:
+                    raise ValueError(f"槽位空间不足: 需要 {capacity} bytes")
+            buf = self.shm.buf
+            # 序列计数器沿用旧槽位，版本号单调递增
+            struct.pack_into(U64_FMT, buf, region + SLOT_SEQ, slot.lock.seqlock.load())
+            new = _Slot(self.shm, slot.entry, region, capacity)
+            _write_locked(self.shm, data, new.lock, new.data_offset, new.buf_size,
+                          WRITE_FILL_DELTA)
+            # 先写容量再写区域偏移：其他进程读到新偏移时容量也是新的
+            struct.pack_into(U32_FMT, buf, slot.entry + 8, capacity)
+            struct.pack_into(U64_FMT, buf, slot.entry, region)
+            with self._cache_lock:
+                self._slots[key] = new
+                self._retired.append(slot)
+        finally:
+            self.dir_lock.release()
+
+    def _write(self, key: bytes, slot: _Slot, data, timeout: float):
+        """在槽位锁内核对目录项后写入，槽位已被迁移时返回 False（由调用方刷新后重试）"""
+        slot.lock.acquire(timeout)
+        try:
+            # 段已迁移时拒绝写入旧段，避免数据丢失
+            new_name = segment_redirect(self.shm)
+            if new_name is not None:
+                raise SegmentMovedError(new_name)
+            if self._moved(slot):
+                return False
+            relocate = len(data) > slot.capacity
+            if relocate:
+                self._relocate(key, slot, data, timeout)
+            else:
+                _write_locked(self.shm, data, slot.lock, slot.data_offset, slot.buf_size,
+                              WRITE_FILL_DELTA)
+        finally:
+            slot.lock.release()
+        if relocate and hasattr(slot.lock, "unlink"):
+            # 旧槽位不再使用，销毁它的信号量（已打开的句柄在关闭前仍然有效）
+            slot.lock.unlink()
+        return True
+
+    def get_bytes(self, key, mode: str = READ_MODE_SEQLOCK, timeout: float = 5.0):
+        """读取键对应的原始字节，键不存在时返回 None"""
+        key = _encode_key(key)
+        slot = self._find(key)
+        if slot is None:
+            return None
+        while True:
+            data = shm_read_bytes(self.shm, slot.lock, slot.data_offset, mode, timeout,
+                                  slot.buf_size)
+            # 读取之后核对：读取期间槽位被迁移时到新区域重新读取
+            if not self._moved(slot):
+                return data
+            slot = self._current(key, slot)
+
+    def put_bytes(self, key, data, capacity: int = None, timeout: float = 5.0):
+        """写入键对应的原始字节，键不存在时新建槽位
+
+        capacity 为变长槽位新建时分配的数据容量（默认为 len(data)）；之后写入更长的值时
+        槽位迁移到更大的区域。定长槽位忽略该参数，数据超过 slot_size 时抛出 ValueError。
+        """
+        n = len(data)
+        if self.slot_size and n > self.slot_size:
+            raise ValueError(f"数据太长: {n} > {self.slot_size} bytes")
+        started = time.perf_counter() if METRICS.enabled else None
+        key = _encode_key(key)
+        slot = self._find(key)
+        if slot is None:
+            slot = self._create(key, n if capacity is None else capacity, timeout)
+        while not self._write(key, slot, data, timeout):
+            slot = self._current(key, slot)
+        if started is not None:
+            METRICS.record_shm("write", n, started)
+
+    def get(self, key, mode: str = READ_MODE_SEQLOCK, timeout: float = 5.0):
+        """读取键对应的文本，键不存在时返回 None"""
+        data = self.get_bytes(key, mode, timeout)
+        if data is None:
+            return None
+        return data.decode("utf-8", errors="replace")
+
+    def put(self, key, value: str, capacity: int = None, timeout: float = 5.0):
+        """写入键对应的文本"""
+        self.put_bytes(key, value.encode("utf-8"), capacity, timeout)
+
+    def keys(self):
+        """返回所有键（UTF-8 解码）"""
+        with self._cache_lock:
+            self._scan()
+            return [key.decode("utf-8", errors="replace") for key in self._slots]
+
+    def __len__(self):
+        return self._used()
+
+    def capacity(self, key):
+        """键对应槽位的数据容量，键不存在时返回 None"""
+        key = _encode_key(key)
+        slot = self._find(key)
+        return None if slot is None else self._current(key, slot).capacity
+
+    def _current_slots(self):
+        """扫描新建的目录项并刷新已迁移的槽位，返回所有键当前的槽位"""
+        with self._cache_lock:
+            self._scan()
+            slots = list(self._slots.items())
+        return [self._current(key, slot) for key, slot in slots]
+
+    def version(self):
+        """各槽位版本号之和：任意槽位写入或新建键都会使其增加（用于判断表内容是否变化）"""
+        return sum(slot.lock.seqlock.version() for slot in self._current_slots())
+
+    def close(self):
+        """关闭本进程的锁句柄（信号量锁），包括已迁移的旧槽位"""
+        for lock in self._locks() + [slot.lock for slot in self._retired]:
+            if hasattr(lock, "close"):
+                lock.close()
+
+    def unlink(self):
+        """销毁各槽位锁占用的命名信号量（由创建段的 Host 在停止时调用）
+
+        已迁移的旧槽位的信号量由迁移它的一方销毁。
+        """
+        self._current_slots()
+        for lock in self._locks():
+            if hasattr(lock, "unlink"):
+                lock.unlink()
+
+    def _locks(self):
+        return [self.dir_lock] + [slot.lock for slot in list(self._slots.values())]
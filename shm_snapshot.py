@@ -0,0 +1,333 @@
+"""快照模块
+把段内容保存到文件、从文件恢复，Host 停止或崩溃后可以从最近的快照热启动
+
+快照文件格式（小端序）:
+    偏移  大小  内容
+    0     4     magic         b"SHMS"
+    4     2     format        文件格式版本（SNAPSHOT_FORMAT）
+    6     1     layout        段布局（LAYOUT_SINGLE / LAYOUT_SLOTS）
+    7     1     lock_kind     段的锁类型
+    8     4     slot_count    槽位布局的目录容量（单值布局为 0）
+    12    4     slot_size     定长槽位的容量
+    16    8     segment_size  保存时段的大小
+    24    8     version       保存时的内容版本号（槽位布局为各槽位版本号之和）
+    32    8     length        负载长度
+    40    8     created       保存时间（Unix 时间戳，float64）
+    48    4     crc32         负载的 CRC32
+    52    12    保留
+    64    ...   负载          单值布局为数据区原样；槽位布局为
+                              (uint16 键长度 + uint32 容量 + uint32 值长度 + 键 + 值) * N
+
+写入：单值布局在 seqlock 保护下把数据区直接复制到临时文件的内存映射中（不持有写锁，
+期间发生写入则重新复制，多次失败后才退化为加锁复制），校验和、fsync 之后原子重命名为目标文件，
+崩溃时目标文件要么是旧快照、要么是新快照。槽位布局逐个槽位一致地读取（各槽位之间不是同一时刻）。
+"""
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+from shared_memory_utils import (
+    DATA_OFFSET, LAYOUT_SINGLE, LAYOUT_SLOTS, READ_MODE_SEQLOCK, _consistent_read,
+    segment_capacity, segment_layout, segment_lock_kind, segment_size, segment_version,
+    shm_write_bytes
+)
+from shm_metrics import METRICS
+from shm_slots import SlotTable
+
+SNAPSHOT_MAGIC = b"SHMS"
+SNAPSHOT_FORMAT = 1
+SNAPSHOT_HEADER_FMT = "<4sHBBIIQQQdI"
+SNAPSHOT_HEADER_SIZE = 64
+SLOT_RECORD_FMT = "<HII"
+SLOT_RECORD_SIZE = struct.calcsize(SLOT_RECORD_FMT)
+DEFAULT_SNAPSHOT_INTERVAL = 60.0  # 定期快照的间隔（秒），内容未变化时跳过
+
+
+class SnapshotError(RuntimeError):
+    """快照文件格式错误或已损坏"""
+
+
+class SnapshotInfo:
+    """快照文件头中的信息"""
+    __slots__ = ("path", "layout", "lock_kind", "slot_count", "slot_size", "segment_size",
+                 "version", "length", "created", "crc32")
+
+    def __init__(self, path, layout, lock_kind, slot_count, slot_size, segment_size, version,
+                 length, created, crc32):
+        self.path = path
+        self.layout = layout
+        self.lock_kind = lock_kind
+        self.slot_count = slot_count
+        self.slot_size = slot_size
+        self.segment_size = segment_size
+        self.version = version
+        self.length = length
+        self.created = created
+        self.crc32 = crc32
+
+    def __repr__(self):
+        return (f"SnapshotInfo(path={self.path!r}, layout={self.layout}, version={self.version}, "
+                f"length={self.length}, segment_size={self.segment_size})")
+
+
+def _fsync_dir(path: str):
+    """重命名后同步目录项（Windows 不支持打开目录，跳过）"""
+    if os.name != "posix":
+        return
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _pack_header(shm, layout, version, length, crc, slot_count=0, slot_size=0):
+    return struct.pack(SNAPSHOT_HEADER_FMT, SNAPSHOT_MAGIC, SNAPSHOT_FORMAT, layout,
+                       segment_lock_kind(shm), slot_count, slot_size, segment_size(shm), version,
+                       length, time.time(), crc)
+
+
+def _write_file(path: str, size: int, fill):
+    """创建临时文件并映射 size 字节，由 fill(mm) 填充并返回实际的文件长度；
+    截断到该长度、fsync 后原子重命名为 path"""
+    tmp = f"{path}.tmp{os.getpid()}"
+    fd = os.open(tmp, os.O_RDWR | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o644)
+    try:
+        os.ftruncate(fd, size)
+        with mmap.mmap(fd, size) as mm:
+            length = fill(mm)
+            mm.flush()
+        os.ftruncate(fd, length)
+        os.fsync(fd)
+    except BaseException:
+        os.close(fd)
+        os.unlink(tmp)
+        raise
+    os.close(fd)
+    os.replace(tmp, path)
+    _fsync_dir(path)
+
+
+def save_snapshot(path: str, shm, lock=None, table: SlotTable = None):
+    """把段内容保存为快照文件，返回 SnapshotInfo
+
+    单值布局需要 lock（段的锁对象），槽位布局需要 table（SlotTable）。
+    """
+    started = time.perf_counter()
+    layout = segment_layout(shm)
+    if layout == LAYOUT_SINGLE:
+        if lock is None:
+            raise ValueError("单值布局的快照需要段的锁对象")
+        info = _save_single(path, shm, lock)
+    elif layout == LAYOUT_SLOTS:
+        if table is None:
+            raise ValueError("槽位布局的快照需要 SlotTable")
+        info = _save_slots(path, shm, table)
+    else:
+        raise ValueError(f"不支持快照的段布局: {layout}")
+    if METRICS.enabled:
+        METRICS.record_shm("snapshot", info.length, started)
+    return info
+
+
+def _save_single(path, shm, lock):
+    """数据区直接复制到文件映射中（seqlock 一致复制，不持有写锁）"""
+    capacity = segment_capacity(shm)
+
+    def fill(mm):
+        target = memoryview(mm)
+        buf = shm.buf
+
+        def copy(a, b):
+            # 复制在 seqlock 校验窗口内进行，版本号与数据一致；读取期间有写入时整体重新复制
+            n = b - a
+            target[SNAPSHOT_HEADER_SIZE:SNAPSHOT_HEADER_SIZE+n] = buf[a:b]
+            return segment_version(shm), n
+
+        try:
+            version, n = _consistent_read(shm, lock, DATA_OFFSET, READ_MODE_SEQLOCK, copy)
+            crc = zlib.crc32(target[SNAPSHOT_HEADER_SIZE:SNAPSHOT_HEADER_SIZE+n])
+            header = _pack_header(shm, LAYOUT_SINGLE, version, n, crc)
+            target[:len(header)] = header
+        finally:
+            target.release()
+        return SNAPSHOT_HEADER_SIZE + n
+
+    _write_file(path, SNAPSHOT_HEADER_SIZE + capacity, fill)
+    return read_snapshot_info(path)
+
+
+def _save_slots(path, shm, table):
+    """逐个槽位读取后写入（每个槽位各自一致）"""
+    version = table.version()  # 先于读取取得：读取期间的写入会使下一次定期快照不被跳过
+    records = []
+    for key in table.keys():
+        value = table.get_bytes(key)
+        if value is None:
+            continue
+        key_bytes = key.encode("utf-8")
+        records.append(struct.pack(SLOT_RECORD_FMT, len(key_bytes), table.capacity(key),
+                                   len(value)))
+        records.append(key_bytes)
+        records.append(value)
+    payload = b"".join(records)
+    crc = zlib.crc32(payload)
+    header = _pack_header(shm, LAYOUT_SLOTS, version, len(payload), crc, table.slot_count,
+                          table.slot_size)
+
+    def fill(mm):
+        mm[:len(header)] = header
+        mm[SNAPSHOT_HEADER_SIZE:SNAPSHOT_HEADER_SIZE+len(payload)] = payload
+        return SNAPSHOT_HEADER_SIZE + len(payload)
+
+    _write_file(path, SNAPSHOT_HEADER_SIZE + max(len(payload), 1), fill)
+    return read_snapshot_info(path)
+
+
+def content_version(shm, table: SlotTable = None):
+    """段内容的版本号（与快照文件头中的 version 含义相同）"""
+    return table.version() if table is not None else segment_version(shm)
+
+
+def _parse_header(path: str, header, file_size: int):
+    if len(header) < SNAPSHOT_HEADER_SIZE:
+        raise SnapshotError(f"快照文件太短: {path}")
+    fields = struct.unpack_from(SNAPSHOT_HEADER_FMT, header)
+    if fields[0] != SNAPSHOT_MAGIC:
+        raise SnapshotError(f"不是快照文件: {path}")
+    if fields[1] != SNAPSHOT_FORMAT:
+        raise SnapshotError(f"不支持的快照格式版本: {fields[1]}")
+    info = SnapshotInfo(path, *fields[2:])
+    if SNAPSHOT_HEADER_SIZE + info.length != file_size:
+        raise SnapshotError(f"快照文件长度不符: {file_size} != "
+                            f"{SNAPSHOT_HEADER_SIZE + info.length}")
+    return info
+
+
+def read_snapshot_info(path: str):
+    """读取快照文件头，不读取负载"""
+    with open(path, "rb") as f:
+        header = f.read(SNAPSHOT_HEADER_SIZE)
+        return _parse_header(path, header, os.fstat(f.fileno()).st_size)
+
+
+def _open_payload(path: str):
+    """映射快照文件并校验负载，返回 (SnapshotInfo, mmap, 负载的 memoryview)
+
+    文件头和负载来自同一次映射，读取期间文件被新快照替换也不会混用新旧内容。
+    """
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size < SNAPSHOT_HEADER_SIZE:
+            raise SnapshotError(f"快照文件太短: {path}")
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        info = _parse_header(path, mm[:SNAPSHOT_HEADER_SIZE], len(mm))
+    except SnapshotError:
+        mm.close()
+        raise
+    payload = memoryview(mm)[SNAPSHOT_HEADER_SIZE:SNAPSHOT_HEADER_SIZE+info.length]
+    if zlib.crc32(payload) != info.crc32:
+        payload.release()
+        mm.close()
+        raise SnapshotError(f"快照校验和不符（文件已损坏）: {path}")
+    return info, mm, payload
+
+
+def restore_snapshot(path: str, shm, lock=None, table: SlotTable = None):
+    """把快照内容写入段（布局必须与快照相同），返回 SnapshotInfo
+
+    单值布局把文件映射直接复制到数据区（一次写入，订阅者只看到一次变化）；
+    段容量不足时抛出 ValueError，调用方应先按 info.length 扩容或创建更大的段。
+    """
+    info, mm, payload = _open_payload(path)
+    layout = segment_layout(shm)
+    try:
+        if layout != info.layout:
+            raise ValueError(f"段布局与快照不一致: {layout} != {info.layout}")
+        if layout == LAYOUT_SINGLE:
+            if lock is None:
+                raise ValueError("单值布局的恢复需要段的锁对象")
+            shm_write_bytes(shm, payload, lock)
+        else:
+            if table is None:
+                raise ValueError("槽位布局的恢复需要 SlotTable")
+            for key, capacity, value in _iter_slot_records(payload):
+                table.put_bytes(key, value, capacity)
+    finally:
+        payload.release()
+        mm.close()
+    return info
+
+
+def _iter_slot_records(payload):
+    pos = 0
+    while pos < len(payload):
+        if pos + SLOT_RECORD_SIZE > len(payload):
+            raise SnapshotError("槽位记录被截断")
+        key_len, capacity, value_len = struct.unpack_from(SLOT_RECORD_FMT, payload, pos)
+        pos += SLOT_RECORD_SIZE
+        if pos + key_len + value_len > len(payload):
+            raise SnapshotError("槽位记录被截断")
+        key = bytes(payload[pos:pos+key_len])
+        value = bytes(payload[pos+key_len:pos+key_len+value_len])
+        pos += key_len + value_len
+        yield key, capacity, value
+
+
+class Snapshotter:
+    """定期快照：每隔 interval 秒检查一次，内容版本变化时保存快照
+
+    get_target: 无参回调，返回当前的 (shm, lock, table)（段扩容后返回新段）
+    on_snapshot: 每次保存后的回调 on_snapshot(info, error)，在快照线程中调用
+    """
+    def __init__(self, path: str, get_target, interval: float = DEFAULT_SNAPSHOT_INTERVAL,
+                 on_snapshot=None):
+        if interval <= 0:
+            raise ValueError(f"快照间隔必须大于 0: {interval}")
+        self.path = path
+        self.get_target = get_target
+        self.interval = interval
+        self.on_snapshot = on_snapshot
+        self.last_version = None  # 最近一次快照时的内容版本（见 content_version）
+        self.last_error = None
+        self._lock = threading.Lock()  # 定期快照与按需快照不并发写同一个文件
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="shm-snapshot", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=30.0)
+            self._thread = None
+
+    def snapshot(self, force: bool = True):
+        """立即保存快照并返回 SnapshotInfo；force=False 且内容未变化时跳过，返回 None"""
+        with self._lock:
+            shm, lock, table = self.get_target()
+            if not force and content_version(shm, table) == self.last_version:
+                return None
+            info = save_snapshot(self.path, shm, lock, table)
+            self.last_version = info.version
+            return info
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                info = self.snapshot(force=False)
+            except Exception as e:
+                self.last_error = e
+                if self.on_snapshot:
+                    self.on_snapshot(None, e)
+                continue
+            self.last_error = None
+            if info is not None and self.on_snapshot:
+                self.on_snapshot(info, None)
@@ -0,0 +1,262 @@
+"""shared_memory_utils 的测试：段头、在线扩容与 redirect、seqlock 读取"""
+import multiprocessing
+import threading
+import time
+
+import pytest
+
+from shared_memory_utils import (
+    DATA_OFFSET, LOCK_KIND_RWLOCK, LOCK_KIND_SEMAPHORE, LOCK_KIND_SPIN, READ_MODE_SEQLOCK,
+    SEQLOCK_READ_RETRIES, SegmentMovedError, attach_segment, create_segment, follow_redirect,
+    grow_segment, open_lock, segment_capacity, segment_generation, segment_redirect, segment_size,
+    segment_version, shm_read_bytes, shm_view, shm_write_bytes
+)
+from shm_metrics import METRICS
+from shm_server import release_lock
+
+LOCK_KINDS = (LOCK_KIND_SPIN, LOCK_KIND_SEMAPHORE, LOCK_KIND_RWLOCK)
+
+
+def close_lock(lock):
+    """关闭本进程的锁句柄（不 unlink，信号量归创建段的一方所有）"""
+    if hasattr(lock, "close"):
+        lock.close()
+
+
+class Segments:
+    """测试中创建的段，结束时统一关闭并 unlink"""
+    def __init__(self):
+        self.owned = []
+
+    def create(self, size=4096, lock_kind=LOCK_KIND_SPIN):
+        shm = create_segment(size, lock_kind=lock_kind)
+        return self.own(shm)
+
+    def own(self, shm):
+        lock = open_lock(shm)
+        self.owned.append((shm, lock))
+        return shm, lock
+
+    def close(self):
+        for shm, lock in reversed(self.owned):
+            release_lock(lock)
+            shm.close()
+            shm.unlink()
+
+
+@pytest.fixture
+def segments():
+    s = Segments()
+    yield s
+    s.close()
+
+
+def test_create_segment_header(segments):
+    shm, _ = segments.create(8192)
+    assert segment_size(shm) == 8192
+    assert segment_capacity(shm) == 8192 - DATA_OFFSET
+    assert segment_generation(shm) == 0
+    assert segment_redirect(shm) is None
+    assert segment_version(shm) == 0
+
+
+def test_write_too_long(segments):
+    shm, lock = segments.create(4096)
+    with pytest.raises(ValueError):
+        shm_write_bytes(shm, b"x" * (segment_capacity(shm) + 1), lock)
+
+
+@pytest.mark.parametrize("lock_kind", LOCK_KINDS)
+def test_grow_copies_data_and_publishes_redirect(segments, lock_kind):
+    shm, lock = segments.create(4096, lock_kind)
+    shm_write_bytes(shm, b"hello", lock)
+    new_shm, new_lock = segments.own(grow_segment(shm, lock, 65536))
+
+    assert segment_redirect(shm) == new_shm.name
+    assert segment_generation(new_shm) == 1
+    assert segment_size(new_shm) == 65536
+    assert shm_read_bytes(new_shm, new_lock) == b"hello"
+    # 序列计数器沿用旧段，版本号单调递增
+    assert segment_version(new_shm) == segment_version(shm)
+    with pytest.raises(SegmentMovedError):
+        shm_write_bytes(shm, b"lost", lock)
+    with pytest.raises(ValueError):
+        grow_segment(new_shm, new_lock, 65536)
+
+
+def test_attach_follows_redirect_chain(segments):
+    shm, lock = segments.create(4096)
+    mid, mid_lock = segments.own(grow_segment(shm, lock, 8192))
+    last, _ = segments.own(grow_segment(mid, mid_lock, 16384))
+    reader = attach_segment(shm.name, track=False)
+    try:
+        assert reader.name == last.name
+    finally:
+        reader.close()
+
+
+@pytest.mark.parametrize("lock_kind", LOCK_KINDS)
+def test_grow_under_concurrent_writes(segments, lock_kind):
+    """写者持续写入时多次扩容：写者沿 redirect 迁移，不丢失任何一次成功的写入"""
+    shm, lock = segments.create(4096, lock_kind)
+    stop = threading.Event()
+    result = {}
+
+    def writer():
+        w_shm = attach_segment(shm.name, track=False)
+        w_lock = open_lock(w_shm)
+        written = moves = 0
+        try:
+            while not stop.is_set():
+                try:
+                    shm_write_bytes(w_shm, str(written + 1).encode(), w_lock)
+                except SegmentMovedError:
+                    close_lock(w_lock)
+                    w_shm = follow_redirect(w_shm, track=False)
+                    w_lock = open_lock(w_shm)
+                    moves += 1
+                    continue
+                written += 1
+        finally:
+            result.update(written=written, moves=moves, name=w_shm.name)
+            close_lock(w_lock)
+            w_shm.close()
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    try:
+        current, current_lock = shm, lock
+        for size in (8192, 65536, 1 << 20):
+            time.sleep(0.05)
+            current, current_lock = segments.own(grow_segment(current, current_lock, size))
+        time.sleep(0.05)
+    finally:
+        stop.set()
+        thread.join()
+
+    assert result["name"] == current.name
+    assert result["moves"] >= 1
+    assert result["written"] > 0
+    assert shm_read_bytes(current, current_lock) == str(result["written"]).encode()
+    # 每次成功写入版本号 +1，跨段连续计数
+    assert segment_version(current) == result["written"]
+
+
+@pytest.mark.parametrize("lock_kind", LOCK_KINDS)
+def test_seqlock_version_and_write_window(segments, lock_kind):
+    shm, lock = segments.create(4096, lock_kind)
+    seqlock = lock.seqlock
+    shm_write_bytes(shm, b"a", lock)
+    shm_write_bytes(shm, b"b", lock)
+    assert seqlock.version() == segment_version(shm) == 2
+    start = seqlock.read_begin()
+    assert start is not None and seqlock.read_validate(start)
+    # 写入期间计数器为奇数，乐观读取不会开始；写入完成后原来的起始值失效
+    lock.acquire()
+    try:
+        seqlock.write_begin()
+        assert seqlock.read_begin() is None
+        seqlock.write_end()
+    finally:
+        lock.release()
+    assert not seqlock.read_validate(start)
+
+
+@pytest.fixture
+def metrics():
+    METRICS.reset()
+    METRICS.enable()
+    yield METRICS
+    METRICS.disable()
+    METRICS.reset()
+
+
+@pytest.mark.parametrize("lock_kind", LOCK_KINDS)
+def test_seqlock_read_falls_back_to_locked_copy(segments, metrics, monkeypatch, lock_kind):
+    """每次乐观复制期间都有写入时，重试 SEQLOCK_READ_RETRIES 次后退化为加锁复制"""
+    shm, lock = segments.create(4096, lock_kind)
+    shm_write_bytes(shm, b"first", lock)
+    read_validate = lock.seqlock.read_validate
+    calls = []
+
+    def write_before_validate(start):
+        calls.append(start)
+        # 模拟并发写者：乐观复制之后、校验之前写入，校验失败
+        shm_write_bytes(shm, b"write-%d" % len(calls), lock)
+        return read_validate(start)
+
+    monkeypatch.setattr(lock.seqlock, "read_validate", write_before_validate)
+    assert shm_read_bytes(shm, lock) == b"write-%d" % SEQLOCK_READ_RETRIES
+    assert len(calls) == SEQLOCK_READ_RETRIES
+    assert metrics.shm_read_fallbacks.get() == 1
+    # 加锁复制结束后锁已释放
+    shm_write_bytes(shm, b"after", lock, timeout=0)
+
+
+@pytest.mark.parametrize("lock_kind", LOCK_KINDS)
+def test_seqlock_view_falls_back_to_lock(segments, metrics, lock_kind):
+    """写入一直未完成时 seqlock 视图不会无限等待：退化为加锁，锁被占用时超时"""
+    shm, lock = segments.create(4096, lock_kind)
+    shm_write_bytes(shm, b"stable", lock)
+    with shm_view(shm, lock, mode=READ_MODE_SEQLOCK) as view:
+        assert bytes(view.data) == b"stable"
+    assert view.valid
+    assert metrics.shm_read_fallbacks.get() == 0
+
+    # 模拟写到一半停住的写者：持有锁且序列计数器为奇数
+    lock.acquire()
+    lock.seqlock.write_begin()
+    start = time.monotonic()
+    with pytest.raises(TimeoutError):
+        with shm_view(shm, lock, mode=READ_MODE_SEQLOCK, timeout=0.1):
+            pass
+    assert 0.1 <= time.monotonic() - start < 2.0
+    assert metrics.shm_read_fallbacks.get() == 1
+    lock.seqlock.write_end()
+    lock.release()
+
+    # 计数器仍为奇数但锁已释放（写者异常退出）：加锁读取成功
+    lock.seqlock.write_begin()
+    with shm_view(shm, lock, mode=READ_MODE_SEQLOCK, timeout=0.1) as view:
+        assert bytes(view.data) == b"stable"
+    assert view.valid
+    lock.seqlock.write_end()
+    shm_write_bytes(shm, b"after", lock, timeout=0)
+
+
+def _alternate_writes(name, payloads, stop):
+    shm = attach_segment(name, track=False)
+    lock = open_lock(shm)
+    try:
+        i = 0
+        while not stop.is_set():
+            shm_write_bytes(shm, payloads[i % len(payloads)], lock)
+            i += 1
+    finally:
+        close_lock(lock)
+        shm.close()
+
+
+@pytest.mark.parametrize("lock_kind", LOCK_KINDS)
+def test_seqlock_reads_are_never_torn(segments, lock_kind):
+    """另一个进程交替写入长度和内容都不同的数据，读者只会读到完整的某一份"""
+    shm, lock = segments.create(1 << 16, lock_kind)
+    payloads = (b"a" * 40000, b"b" * 100, b"c" * 12345)
+    shm_write_bytes(shm, payloads[0], lock)
+    stop = multiprocessing.Event()
+    writer = multiprocessing.Process(target=_alternate_writes, args=(shm.name, payloads, stop))
+    writer.start()
+    try:
+        seen = set()
+        deadline = time.monotonic() + 10.0
+        for _ in range(2000):
+            data = shm_read_bytes(shm, lock)
+            assert data in payloads
+            seen.add(data)
+            if time.monotonic() > deadline:
+                break
+    finally:
+        stop.set()
+        writer.join(10.0)
+    assert writer.exitcode == 0
+    assert len(seen) > 1
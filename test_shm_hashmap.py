@@ -0,0 +1,201 @@
+"""SharedHashMap 的测试：读写删除、墓碑、rehash 与跨进程挂载"""
+import os
+import subprocess
+import sys
+import threading
+
+import pytest
+
+from shared_memory_utils import segment_generation, segment_redirect
+from shm_hashmap import HashMapFullError, SharedHashMap, create_hashmap_segment
+
+
+@pytest.fixture
+def new_map():
+    maps = []
+
+    def create(capacity=64, auto_rehash=False, **kwargs):
+        m = SharedHashMap(create_hashmap_segment(capacity, **kwargs), auto_rehash)
+        maps.append(m)
+        return m
+
+    yield create
+    for m in maps:
+        m.close()
+        m.unlink()
+
+
+def test_put_get_overwrite_delete(new_map):
+    m = new_map()
+    assert m.get("missing") is None
+    m.put("a", "1")
+    m.put_bytes(b"b", b"\x00\x01")
+    assert m.get("a") == "1"
+    assert m.get_bytes("b") == b"\x00\x01"
+    m.put("a", "updated")
+    assert m.get("a") == "updated"
+    assert len(m) == 2
+    assert m.delete("a") is True
+    assert m.delete("a") is False
+    assert "a" not in m and "b" in m
+    assert len(m) == 1
+
+
+def test_key_and_value_limits(new_map):
+    m = new_map(key_size=8, value_size=16)
+    with pytest.raises(ValueError):
+        m.put("", "x")
+    with pytest.raises(ValueError):
+        m.put("k" * 9, "x")
+    with pytest.raises(ValueError):
+        m.put("k", "v" * 17)
+    m.put("k" * 8, "v" * 16)
+    assert m.get("k" * 8) == "v" * 16
+
+
+def test_tombstones_keep_probe_chains_intact(new_map):
+    """单个分段中反复插入删除：墓碑保证探测链上后面的键仍可查到，墓碑过多时原地整理"""
+    m = new_map(16, stripes=1)
+    limit = m.capacity
+    keys = [f"key{i}" for i in range(limit)]
+    for k in keys:
+        m.put(k, k)
+    for k in keys[::2]:
+        assert m.delete(k)
+    for k in keys[1::2]:
+        assert m.get(k) == k
+    # 删除和插入交替进行，总插入次数远超容量也不会报满
+    for round_ in range(10):
+        for k in keys[::2]:
+            m.put(f"{k}-{round_}", "x")
+        for k in keys[::2]:
+            assert m.delete(f"{k}-{round_}")
+    stats = m.stats()
+    assert stats["count"] == len(keys[1::2])
+    assert stats["count"] + stats["tombstones"] <= limit
+    for k in keys[1::2]:
+        assert m.get(k) == k
+
+
+def test_full_stripe_raises_or_rehashes(new_map):
+    m = new_map(8, stripes=1)
+    for i in range(m.capacity):
+        m.put(f"k{i}", "v")
+    with pytest.raises(HashMapFullError):
+        m.put("one more", "v")
+    m.put("k0", "overwrite is fine")
+
+    grown = new_map(8, auto_rehash=True, stripes=1)
+    for i in range(grown.capacity * 3):
+        grown.put(f"k{i}", str(i))
+    assert grown.stats()["generation"] >= 1
+    assert all(grown.get(f"k{i}") == str(i) for i in range(24))
+
+
+def test_rehash_moves_entries_to_new_segment(new_map):
+    m = new_map(16)
+    for i in range(10):
+        m.put(f"k{i}", str(i))
+    m.delete("k3")
+    old_shm = m.shm
+    new_shm = m.rehash(64)
+    assert m.shm is new_shm and new_shm.name != old_shm.name
+    assert segment_redirect(old_shm) == new_shm.name
+    assert segment_generation(new_shm) == 1
+    assert m.capacity >= 64
+    assert len(m) == 9 and m.stats()["tombstones"] == 0
+    assert m.get("k3") is None
+    assert all(m.get(f"k{i}") == str(i) for i in range(10) if i != 3)
+
+
+def test_reader_attached_before_rehash_follows_redirect(new_map):
+    m = new_map(16)
+    m.put("before", "1")
+    reader = SharedHashMap.attach(m.shm.name)
+    try:
+        assert reader.get("before") == "1"
+        m.rehash()
+        m.put("after", "2")
+        # 读者下一次操作时迁移到新段，能看到 rehash 之后的写入
+        assert reader.get("after") == "2"
+        assert reader.shm.name == m.shm.name
+        reader.put("from reader", "3")
+        assert m.get("from reader") == "3"
+    finally:
+        reader.close()
+
+
+def test_reads_during_concurrent_writes_are_consistent(new_map):
+    m = new_map(64, stripes=2)
+    m.put("counter", "0" * 32)
+    stop = threading.Event()
+
+    def writer():
+        i = 0
+        while not stop.is_set():
+            i += 1
+            m.put("counter", str(i % 10) * 32)
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    try:
+        for _ in range(2000):
+            value = m.get("counter")
+            assert len(set(value)) == 1 and len(value) == 32
+    finally:
+        stop.set()
+        thread.join()
+
+
+def test_attached_process_exit_keeps_segment():
+    """其他进程挂载后退出，不会经由它的 resource_tracker 删掉哈希表段"""
+    owner = SharedHashMap(create_hashmap_segment(64))
+    try:
+        owner.put("key", "value")
+        script = ("import sys; from shm_hashmap import SharedHashMap; "
+                  "m = SharedHashMap.attach(sys.argv[1]); assert m.get('key') == 'value'; "
+                  "m.put('child', 'was here'); m.close()")
+        subprocess.run([sys.executable, "-c", script, owner.shm.name], check=True, timeout=30,
+                       cwd=os.path.dirname(os.path.abspath(__file__)))
+        reader = SharedHashMap.attach(owner.shm.name)
+        try:
+            assert reader.get("child") == "was here"
+        finally:
+            reader.close()
+        assert owner.get("key") == "value"
+    finally:
+        owner.close()
+        owner.unlink()
+
+
+def test_process_following_rehash_keeps_new_segment():
+    """其他进程挂载旧段、沿 redirect 迁移到 rehash 后的新段再退出，新段仍然存在"""
+    owner = SharedHashMap(create_hashmap_segment(64))
+    try:
+        owner.put("key", "value")
+        script = ("import sys; from shm_hashmap import SharedHashMap; "
+                  "m = SharedHashMap.attach(sys.argv[1]); print('attached', flush=True); "
+                  "sys.stdin.readline(); assert m.get('key') == 'value'; "
+                  "assert m.shm.name != sys.argv[1]; m.close()")
+        child = subprocess.Popen([sys.executable, "-c", script, owner.shm.name],
+                                 stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True,
+                                 cwd=os.path.dirname(os.path.abspath(__file__)))
+        try:
+            assert child.stdout.readline().strip() == "attached"
+            owner.rehash()
+            child.stdin.write("go\n")
+            child.stdin.close()
+            assert child.wait(30) == 0
+        finally:
+            if child.poll() is None:
+                child.kill()
+        # 已映射的段在 unlink 后仍可访问，按名称重新挂载才能确认段还在
+        reader = SharedHashMap.attach(owner.retired_segments[0].shm.name)
+        try:
+            assert reader.shm.name == owner.shm.name
+            assert reader.get("key") == "value"
+        finally:
+            reader.close()
+    finally:
+        owner.close()
+        owner.unlink()
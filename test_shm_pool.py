@@ -0,0 +1,122 @@
+"""ClientPool 的测试：请求分配、Host 重启后按退避重连、shm_id 校验"""
+import threading
+import time
+
+import pytest
+
+from shm_pool import ClientPool
+from shm_server import SharedMemoryHost
+
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class States:
+    """记录 on_state 回调：(index, alive, error)"""
+    def __init__(self):
+        self.events = []
+        self.lock = threading.Lock()
+
+    def __call__(self, index, alive, error):
+        with self.lock:
+            self.events.append((index, alive, error))
+
+    def failures(self, index):
+        with self.lock:
+            return sum(1 for i, alive, error in self.events
+                       if i == index and not alive and error is not None)
+
+
+@pytest.fixture
+def host():
+    h = SharedMemoryHost(4096, host="127.0.0.1")
+    h.start()
+    yield h
+    h.stop()
+
+
+def test_requests_use_all_connections(host):
+    with ClientPool("127.0.0.1", host.address[1], shm_id=host.shm_id, size=3,
+                    local=False) as pool:
+        assert pool.healthy_count() == 3
+        pool.write("pooled")
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(pool.read()))
+                   for _ in range(6)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert results == ["pooled"] * 6
+        # 请求轮流分配，每条连接都用过
+        assert all(conn.last_used > 0 for conn in pool.connections)
+
+
+def test_reconnects_with_backoff_after_host_restart():
+    """Host 停止期间按指数退避重试，在同一端口重启后所有连接恢复"""
+    states = States()
+    first = SharedMemoryHost(4096, host="127.0.0.1")
+    first.start()
+    port = first.address[1]
+    with ClientPool("127.0.0.1", port, size=2, timeout=0.5, local=False,
+                    reconnect_min=0.05, reconnect_max=1.0, on_state=states) as pool:
+        pool.write("before restart")
+        first.stop()
+        assert wait_until(lambda: pool.healthy_count() == 0)
+        with pytest.raises(RuntimeError):
+            pool.read()
+        # 间隔从 0.05 秒逐次翻倍（带 0.5~1 倍抖动）：停止后约 1.5 秒内每条连接重试 3~7 次，而不是忙等
+        time.sleep(1.0)
+        assert all(3 <= conn.failures <= 7 for conn in pool.connections)
+        assert all(states.failures(index) >= 3 for index in range(2))
+
+        second = SharedMemoryHost(4096, host="127.0.0.1", port=port)
+        second.start()
+        try:
+            assert wait_until(lambda: pool.healthy_count() == 2)
+            assert all(conn.failures == 0 for conn in pool.connections)
+            assert pool.read() == ""
+            pool.write("after restart")
+            assert second.read() == "after restart"
+        finally:
+            second.stop()
+
+
+def test_rejects_host_with_other_shm_id(host):
+    states = States()
+    with ClientPool("127.0.0.1", host.address[1], shm_id="other", size=2, timeout=0.3,
+                    local=False, reconnect_min=0.05, on_state=states) as pool:
+        assert pool.healthy_count() == 0
+        assert "不匹配" in str(pool.last_error)
+        with pytest.raises(RuntimeError, match="没有可用的连接"):
+            pool.read()
+        # 维护线程继续按退避重试，但 ID 不一致时一直不会接受这个 Host
+        assert wait_until(lambda: states.failures(0) >= 3)
+        assert pool.healthy_count() == 0
+    assert host.read() == ""
+
+
+def test_restarted_host_with_new_shm_id_is_rejected():
+    """固定 shm_id 的连接池不会连到重启后段名已变化的 Host"""
+    first = SharedMemoryHost(4096, host="127.0.0.1")
+    first.start()
+    port = first.address[1]
+    with ClientPool("127.0.0.1", port, shm_id=first.shm_id, size=1, timeout=0.3,
+                    local=False, reconnect_min=0.05) as pool:
+        assert pool.healthy_count() == 1
+        first.stop()
+        assert wait_until(lambda: pool.healthy_count() == 0)
+        second = SharedMemoryHost(4096, host="127.0.0.1", port=port)
+        second.start()
+        try:
+            assert second.shm_id != first.shm_id
+            assert wait_until(lambda: "不匹配" in str(pool.last_error))
+            assert pool.healthy_count() == 0
+        finally:
+            second.stop()
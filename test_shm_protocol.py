@@ -0,0 +1,93 @@
+"""shm_protocol 的测试：负载压缩和压缩协商"""
+import os
+
+import pytest
+
+from shm_client import SharedMemoryClient
+from shm_protocol import (
+    CODEC_LZMA, CODEC_NONE, CODEC_ZLIB, COMPRESS_THRESHOLD, FLAG_COMPRESSED, Compression,
+    ProtocolError, choose_codec
+)
+from shm_server import SharedMemoryHost
+
+COMPRESSIBLE = b"shared memory " * 1000
+
+
+@pytest.mark.parametrize("codec", (CODEC_ZLIB, CODEC_LZMA))
+def test_compression_round_trip(codec):
+    compression = Compression(codec)
+    flags, packed = compression.encode(COMPRESSIBLE, 0x01)
+    assert flags == 0x01 | FLAG_COMPRESSED
+    assert len(packed) < len(COMPRESSIBLE) // 10
+    assert compression.decode(flags, packed) == (0x01, COMPRESSIBLE)
+
+
+@pytest.mark.parametrize("codec", (CODEC_ZLIB, CODEC_LZMA))
+def test_small_and_incompressible_payloads_are_sent_as_is(codec):
+    compression = Compression(codec)
+    small = b"x" * (COMPRESS_THRESHOLD - 1)
+    assert compression.encode(small) == (0, small)
+    noise = os.urandom(COMPRESS_THRESHOLD * 4)
+    assert compression.encode(noise) == (0, noise)
+    assert compression.decode(0, small) == (0, small)
+
+
+def test_decode_rejects_unexpected_or_damaged_frames():
+    flags, packed = Compression(CODEC_ZLIB).encode(COMPRESSIBLE)
+    with pytest.raises(ProtocolError):
+        Compression().decode(flags, packed)
+    with pytest.raises(ProtocolError):
+        Compression(CODEC_LZMA).decode(flags, packed)
+    with pytest.raises(ValueError):
+        Compression(99)
+
+
+def test_choose_codec():
+    assert choose_codec((CODEC_LZMA, CODEC_ZLIB)) == CODEC_LZMA
+    assert choose_codec((CODEC_LZMA, CODEC_ZLIB), (CODEC_ZLIB,)) == CODEC_ZLIB
+    assert choose_codec((CODEC_LZMA,), (CODEC_ZLIB,)) == CODEC_NONE
+    assert choose_codec((), (CODEC_ZLIB,)) == CODEC_NONE
+
+
+@pytest.fixture
+def decoded(monkeypatch):
+    """记录两个方向上收到的帧：(连接的算法, 是否压缩, 解压后的长度)"""
+    frames = []
+    decode = Compression.decode
+
+    def record(self, flags, payload):
+        result = decode(self, flags, payload)
+        frames.append((self.codec, bool(flags & FLAG_COMPRESSED), len(result[1])))
+        return result
+
+    monkeypatch.setattr(Compression, "decode", record)
+    return frames
+
+
+@pytest.mark.parametrize("name, codec", (("zlib", CODEC_ZLIB), ("lzma", CODEC_LZMA)))
+def test_compressed_connection_round_trip(decoded, name, codec):
+    with SharedMemoryHost(1 << 16, host="127.0.0.1") as host:
+        with SharedMemoryClient("127.0.0.1", host.address[1], local=False,
+                                compression=name) as client:
+            assert client.codec == codec
+            client.write_bytes(COMPRESSIBLE)
+            assert client.read_bytes() == COMPRESSIBLE
+            client.write("small")
+            assert client.read() == "small"
+        assert host.read() == "small"
+    # 大负载的请求和响应都压缩，小于阈值的帧原样发送
+    assert decoded.count((codec, True, len(COMPRESSIBLE))) == 2
+    assert (codec, False, len(b"small")) in decoded
+    assert all(compressed == (n >= COMPRESS_THRESHOLD) for _, compressed, n in decoded)
+
+
+@pytest.mark.parametrize("accepted, requested", (((), "zlib"), ((CODEC_ZLIB,), "lzma")))
+def test_falls_back_without_common_codec(decoded, accepted, requested):
+    """Host 不接受 Client 提出的任何算法时，连接不压缩，读写照常"""
+    with SharedMemoryHost(1 << 16, host="127.0.0.1", codecs=accepted) as host:
+        with SharedMemoryClient("127.0.0.1", host.address[1], local=False,
+                                compression=requested) as client:
+            assert client.codec == CODEC_NONE
+            client.write_bytes(COMPRESSIBLE)
+            assert client.read_bytes() == COMPRESSIBLE
+    assert decoded and not any(compressed for _, compressed, _ in decoded)
@@ -0,0 +1,99 @@
+"""ReplicaHost 的测试：增量订阅（SUBSCRIBE_DELTA）复制到本机只读段"""
+import socket
+import time
+
+import pytest
+
+from shm_client import SharedMemoryClient
+from shm_replica import ReplicaHost
+from shm_server import SharedMemoryHost
+
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+@pytest.fixture
+def upstream():
+    h = SharedMemoryHost(4096, host="127.0.0.1")
+    h.start()
+    yield h
+    h.stop()
+
+
+@pytest.fixture
+def replica(upstream):
+    upstream.write("initial")
+    r = ReplicaHost("127.0.0.1", upstream.address[1], upstream_shm_id=upstream.shm_id,
+                    host="127.0.0.1")
+    r.start()
+    yield r
+    r.stop()
+
+
+def in_sync(upstream, replica):
+    return (replica.upstream_version == upstream.version
+            and replica.read_bytes() == upstream.read_bytes())
+
+
+def test_replica_starts_from_snapshot(upstream, replica):
+    # 快照在 start() 返回前已经应用
+    assert replica.connected
+    assert replica.read() == "initial"
+    assert replica.upstream_version == upstream.version
+    assert replica.shm_id != upstream.shm_id
+
+
+def test_replica_applies_writes_and_patches(upstream, replica):
+    upstream.write("0123456789" * 10)
+    assert wait_until(lambda: in_sync(upstream, replica))
+    upstream.patch(50, b"PATCHED")
+    assert wait_until(lambda: in_sync(upstream, replica))
+    assert replica.read_bytes()[50:57] == b"PATCHED"
+    upstream.patch(20, b"end", truncate=True)
+    assert wait_until(lambda: in_sync(upstream, replica))
+    assert replica.read() == "01234567890123456789end"
+
+
+def test_replica_follows_many_small_changes(upstream, replica):
+    for i in range(200):
+        upstream.patch(i % 64, bytes([65 + i % 26]))
+    assert wait_until(lambda: in_sync(upstream, replica))
+
+
+def test_replica_grows_with_upstream(upstream, replica):
+    upstream.grow(1 << 20)
+    data = bytes(range(256)) * 400
+    upstream.write_bytes(data)
+    assert wait_until(lambda: in_sync(upstream, replica))
+    assert replica.capacity >= len(data)
+
+
+def test_replica_serves_read_only_clients(upstream, replica):
+    upstream.write("shared")
+    assert wait_until(lambda: in_sync(upstream, replica))
+    with SharedMemoryClient("127.0.0.1", replica.address[1], shm_id=replica.shm_id,
+                            local=False) as client:
+        assert client.read() == "shared"
+        with pytest.raises(RuntimeError, match="只读"):
+            client.write("not allowed")
+    assert upstream.read() == "shared"
+
+
+def test_replica_resyncs_after_connection_loss(upstream):
+    """与上游的连接断开后自动重连，重新接收快照补上断开期间的修改"""
+    states = []
+    with ReplicaHost("127.0.0.1", upstream.address[1], host="127.0.0.1",
+                     on_state=lambda connected, error: states.append(connected)) as replica:
+        assert states == [True]
+        replica.client.sock.shutdown(socket.SHUT_RDWR)
+        upstream.write("written around the disconnect")
+        assert wait_until(lambda: states[-1:] == [True] and len(states) >= 3)
+        assert False in states
+        assert wait_until(lambda: replica.connected and in_sync(upstream, replica))
+        assert replica.read() == "written around the disconnect"
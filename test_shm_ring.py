@@ -0,0 +1,168 @@
+"""shm_ring 的测试：阻塞模式背压、覆盖模式丢弃计数、批量读取和 SUBSCRIBE_STREAM 推送"""
+import threading
+import time
+
+import pytest
+
+from shm_client import SharedMemoryClient
+from shm_ring import (
+    RING_BLOCK, RING_OVERWRITE, RingConsumer, RingFullError, RingProducer, create_ring_segment,
+    ring_stats
+)
+from shm_server import SharedMemoryHost
+
+# 56 字节的消息加 8 字节记录头正好 64 字节，1024 字节的数据区放 16 条
+CAPACITY = 1024
+PER_RING = 16
+
+
+def message(i):
+    return b"%056d" % i
+
+
+@pytest.fixture
+def rings():
+    owned = []
+
+    def create(policy=RING_BLOCK, max_consumers=4):
+        shm = create_ring_segment(CAPACITY, max_consumers, policy)
+        owned.append(shm)
+        return shm
+
+    yield create
+    for shm in owned:
+        shm.close()
+        shm.unlink()
+
+
+def test_messages_in_order(rings):
+    shm = rings()
+    producer = RingProducer(shm)
+    with RingConsumer(shm) as consumer:
+        # 多轮回绕，消息长度不同，会写入回绕标记
+        for i in range(100):
+            producer.push(b"m" * (i % 300) + message(i))
+            assert consumer.pop(timeout=0) == b"m" * (i % 300) + message(i)
+        assert consumer.try_pop() is None
+
+
+def test_consumer_starts_at_head(rings):
+    shm = rings()
+    producer = RingProducer(shm)
+    producer.push(b"before")
+    with RingConsumer(shm) as consumer:
+        assert consumer.try_pop() is None
+        producer.push(b"after")
+        assert consumer.try_pop() == b"after"
+
+
+def test_block_backpressure(rings):
+    shm = rings(RING_BLOCK)
+    producer = RingProducer(shm)
+    with RingConsumer(shm) as consumer:
+        for i in range(PER_RING):
+            assert producer.try_push(message(i))
+        assert not producer.try_push(message(PER_RING))
+        with pytest.raises(RingFullError):
+            producer.push(message(PER_RING), timeout=0.05)
+        assert consumer.lag() == CAPACITY
+        # 读走一条后腾出一条的空间
+        assert consumer.pop() == message(0)
+        assert producer.try_push(message(PER_RING))
+        assert not producer.try_push(message(PER_RING + 1))
+        assert consumer.pop_many(100, timeout=0) == [message(i) for i in range(1, PER_RING + 1)]
+        assert consumer.dropped == 0
+
+
+def test_block_push_waits_for_consumer(rings):
+    shm = rings(RING_BLOCK)
+    producer = RingProducer(shm)
+    received = []
+    with RingConsumer(shm) as consumer:
+        def consume():
+            while len(received) < 200:
+                received.extend(consumer.pop_many(8, timeout=5.0))
+                time.sleep(0.001)
+
+        thread = threading.Thread(target=consume)
+        thread.start()
+        try:
+            for i in range(200):
+                producer.push(message(i), timeout=5.0)
+        finally:
+            thread.join()
+    assert received == [message(i) for i in range(200)]
+
+
+def test_block_ignores_closed_consumer(rings):
+    shm = rings(RING_BLOCK)
+    producer = RingProducer(shm)
+    consumer = RingConsumer(shm)
+    for i in range(PER_RING):
+        producer.push(message(i), timeout=0)
+    assert not producer.try_push(b"full")
+    # 关闭的消费者不再阻塞生产者
+    consumer.close()
+    assert producer.try_push(b"not full")
+
+
+def test_overwrite_counts_dropped(rings):
+    shm = rings(RING_OVERWRITE)
+    producer = RingProducer(shm)
+    with RingConsumer(shm) as slow, RingConsumer(shm) as fast:
+        total = 40
+        for i in range(total):
+            producer.push(message(i), timeout=0)
+            assert fast.try_pop() == message(i)
+        # 慢消费者跳过被覆盖的消息，按顺序读到最新的 PER_RING 条
+        assert slow.pop_many(100, timeout=0) == [message(i) for i in range(total - PER_RING, total)]
+        assert slow.dropped == total - PER_RING
+        assert fast.dropped == 0
+        stats = ring_stats(shm)
+        assert stats["policy"] == RING_OVERWRITE
+        assert [c["dropped"] for c in stats["consumers"]] == [total - PER_RING, 0]
+        assert [c["lag"] for c in stats["consumers"]] == [0, 0]
+
+
+def test_pop_many(rings):
+    shm = rings()
+    producer = RingProducer(shm)
+    with RingConsumer(shm) as consumer:
+        start = time.monotonic()
+        assert consumer.pop_many(10, timeout=0.05) == []
+        assert time.monotonic() - start >= 0.05
+        producer.push_many([message(i) for i in range(10)])
+        assert consumer.pop_many(4, timeout=0) == [message(i) for i in range(4)]
+        assert consumer.pop_many(100, timeout=0) == [message(i) for i in range(4, 10)]
+        assert consumer.lag() == 0
+
+
+def test_limits(rings):
+    shm = rings(max_consumers=2)
+    producer = RingProducer(shm)
+    with pytest.raises(ValueError, match="消息太长"):
+        producer.push(b"x" * CAPACITY)
+    with RingConsumer(shm), RingConsumer(shm):
+        with pytest.raises(RuntimeError):
+            RingConsumer(shm)
+    # 关闭后槽位可以重新认领
+    RingConsumer(shm).close()
+
+
+def test_subscribe_stream_over_tcp():
+    received = []
+    done = threading.Event()
+
+    def on_messages(messages):
+        received.extend(messages)
+        if len(received) >= 300:
+            done.set()
+
+    with SharedMemoryHost(4096, host="127.0.0.1", ring_size=1 << 16) as host:
+        with SharedMemoryClient("127.0.0.1", host.address[1], shm_id=host.shm_id, local=False,
+                                on_messages=on_messages) as client:
+            assert client.streaming
+            host.push("first")
+            host.push_many([message(i) for i in range(299)])
+            assert done.wait(5.0)
+    assert received == [b"first"] + [message(i) for i in range(299)]
@@ -0,0 +1,267 @@
+"""SharedMemoryHost / SharedMemoryClient 的测试：TCP 读写、运行中扩容、只读段、推送与批量请求"""
+import asyncio
+import threading
+import time
+
+import pytest
+
+import shm_client
+import shm_server
+from shared_memory_utils import VersionConflictError, mark_read_only, segment_redirect
+from shm_client import SharedMemoryClient
+from shm_protocol import OP_BATCH, SUBSCRIBE_CONTENT, SUBSCRIBE_VERSION
+from shm_server import SharedMemoryHost
+
+
+@pytest.fixture
+def host():
+    h = SharedMemoryHost(4096, host="127.0.0.1")
+    h.start()
+    yield h
+    h.stop()
+
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def connect(host, local=False):
+    return SharedMemoryClient("127.0.0.1", host.address[1], shm_id=host.shm_id, local=local)
+
+
+def test_write_and_read_over_tcp(host):
+    with connect(host) as client:
+        assert not client.is_local
+        client.write("hello")
+        assert client.read() == "hello"
+    assert host.read() == "hello"
+
+
+def test_local_client_attaches_segment(host):
+    with connect(host, local=True) as client:
+        assert client.is_local
+        client.write("local")
+        assert host.read() == "local"
+
+
+def test_grow_while_clients_write(host):
+    """TCP 和本机 Client 持续写入时 Host 多次扩容：所有写入都成功，版本号计入每一次写入"""
+    stop = threading.Event()
+    counts, errors = [], []
+
+    def writer(local):
+        written = 0
+        try:
+            with connect(host, local) as client:
+                while not stop.is_set():
+                    client.write_bytes(b"x" * (written % 3000 + 1))
+                    written += 1
+        except Exception as e:
+            errors.append(e)
+        counts.append(written)
+
+    threads = [threading.Thread(target=writer, args=(local,))
+               for local in (False, False, True)]
+    for t in threads:
+        t.start()
+    try:
+        for size in (8192, 65536, 1 << 20):
+            stop.wait(0.1)
+            host.grow(size)
+        stop.wait(0.1)
+    finally:
+        stop.set()
+        for t in threads:
+            t.join()
+
+    assert errors == []
+    assert host.capacity > 65536
+    assert all(n > 0 for n in counts)
+    assert host.version == sum(counts)
+
+
+def test_local_client_threads_follow_grow(host):
+    """同一个本机 Client 的多个线程在 Host 扩容时读写：各线程迁移到新段，读到的总是完整的内容"""
+    payloads = (b"a" * 3000, b"b" * 10)
+    host.write_bytes(payloads[0])
+    stop = threading.Event()
+    errors = []
+
+    with connect(host, local=True) as client:
+        def worker(i):
+            try:
+                while not stop.is_set():
+                    if i == 0:
+                        client.write_bytes(payloads[int(time.monotonic() * 1000) % 2])
+                    else:
+                        assert client.read_bytes() in payloads
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(4)]
+        for t in threads:
+            t.start()
+        try:
+            for size in (8192, 65536, 1 << 20):
+                stop.wait(0.05)
+                host.grow(size)
+            stop.wait(0.05)
+        finally:
+            stop.set()
+            for t in threads:
+                t.join()
+        assert errors == []
+        assert client.segment[0].name == host.shm.name
+
+
+def test_push_never_sends_older_version(host, monkeypatch):
+    """两次推送读取内容后的完成顺序颠倒：内容和版本订阅者都只收到较新的版本"""
+    received = {SUBSCRIBE_CONTENT: [], SUBSCRIBE_VERSION: []}
+    reads = []
+    read_if_newer = host.server._read_if_newer
+
+    async def slow_first_read(since_version):
+        result = await read_if_newer(since_version)
+        reads.append(result[0])
+        if len(reads) == 1:
+            await asyncio.sleep(0.2)  # 第一次推送读到内容后被挂起，第二次推送先发出
+        return result
+
+    def subscribe(mode):
+        return SharedMemoryClient("127.0.0.1", host.address[1], local=False, subscribe_mode=mode,
+                                  on_notify=lambda version, _: received[mode].append(version))
+
+    monkeypatch.setattr(host.server, "_read_if_newer", slow_first_read)
+    with subscribe(SUBSCRIBE_CONTENT), subscribe(SUBSCRIBE_VERSION):
+        host.write("one")
+        assert wait_until(lambda: reads)
+        host.write("two")
+        assert wait_until(lambda: len(reads) == 2)
+        time.sleep(0.4)
+    assert reads == [1, 2]
+    assert received == {SUBSCRIBE_CONTENT: [2], SUBSCRIBE_VERSION: [2]}
+
+
+@pytest.mark.parametrize("local", (False, True))
+def test_read_only_host_rejects_writes(local):
+    with SharedMemoryHost(4096, host="127.0.0.1", read_only=True) as host:
+        with connect(host, local) as client:
+            assert client.is_local == local
+            for _ in range(2):
+                with pytest.raises(RuntimeError, match="只读"):
+                    client.write("x")
+                with pytest.raises(RuntimeError, match="只读"):
+                    client.patch(0, b"x")
+                # 扩容后的新段同样只读，本机 Client 迁移到新段后仍拒绝写入
+                host.grow(host.capacity * 4)
+            assert client.read() == ""
+
+
+def test_local_write_retry_after_grow_checks_read_only(host, monkeypatch):
+    """写入时段已迁移（SegmentMovedError 重试路径）也要检查新段是否只读"""
+    with connect(host, local=True) as client:
+        client.write("before")
+        host.grow(65536)
+        # 新段只读，模拟迁移到副本的段
+        mark_read_only(host.shm)
+        # 第一次检查 redirect 时还未迁移：Client 写入旧段，得到 SegmentMovedError 后重试
+        calls = []
+
+        def stale_redirect(shm):
+            calls.append(shm)
+            return None if len(calls) == 1 else segment_redirect(shm)
+
+        monkeypatch.setattr(shm_client, "segment_redirect", stale_redirect)
+        with pytest.raises(RuntimeError, match="只读"):
+            client.write("after")
+        assert len(calls) > 1
+        assert client.shm.name == host.shm.name
+        assert host.read() == "before"
+
+
+def test_batch_mixed_operations_in_one_frame(host, monkeypatch):
+    """READ/WRITE/PATCH 打包为一个 BATCH 帧，按顺序执行，结果与操作顺序一致"""
+    with connect(host) as client:
+        client.write("start")
+        version = host.version
+        opcodes = []
+        request_async = client.request_async
+
+        def record(opcode, *args, **kwargs):
+            opcodes.append(opcode)
+            return request_async(opcode, *args, **kwargs)
+
+        monkeypatch.setattr(client, "request_async", record)
+        results = (client.batch()
+                   .read_bytes()
+                   .write("hello world")
+                   .patch(6, b"WORLD", expected_version=version + 1)
+                   .read_bytes()
+                   .patch(5, b"!", truncate=True)
+                   .execute())
+        assert opcodes == [OP_BATCH]
+    assert results == [b"start", None, version + 2, b"hello WORLD", version + 3]
+    assert host.read() == "hello!"
+
+
+def test_batch_reports_errors_per_operation(host):
+    """失败的操作在对应位置是异常对象，不影响前后的操作"""
+    with connect(host) as client:
+        client.write("base")
+        stale = host.version - 1
+        results = (client.batch()
+                   .patch(0, b"x", expected_version=stale)
+                   .write("after conflict")
+                   .patch(host.capacity + 1, b"too far")
+                   .get_bytes("key")
+                   .read_bytes()
+                   .execute())
+        assert client.batch().execute() == []
+    conflict, written, too_far, no_slots, read = results
+    assert isinstance(conflict, VersionConflictError)
+    assert (conflict.expected, conflict.actual) == (stale, stale + 1)
+    assert written is None
+    assert isinstance(too_far, RuntimeError)
+    assert isinstance(no_slots, RuntimeError)
+    assert read == b"after conflict"
+
+
+def test_batch_on_slots_host():
+    with SharedMemoryHost(1 << 16, host="127.0.0.1", slots=8) as host:
+        with connect(host) as client:
+            results = (client.batch()
+                       .put_bytes("a", b"1")
+                       .put_bytes("b", b"22")
+                       .get_bytes("a")
+                       .get_bytes("missing")
+                       .get_bytes("b")
+                       .execute())
+    assert results == [None, None, b"1", None, b"22"]
+
+
+@pytest.mark.parametrize("method", ("write_bytes", "patch"))
+def test_host_write_retries_after_concurrent_grow(host, monkeypatch, method):
+    """Host 自己的写入取得段之后、写入之前段被扩容：改写到新段，不抛出 SegmentMovedError"""
+    name = "shm_write_bytes" if method == "write_bytes" else "shm_patch"
+    write = getattr(shm_server, name)
+    calls = []
+
+    def grow_then_write(shm, *args, **kwargs):
+        calls.append(shm.name)
+        if len(calls) == 1:
+            host.grow(65536)
+        return write(shm, *args, **kwargs)
+
+    monkeypatch.setattr(shm_server, name, grow_then_write)
+    if method == "write_bytes":
+        host.write_bytes(b"after grow")
+    else:
+        host.patch(0, b"after grow")
+    assert calls == [host.retired_segments[0][0].name, host.shm.name]
+    assert host.read_bytes() == b"after grow"
+    assert host.version == 1
@@ -0,0 +1,162 @@
+"""shm_slots 的测试：槽位读写、变长槽位迁移到更大的区域、其他进程缓存的旧槽位"""
+import threading
+
+import pytest
+
+from shared_memory_utils import LOCK_KIND_SEMAPHORE, LOCK_KIND_SPIN, attach_segment
+from shm_slots import MIN_SLOT_CAPACITY, SlotTable, create_slot_segment
+
+LOCK_KINDS = (LOCK_KIND_SPIN, LOCK_KIND_SEMAPHORE)
+
+
+@pytest.fixture
+def tables():
+    owned, attached = [], []
+
+    def create(size=1 << 16, slot_count=8, slot_size=0, lock_kind=LOCK_KIND_SPIN):
+        shm = create_slot_segment(size, slot_count, slot_size, lock_kind)
+        table = SlotTable(shm)
+        owned.append((shm, table))
+        return table
+
+    def attach(table):
+        """以独立的段句柄和缓存打开同一张表，相当于另一个进程"""
+        shm = attach_segment(table.shm.name, track=False)
+        other = SlotTable(shm)
+        attached.append((shm, other))
+        return other
+
+    create.attach = attach
+    yield create
+    for shm, table in attached:
+        table.close()
+        shm.close()
+    for shm, table in owned:
+        table.unlink()
+        table.close()
+        shm.close()
+        shm.unlink()
+
+
+def test_put_get(tables):
+    table = tables()
+    assert table.get("missing") is None
+    table.put("a", "1")
+    table.put_bytes("b", b"\x00\x01", capacity=500)
+    assert table.get("a") == "1"
+    assert table.get_bytes("b") == b"\x00\x01"
+    assert table.capacity("a") == MIN_SLOT_CAPACITY
+    assert table.capacity("b") == 504
+    assert sorted(table.keys()) == ["a", "b"]
+    assert len(table) == 2
+    with pytest.raises(ValueError):
+        table.put("", "x")
+    with pytest.raises(ValueError):
+        table.put("k" * 49, "x")
+
+
+@pytest.mark.parametrize("lock_kind", LOCK_KINDS)
+def test_variable_slot_grows(tables, lock_kind):
+    """变长槽位写入超过容量的值时迁移到更大的区域，不再抛出“数据太长”"""
+    table = tables(lock_kind=lock_kind)
+    table.put("key", "short")
+    table.put("other", "neighbour")
+    version = table.version()
+    table.put_bytes("key", b"x" * 100)
+    assert table.get_bytes("key") == b"x" * 100
+    assert table.capacity("key") == 2 * MIN_SLOT_CAPACITY
+    table.put_bytes("key", b"y" * 1000)
+    assert table.capacity("key") == 1000
+    assert table.get_bytes("key") == b"y" * 1000
+    # 迁移后写入更短的值不再迁移，尾部清零
+    table.put_bytes("key", b"z")
+    assert table.capacity("key") == 1000
+    assert table.get_bytes("key") == b"z"
+    assert table.get("other") == "neighbour"
+    # 版本号沿用旧槽位的计数器，单调递增
+    assert table.version() == version + 3
+    assert sorted(table.keys()) == ["key", "other"]
+
+
+def test_relocation_out_of_space(tables):
+    table = tables(size=4096, slot_count=4)
+    table.put_bytes("key", b"x" * 100)
+    table.put_bytes("key", b"y" * 1200)
+    assert table.capacity("key") == 1200
+    # 翻倍（2400）放不下时只分配所需的容量
+    table.put_bytes("key", b"z" * 1201)
+    assert table.capacity("key") == 1208
+    with pytest.raises(ValueError, match="槽位空间不足"):
+        table.put_bytes("key", b"w" * 2000)
+    assert table.get_bytes("key") == b"z" * 1201
+
+
+def test_fixed_slot_rejects_long_value(tables):
+    table = tables(slot_size=32)
+    table.put_bytes("key", b"x" * 32)
+    with pytest.raises(ValueError, match="数据太长"):
+        table.put_bytes("key", b"x" * 33)
+    assert table.get_bytes("key") == b"x" * 32
+
+
+@pytest.mark.parametrize("lock_kind", LOCK_KINDS)
+def test_other_process_follows_relocation(tables, lock_kind):
+    """另一个进程缓存了旧槽位：读取和写入都改用迁移后的区域，写入不会丢失"""
+    table = tables(lock_kind=lock_kind)
+    table.put("key", "v1")
+    other = tables.attach(table)
+    assert other.get("key") == "v1"
+    version = other.version()
+
+    table.put("key", "v2" * 100)
+    assert other.get("key") == "v2" * 100
+    assert other.capacity("key") == table.capacity("key")
+    assert other.version() == version + 1
+
+    # 旧缓存的一方写入同样写到新区域
+    third = tables.attach(table)
+    assert third.get("key") == "v2" * 100
+    other.put("key", "v3" * 300)
+    third.put("key", "v4")
+    assert table.get("key") == "v4"
+    assert other.get("key") == "v4"
+
+
+def test_concurrent_writers_during_relocation(tables):
+    """多个“进程”同时写入逐渐变长的值：每次读取都是某一次完整的写入"""
+    table = tables(size=1 << 20)
+    table.put("key", "")
+    views = [table] + [tables.attach(table) for _ in range(3)]
+    errors = []
+    stop = threading.Event()
+
+    def writer(view, tag):
+        try:
+            for i in range(1, 200):
+                view.put_bytes("key", tag * i)
+        except Exception as e:
+            errors.append(e)
+
+    def reader(view):
+        try:
+            while not stop.is_set():
+                data = view.get_bytes("key")
+                assert len(set(data)) <= 1
+        except Exception as e:
+            errors.append(e)
+
+    writers = [threading.Thread(target=writer, args=(view, tag))
+               for view, tag in zip(views[:3], (b"a", b"b", b"c"))]
+    read_thread = threading.Thread(target=reader, args=(views[3],))
+    read_thread.start()
+    for t in writers:
+        t.start()
+    for t in writers:
+        t.join()
+    stop.set()
+    read_thread.join()
+    assert errors == []
+    final = table.get_bytes("key")
+    assert len(final) == 199
+    assert all(view.get_bytes("key") == final for view in views)
+    assert table.version() == 1 + 3 * 199
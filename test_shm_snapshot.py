@@ -0,0 +1,189 @@
+"""shm_snapshot 的测试：快照保存/恢复、一致性、损坏检测和 Host 热启动"""
+import os
+import threading
+
+import pytest
+
+from shared_memory_utils import (
+    create_segment, open_lock, segment_size, shm_read_bytes, shm_write_bytes
+)
+from shm_client import SharedMemoryClient
+from shm_server import SharedMemoryHost, release_lock
+from shm_slots import SlotTable, create_slot_segment
+from shm_snapshot import (
+    SNAPSHOT_HEADER_SIZE, SnapshotError, Snapshotter, read_snapshot_info, restore_snapshot,
+    save_snapshot
+)
+
+
+@pytest.fixture
+def segments():
+    owned = []
+
+    def create(size=4096, slots=0):
+        """返回 (shm, lock, table)：单值布局 table 为 None，槽位布局 lock 为 None"""
+        if slots:
+            shm = create_slot_segment(size, slots)
+            lock, table = None, SlotTable(shm)
+        else:
+            shm = create_segment(size)
+            lock, table = open_lock(shm), None
+        owned.append((shm, lock or table))
+        return shm, lock, table
+
+    yield create
+    for shm, lock in owned:
+        release_lock(lock)
+        shm.close()
+        shm.unlink()
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "state.snap")
+
+
+def test_single_round_trip(segments, path):
+    shm, lock, _ = segments(65536)
+    data = bytes(range(256)) * 100
+    shm_write_bytes(shm, data, lock)
+    info = save_snapshot(path, shm, lock)
+    assert info.length == len(data)
+    assert info.version == 1
+    assert info.segment_size == 65536
+    assert os.path.getsize(path) == SNAPSHOT_HEADER_SIZE + len(data)
+    assert os.listdir(os.path.dirname(path)) == ["state.snap"]  # 临时文件已重命名
+
+    target, target_lock, _ = segments(65536)
+    shm_write_bytes(target, b"old content that is longer", target_lock)
+    assert restore_snapshot(path, target, target_lock).length == len(data)
+    assert shm_read_bytes(target, target_lock) == data
+
+
+def test_empty_segment_round_trip(segments, path):
+    shm, lock, _ = segments()
+    assert save_snapshot(path, shm, lock).length == 0
+    target, target_lock, _ = segments()
+    restore_snapshot(path, target, target_lock)
+    assert shm_read_bytes(target, target_lock) == b""
+
+
+def test_slots_round_trip(segments, path):
+    shm, _, table = segments(1 << 16, slots=8)
+    table.put_bytes("a", b"1" * 10)
+    table.put_bytes("b", b"xyz", 500)
+    info = save_snapshot(path, shm, table=table)
+    assert info.slot_count == table.slot_count
+
+    target, _, target_table = segments(1 << 16, slots=8)
+    restore_snapshot(path, target, table=target_table)
+    assert sorted(target_table.keys()) == ["a", "b"]
+    assert target_table.get_bytes("a") == b"1" * 10
+    assert target_table.get_bytes("b") == b"xyz"
+    assert target_table.capacity("b") == table.capacity("b")
+
+
+def test_restore_checks_layout_and_capacity(segments, path):
+    shm, lock, _ = segments(65536)
+    shm_write_bytes(shm, b"x" * 10000, lock)
+    save_snapshot(path, shm, lock)
+    small, small_lock, _ = segments(4096)
+    with pytest.raises(ValueError):
+        restore_snapshot(path, small, small_lock)
+    slots_shm, _, table = segments(65536, slots=4)
+    with pytest.raises(ValueError):
+        restore_snapshot(path, slots_shm, table=table)
+
+
+@pytest.mark.parametrize("damage", ("payload", "magic", "truncate"))
+def test_damaged_snapshot_is_rejected(segments, path, damage):
+    shm, lock, _ = segments()
+    shm_write_bytes(shm, b"important state", lock)
+    save_snapshot(path, shm, lock)
+    with open(path, "r+b") as f:
+        if damage == "payload":
+            f.seek(-1, os.SEEK_END)
+            last = f.read(1)
+            f.seek(-1, os.SEEK_END)
+            f.write(bytes([last[0] ^ 1]))
+        elif damage == "magic":
+            f.write(b"XXXX")
+        else:
+            f.truncate(SNAPSHOT_HEADER_SIZE + 3)
+    target, target_lock, _ = segments()
+    with pytest.raises(SnapshotError):
+        restore_snapshot(path, target, target_lock)
+    assert shm_read_bytes(target, target_lock) == b""
+
+
+def test_snapshot_is_consistent_under_concurrent_writes(segments, path):
+    """写者持续写入长度和内容不同的数据时保存快照：快照总是某一次完整的写入"""
+    shm, lock, _ = segments(1 << 20)
+    shm_write_bytes(shm, b"\x00" * 1000, lock)
+    stop = threading.Event()
+
+    def writer():
+        i = 0
+        while not stop.is_set():
+            i += 1
+            shm_write_bytes(shm, bytes([i % 256]) * (1000 + i % 50000), lock)
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    try:
+        for _ in range(30):
+            info = save_snapshot(path, shm, lock)
+            with open(path, "rb") as f:
+                payload = f.read()[SNAPSHOT_HEADER_SIZE:]
+            assert len(payload) == info.length
+            assert len(set(payload)) == 1
+    finally:
+        stop.set()
+        thread.join()
+
+
+def test_snapshotter_skips_unchanged_content(segments, path):
+    shm, lock, _ = segments()
+    snapshotter = Snapshotter(path, lambda: (shm, lock, None), interval=60)
+    shm_write_bytes(shm, b"v1", lock)
+    assert snapshotter.snapshot(force=False).version == 1
+    assert snapshotter.snapshot(force=False) is None
+    shm_write_bytes(shm, b"v2", lock)
+    assert snapshotter.snapshot(force=False).version == 2
+    assert snapshotter.snapshot().version == 2  # force 总是保存
+
+
+def test_host_warm_start(path):
+    with SharedMemoryHost(4096, host="127.0.0.1", snapshot_path=path) as host:
+        host.grow(65536)
+        host.write_bytes(b"y" * 20000)
+    # 快照比配置的段大：按快照的段大小创建
+    with SharedMemoryHost(4096, host="127.0.0.1", snapshot_path=path, warm_start=True) as host:
+        assert host.restored is not None
+        assert segment_size(host.shm) == 65536
+        assert host.read_bytes() == b"y" * 20000
+    # 不热启动时从空段开始，停止时覆盖快照
+    with SharedMemoryHost(4096, host="127.0.0.1", snapshot_path=path) as host:
+        assert host.restored is None
+        assert host.read_bytes() == b""
+    assert read_snapshot_info(path).length == 0
+
+
+def test_host_final_snapshot_includes_last_tcp_write(path):
+    """停止时在服务停止之后保存：停止前经 TCP 完成的写入都在最终快照中"""
+    host = SharedMemoryHost(4096, host="127.0.0.1", snapshot_path=path)
+    host.start()
+    try:
+        with SharedMemoryClient("127.0.0.1", host.address[1], local=False) as client:
+            for i in range(50):
+                client.write(f"write {i}")
+    finally:
+        host.stop()
+    with SharedMemoryHost(4096, host="127.0.0.1", snapshot_path=path, warm_start=True) as host:
+        assert host.read() == "write 49"
+
+
+def test_host_on_demand_snapshot_requires_path():
+    with SharedMemoryHost(4096, host="127.0.0.1") as host:
+        with pytest.raises(ValueError):
+            host.snapshot()